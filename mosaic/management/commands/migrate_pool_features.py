@@ -0,0 +1,30 @@
+"""
+migrate_pool_features.py
+
+PURPOSE:
+    Management command that converts an image_pool collection's legacy pickled
+    avgRGB/avgLab features to the float32 encoding read by the photomosaic engine.
+
+HOW TO RUN:
+    python manage.py migrate_pool_features --db temp
+
+DETAILS:
+    - Idempotent: only documents without the current feature schema are rewritten.
+    - Updates are sent with one bulk_write per batch.
+"""
+
+from django.core.management.base import BaseCommand
+
+from photomosaic_exec import photomosaic as pm
+
+
+class Command(BaseCommand):
+    help = "Convert pickled pool features to the float32 feature schema."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--db', default='temp', help="MongoDB database holding image_pool")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        migrated = pm.migrate_features(options['db'], options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Migrated {migrated} pool documents."))
@@ -0,0 +1,43 @@
+"""
+prune_pool.py
+
+PURPOSE:
+    Management command that selects a coreset of the image_pool covering the pool's colour
+    features to a tolerance and flags every other image inactive (nothing is deleted).
+    Matching searches only the active set when MOSAIC_POOL_ACTIVE_ONLY=1.
+
+HOW TO RUN:
+    python manage.py prune_pool --db temp --tolerance 20 --dry-run
+    python manage.py prune_pool --db temp --tolerance 20
+
+DETAILS:
+    - Prints the coverage loss (distance from pruned images to their nearest kept image)
+      against the search speedup, so a tolerance can be chosen before flagging anything.
+    - Re-running replaces the previous flags.
+"""
+
+from django.core.management.base import BaseCommand
+
+from photomosaic_exec import photomosaic as pm
+
+
+class Command(BaseCommand):
+    help = "Flag near-redundant pool images inactive, keeping a colour-covering coreset."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--db', default='temp', help="MongoDB database holding image_pool")
+        parser.add_argument('--tolerance', type=float, required=True,
+                            help="Maximum feature distance from any pruned image to a kept one")
+        parser.add_argument('--method', choices=['kcenter', 'grid'], default='kcenter')
+        parser.add_argument('--color-space', choices=['rgb', 'lab'], default='rgb')
+        parser.add_argument('--max-size', type=int, default=None, help="Keep at most this many images")
+        parser.add_argument('--dry-run', action='store_true', help="Report only; do not flag images")
+
+    def handle(self, *args, **options):
+        report = pm.prune_pool(options['db'], options['tolerance'], options['method'],
+                               options['color_space'], options['max_size'], options['dry_run'])
+        self.stdout.write(
+            f"kept {report['kept']} of {report['total']} images, speedup {report['speedup']}x; "
+            f"coverage loss max {report['max_loss']}, mean {report['mean_loss']}, p95 {report['p95_loss']}")
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f"Flagged {report['pruned']} images inactive."))
@@ -2,7 +2,9 @@
 
 from __future__ import absolute_import
 import os
-from celery import Celery
+import uuid
+from celery import Celery, chain, chord, group
+from celery.exceptions import Ignore
 from django.conf import settings
 
 # Ensure Django settings are loaded for Celery
@@ -11,70 +13,317 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'photomosaic.settings')
 # --- Import photomosaic engine ---
 try:
     from photomosaic_exec import photomosaic as pm
+    from photomosaic_exec import distributed, stages
+    from photomosaic_exec.deepzoom import S3Sink
+    from photomosaic_exec.manifest import browser_manifest, decode_manifest, encode_manifest, tile_id
+    from photomosaic_exec.streaming import streamable
 except ImportError as e:
-    pm = None
+    pm = distributed = stages = None
+    S3Sink = browser_manifest = decode_manifest = encode_manifest = tile_id = streamable = None
     print("ERROR: Could not import photomosaic_exec.photomosaic. Make sure it is installed and importable.", e)
 
+# Name of the MongoDB database holding the image_pool collection
+POOL_DB_NAME = os.environ.get('MOSAIC_POOL_DB', 'temp')
+# Optional local memory-mapped pool store, used as a read cache of image_pool
+POOL_STORE_DIR = os.environ.get('MOSAIC_POOL_STORE') or None
+# Optional tile pack of pool thumbnails written at ingestion (see photomosaic_exec/tilepack.py)
+POOL_TILE_PACK = os.environ.get('MOSAIC_TILE_PACK') or None
+# Search only images left active by the prune_pool command
+POOL_ACTIVE_ONLY = os.environ.get('MOSAIC_POOL_ACTIVE_ONLY', '') == '1'
+# Match on quantized (uint8 / int16) pool features instead of float64
+POOL_COMPACT_FEATURES = os.environ.get('MOSAIC_COMPACT_FEATURES', '') == '1'
+# Log how well compact rankings agree with float64 ones for each job's tiles
+POOL_VERIFY_COMPACT = os.environ.get('MOSAIC_VERIFY_COMPACT', '') == '1'
+# Search only dominant-colour shards near each tile (see photomosaic_exec/shards.py)
+POOL_SHARDED = os.environ.get('MOSAIC_POOL_SHARDED', '') == '1'
+# Also match flipped / rotated variants of pool images: 1, 2, 4 or 8 per image
+POOL_ORIENTATIONS = int(os.environ.get('MOSAIC_POOL_ORIENTATIONS', '1'))
+# Distance penalty per log(1 + usage) of a pool image across earlier jobs (0 disables it)
+POOL_USAGE_PENALTY = float(os.environ.get('MOSAIC_USAGE_PENALTY', '0'))
+
+# Split matching into this many tile shards, matched by a Celery chord on the match queue
+# (0 or 1: match inside the job's own task). Every match worker must reach MOSAIC_POOL_DB or
+# have MOSAIC_POOL_STORE at the same path, and MEDIA_ROOT/jobs must be shared with the workers
+# running finish_mosaic.
+POOL_MATCH_SHARDS = int(os.environ.get('MOSAIC_MATCH_SHARDS', '0'))
+
+# Publish a quick low-resolution preview while the full render runs (one extra pool pass and upload)
+PREVIEW = os.environ.get('MOSAIC_PREVIEW', '') == '1'
+# Also publish a Deep Zoom pyramid of every result, linked from the results page
+DEEP_ZOOM = os.environ.get('MOSAIC_DEEP_ZOOM', '') == '1'
+
+# Stop jobs after matching and composite them in the browser (the raster renders on download)
+CLIENT_RENDER = os.environ.get('MOSAIC_CLIENT_RENDER', '') == '1'
+
+# Run jobs as the staged chain of tasks (staged_mosaic) instead of the single test_mosaic task
+STAGED_PIPELINE = os.environ.get('MOSAIC_STAGED_PIPELINE', '') == '1'
+
+# Queues of the staged pipeline (see staged_mosaic). Run workers per queue with their own
+# concurrency, e.g. `celery -A mosaic.tasks worker -Q mosaic_cpu -c <cores>` for the CPU-bound
+# stages and `-Q mosaic_io -c 32` for uploads.
+STAGE_QUEUES = {
+    'analyze': os.environ.get('MOSAIC_QUEUE_ANALYZE', 'mosaic_cpu'),
+    'match': os.environ.get('MOSAIC_QUEUE_MATCH', 'mosaic_cpu'),
+    'render': os.environ.get('MOSAIC_QUEUE_RENDER', 'mosaic_cpu'),
+    'encode': os.environ.get('MOSAIC_QUEUE_ENCODE', 'mosaic_cpu'),
+    'upload': os.environ.get('MOSAIC_QUEUE_UPLOAD', 'mosaic_io'),
+}
+
 app = Celery('mosaic_task')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+app.conf.task_routes = dict(('mosaic.tasks.%s_stage' % stage, {'queue': queue}) for stage, queue in STAGE_QUEUES.items())
+app.conf.task_routes.update({'mosaic.tasks.match_shard': {'queue': STAGE_QUEUES['match']},
+                             'mosaic.tasks.merge_matches': {'queue': STAGE_QUEUES['match']}})
+
+def _match_options():
+    """choose_match options shared by the in-task and distributed matchers."""
+    return dict(local_store=POOL_STORE_DIR, active_only=POOL_ACTIVE_ONLY, compact=POOL_COMPACT_FEATURES,
+                sharded=POOL_SHARDED, orientations=POOL_ORIENTATIONS, usage_penalty=POOL_USAGE_PENALTY)
+
+def _match_chord(payloads, options):
+    """One match_shard task per payload, merged by merge_matches."""
+    return chord(group(match_shard.s(payload, options) for payload in payloads), merge_matches.s(options))
+
+def _upload_result(local_path, s3_bucket):
+    """Upload a file under results/ in the bucket and return its public URL."""
+    region = os.environ.get('AWS_REGION', settings.AWS_REGION)
+    s3_key = 'results/' + os.path.basename(local_path)
+    pm.upload_to_s3(
+        local_path=local_path,
+        s3_bucket=s3_bucket,
+        s3_key=s3_key,
+        aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
+        aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+        region=region
+    )
+    return f"https://{s3_bucket}.s3.{region}.amazonaws.com/{s3_key}"
 
 @app.task(bind=True)
-def test_mosaic(self, main_img_path, pool_image_paths, dimensions, shape, fileout, artistic, bending):
+def test_mosaic(self, main_img_path, pool_image_paths, dimensions, shape, fileout, artistic, bending,
+                deep_zoom=False, client_render=False, tile_url=None):
     """
     Asynchronously generates a photomosaic and uploads the result to AWS S3.
-    Returns the S3 URL.
+    Returns the S3 URL, or with deep_zoom=True a dict with the URL and the
+    manifest of a Deep Zoom tile pyramid uploaded alongside it.
+    With client_render=True, stops after matching and returns a dict with the
+    URL of a placement manifest the results page composites in the browser
+    from pool thumbnails at tile_url (a format string with one {} for the
+    tile id, see views.pool_tile); the raster is only rendered on download
+    (see render_from_manifest).
+    With MOSAIC_MATCH_SHARDS > 1 the task is replaced after analysis by the
+    shard chord and finish_mosaic, which returns the result in its place.
     """
     if pm is None:
         self.update_state(state='FAILURE', meta={'exc': 'photomosaic_exec not installed'})
         return 'photomosaic_exec not installed'
     try:
-        # 1. Create PhotoMosaic instance (no tile_images arg)
-        mypm = pm.PhotoMosaic(
-            main_img_path,
-            dimensions,
-            shape
-        )
-
-        # 2. (Optional) If your API allows, load your pool images here:
-        # mypm.load_tiles_from_list(pool_image_paths)
-        # — consult photomosaic_exec docs for the correct method.
+        results_path = os.path.join(settings.MEDIA_ROOT, 'results')
+        os.makedirs(results_path, exist_ok=True)
+        # Arguments of _finish_mosaic, passed on to finish_mosaic when matching is sharded
+        finish = {'main_img_path': main_img_path,
+                  'local_result_path': os.path.join(results_path, fileout or 'mosaic.jpg'),
+                  's3_bucket': os.environ.get('AWS_BUCKET', settings.AWS_STORAGE_BUCKET_NAME),
+                  'bending': bending, 'deep_zoom': deep_zoom, 'client_render': client_render, 'tile_url': tile_url,
+                  'job': self.request.id}
+        depth = 2 if artistic and shape == 'square' else 0
 
-        # 3. Partition
-        if artistic and shape == 'square':
-            mypm.partition(depth=2)
+        # 1-4. Create, partition and analyze the PhotoMosaic. Sharded jobs keep the analysis in a
+        #      stage job directory, so the chord callback can reopen the tiles on any worker
+        if POOL_MATCH_SHARDS > 1:
+            job_dir = os.path.join(settings.MEDIA_ROOT, 'jobs', self.request.id)
+            stages.create_job(job_dir, main_img_path, dimensions, shape, depth=depth, tile_pack=POOL_TILE_PACK,
+                              fade=bending or None)
+            stages.analyze(job_dir)
+            mypm = stages.open_mosaic(job_dir)
         else:
-            mypm.partition()
+            mypm = pm.PhotoMosaic(main_img_path, dimensions, shape, tile_pack=POOL_TILE_PACK)
+            mypm.partition(depth=depth)
+            mypm.analyze()
 
-        # 4. Analyze & build
-        mypm.analyze()
-        mypm.choose_match()
-        mypm.mosaic()
+        # 5. Optional quick preview (mean colour match, 1x factor), published while the full render
+        #    runs; client-rendered jobs finish right after matching and skip it
+        if PREVIEW and not client_render:
+            preview_path = os.path.join(results_path, 'preview_' + os.path.basename(finish['local_result_path']))
+            mypm.preview(POOL_DB_NAME, local_store=POOL_STORE_DIR, active_only=POOL_ACTIVE_ONLY).save(preview_path)
+            self.update_state(state='PROGRESS', meta={'preview': _upload_result(preview_path, finish['s3_bucket'])})
 
-        # 5. Fading
-        if bending:
-            mypm.fading(bending)
+        # 6. Full-quality match. Sharded: this task is replaced by the shard chord, and
+        #    finish_mosaic renders from the merged matches under this task's id
+        if POOL_MATCH_SHARDS > 1:
+            options = dict(_match_options(), db_name=POOL_DB_NAME)
+            payloads = stages.match_payloads(job_dir, POOL_MATCH_SHARDS, sharded=POOL_SHARDED)
+            options['ntiles'] = sum(len(payload['tiles']) for payload in payloads)
+            return self.replace(_match_chord(payloads, options) | finish_mosaic.s(job_dir, finish))
+        mypm.choose_match(POOL_DB_NAME, verify_compact=POOL_VERIFY_COMPACT, **_match_options())
+        return _finish_mosaic(mypm, **finish)
 
-        # 6. Save locally
-        results_path = os.path.join(settings.MEDIA_ROOT, 'results')
-        os.makedirs(results_path, exist_ok=True)
-        local_result_path = os.path.join(results_path, fileout or 'mosaic.jpg')
-        mypm.imsave(local_result_path)
-
-        # 7. Upload to S3
-        s3_bucket = os.environ.get('AWS_BUCKET', settings.AWS_STORAGE_BUCKET_NAME)
-        s3_key    = 'results/' + os.path.basename(local_result_path)
-        pm.upload_to_s3(
-            local_path=local_result_path,
-            s3_bucket=s3_bucket,
-            s3_key=s3_key,
+    except Ignore:
+        raise
+    except Exception as e:
+        self.update_state(state='FAILURE', meta={'exc': str(e)})
+        return str(e)
+
+@app.task(bind=True)
+def finish_mosaic(self, matches, job_dir, finish):
+    """
+    Chord callback of a sharded test_mosaic: attaches the merged
+    [tile, path, orientation] matches to the job's tiles, then records
+    usage, renders and uploads as test_mosaic does. Its result is the
+    test_mosaic result.
+    """
+    try:
+        mypm = stages.open_mosaic(job_dir)
+        mypm.apply_matches(matches)
+        return _finish_mosaic(mypm, **finish)
+    except Exception as e:
+        self.update_state(state='FAILURE', meta={'exc': str(e)})
+        return str(e)
+
+def _finish_mosaic(mypm, main_img_path, local_result_path, s3_bucket, bending, deep_zoom, client_render,
+                   tile_url, job):
+    """Steps after matching, shared by test_mosaic and finish_mosaic. Returns the task result."""
+    # Usage is final once matched: one batched write per job (a retry of this task is not counted twice)
+    mypm.record_usage(POOL_DB_NAME, job=job)
+    if client_render:
+        # The stored manifest keeps server paths for render_from_manifest; the browser gets tile URLs
+        manifest_path = os.path.splitext(local_result_path)[0] + '.manifest.bin'
+        manifest = mypm.placement_manifest(fade=bending or None, source=main_img_path)
+        with open(manifest_path, 'wb') as f:
+            f.write(encode_manifest(manifest, 'binary'))
+        web_manifest_path = os.path.splitext(local_result_path)[0] + '.manifest.json'
+        with open(web_manifest_path, 'wb') as f:
+            f.write(encode_manifest(browser_manifest(manifest, tile_url)))
+        return {'url': None, 'manifest': _upload_result(web_manifest_path, s3_bucket),
+                'manifest_path': manifest_path, 'fileout': os.path.basename(local_result_path)}
+    # 7. Render and save locally, then upload to S3. PNG / JPEG / TIFF are encoded strip by
+    #    strip as they render; other formats need the whole canvas (parallel encoder where available).
+    #    The optional Deep Zoom pyramid is cut from the same render and written straight to S3.
+    sink = name = None
+    if deep_zoom:
+        sink = S3Sink(
+            s3_bucket,
+            prefix='results',
+            region=os.environ.get('AWS_REGION', settings.AWS_REGION),
             aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-            region=os.environ.get('AWS_REGION', settings.AWS_REGION)
+            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY')
         )
+        name = os.path.splitext(os.path.basename(local_result_path))[0]
+    if streamable(local_result_path):
+        manifest = mypm.stream_mosaic(local_result_path, fade=bending or None, dz_sink=sink, dz_name=name)
+    else:
+        mypm.mosaic(fade=bending or None)
+        ext = os.path.splitext(local_result_path)[1].lstrip('.').lower()
+        if ext == 'webp':
+            report = mypm.export(local_result_path, formats=(ext,))
+            (encoded,) = report.values()
+            if 'error' in encoded:
+                raise RuntimeError(encoded['error'])
+            local_result_path = encoded['path']
+        else:
+            mypm.imsave(local_result_path)
+        manifest = mypm.deep_zoom(sink, name, image=mypm.mos) if deep_zoom else None
+    s3_url = _upload_result(local_result_path, s3_bucket)
+    if deep_zoom:
+        return {'url': s3_url, 'deep_zoom': manifest}
 
-        return f"https://{s3_bucket}.s3.{os.environ.get('AWS_REGION', settings.AWS_REGION)}.amazonaws.com/{s3_key}"
+    return s3_url
 
+@app.task(bind=True)
+def render_from_manifest(self, manifest_path, fileout):
+    """
+    Lazily renders the full raster for a client-rendered job from its
+    placement manifest, uploads it to AWS S3 and returns the S3 URL.
+    """
+    if pm is None:
+        self.update_state(state='FAILURE', meta={'exc': 'photomosaic_exec not installed'})
+        return 'photomosaic_exec not installed'
+    try:
+        with open(manifest_path, 'rb') as f:
+            manifest = decode_manifest(f.read())
+        local_result_path = os.path.join(os.path.dirname(manifest_path), fileout)
+        pm.render_manifest(manifest, tile_pack=POOL_TILE_PACK).save(local_result_path)
+        return _upload_result(local_result_path, os.environ.get('AWS_BUCKET', settings.AWS_STORAGE_BUCKET_NAME))
     except Exception as e:
         self.update_state(state='FAILURE', meta={'exc': str(e)})
         return str(e)
+
+def staged_mosaic(main_img_path, dimensions, shape, fileout, artistic, bending):
+    """
+    Staged alternative to test_mosaic: the job runs as a chain of
+    analyze -> match -> render -> encode -> upload tasks, each routed to its
+    queue (STAGE_QUEUES) and exchanging artifacts through a job directory
+    under MEDIA_ROOT/jobs (see photomosaic_exec/stages.py). Returns the
+    AsyncResult of the chain's last task; its result is the S3 URL.
+    Unlike test_mosaic, stage tasks raise on error so the chain stops at the
+    failed stage (see stage_ids).
+    """
+    if stages is None:
+        raise RuntimeError('photomosaic_exec not installed')
+    job = {'id': uuid.uuid4().hex, 'fileout': fileout or 'mosaic.jpg'}
+    job['dir'] = os.path.join(settings.MEDIA_ROOT, 'jobs', job['id'])
+    stages.create_job(job['dir'], main_img_path, dimensions, shape, depth=2 if artistic and shape == 'square' else 0,
+                      tile_pack=POOL_TILE_PACK, fade=bending or None)
+    return run_stages(job)
+
+def run_stages(job):
+    """
+    Queue the stage chain for a job dict (id, dir, fileout). Stages whose
+    artifacts already exist return at once, so re-running a failed job only
+    redoes the stages after the failure.
+    """
+    return chain(analyze_stage.s(job), match_stage.s(), render_stage.s(), encode_stage.s(),
+                 upload_stage.s()).apply_async()
+
+def stage_ids(result):
+    """Task ids of a queued chain, first stage first (the chain's result is the last)."""
+    ids = []
+    while result is not None:
+        ids.insert(0, result.id)
+        result = result.parent
+    return ids
+
+@app.task
+def analyze_stage(job):
+    stages.analyze(job['dir'])
+    return job
+
+@app.task(bind=True)
+def match_stage(self, job):
+    if POOL_MATCH_SHARDS > 1 and not os.path.exists(os.path.join(job['dir'], stages.PLAN_FILE)):
+        # Replaced by the shard chord; plan_stage then hands the job on to the rest of the chain
+        options = dict(_match_options(), db_name=POOL_DB_NAME)
+        payloads = stages.match_payloads(job['dir'], POOL_MATCH_SHARDS, sharded=POOL_SHARDED)
+        options['ntiles'] = sum(len(payload['tiles']) for payload in payloads)
+        return self.replace(_match_chord(payloads, options) | plan_stage.s(job))
+    stages.match(job['dir'], POOL_DB_NAME, job=job['id'], verify_compact=POOL_VERIFY_COMPACT, **_match_options())
+    return job
+
+@app.task
+def match_shard(payload, options):
+    """Best candidates for one shard of tiles (see photomosaic_exec/distributed.py)."""
+    return distributed.match_shard(payload, **options)
+
+@app.task
+def merge_matches(results, options):
+    """Chord callback: merge shard candidates into [tile, path, orientation] matches."""
+    return distributed.merge_shards(results, **options)
+
+@app.task
+def plan_stage(matches, job):
+    stages.save_plan(job['dir'], matches, POOL_DB_NAME, job=job['id'])
+    return job
+
+@app.task
+def render_stage(job):
+    stages.render(job['dir'])
+    return job
+
+@app.task
+def encode_stage(job):
+    job['path'] = stages.encode(job['dir'], job['fileout'])
+    return job
+
+@app.task
+def upload_stage(job):
+    return _upload_result(job['path'], os.environ.get('AWS_BUCKET', settings.AWS_STORAGE_BUCKET_NAME))
@@ -6,6 +6,9 @@ PURPOSE:
 
 DETAILS:
     - This sample test ensures your test framework is set up and working.
+    - Distributed matching is checked against an in-memory pool, and a sharded test_mosaic job
+      end to end on a memory:// broker with an in-process worker.
+    - Rendering paths are compared pixel for pixel with the serial mosaic() render.
     - Add more tests to cover your views, forms, models, and utility functions.
 
 HOW TO RUN:
@@ -17,9 +20,1323 @@ MODERNIZATION NOTES:
 
 """
 
-from django.test import TestCase
+import importlib.util
+import multiprocessing
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import time
+from unittest import mock, skipUnless
+
+import numpy as np
+from PIL import Image
+from django.test import TestCase, override_settings
+
+from photomosaic_exec import distributed
+from photomosaic_exec.deepzoom import DeepZoomWriter, DirectorySink
+from photomosaic_exec.coreset import coverage_report, nearest_distances, select_coreset
+from photomosaic_exec.dedupe import PerceptualIndex, dhash, hamming
+from photomosaic_exec.export import encode_jpeg_parallel, export
+from photomosaic_exec.features import FEATURE_DTYPE, decode_features, decode_pool, decode_pool_into, encode_features
+from photomosaic_exec.ingest import IngestPipeline
+from photomosaic_exec.feature_store import LocalFeatureStore
+from photomosaic_exec.manifest import LEGACY_HEADER, browser_manifest, decode_manifest, encode_manifest, tile_id
+from photomosaic_exec.orientations import ORIENTATION_TRANSPOSE, orient_features, orient_image, orientation_set, query_variants
+from photomosaic_exec import photomosaic as pm
+from photomosaic_exec import pool_cache
+from photomosaic_exec.pool_cache import get_snapshot, sync_local_store
+from photomosaic_exec import pool_store
+from photomosaic_exec.pool_store import MemoryPoolStore, MongoPoolStore, SQLitePoolStore, resolve_store
+from photomosaic_exec.pool_cache import PoolSnapshot
+from photomosaic_exec.prefetch import TilePrefetcher, decode_tile
+from photomosaic_exec import scanner
+from photomosaic_exec.quantize import CompactPool, verify_ranking
+from photomosaic_exec.scanner import IncrementalScanner, scan_tree
+from photomosaic_exec import stages
+from photomosaic_exec.shards import ShardIndex, shard_field, shard_of
+from photomosaic_exec.streaming import reband, streamable
+from photomosaic_exec.tilepack import TILE_SIZE, TilePack
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
         """Tests that 1 + 1 always equals 2."""
-        self.assertEqual(1 + 1, 2)
\ No newline at end of file
+        self.assertEqual(1 + 1, 2)
+
+def _write_pool(directory, count, seed=0):
+    """count noisy single-colour JPEGs; returns their paths."""
+    rng = np.random.RandomState(seed)
+    paths = []
+    for i in range(count):
+        pixels = rng.rand(90, 120, 3) * 60 + rng.randint(0, 190, 3)
+        path = os.path.join(directory, 'pool%03d.jpg' % i)
+        Image.fromarray(pixels.astype('uint8')).save(path)
+        paths.append(path)
+    return paths
+
+def _write_source(path, size=(400, 300)):
+    y, x = np.mgrid[0:size[1], 0:size[0]]
+    pixels = np.stack([x * 255 // size[0], y * 255 // size[1], (x + y) % 255], -1)
+    Image.fromarray(pixels.astype('uint8')).save(path)
+    return path
+
+def _matched_mosaic(directory, dimensions=(20, 10), count=30, **kwargs):
+    """A partitioned, analyzed PhotoMosaic of a generated source, matched against count pool images."""
+    paths = _write_pool(directory, count)
+    store = MemoryPoolStore([pm.analyze_pool_image(path) for path in paths])
+    mypm = pm.PhotoMosaic(_write_source(os.path.join(directory, 'source.jpg')), dimensions, **kwargs)
+    mypm.partition()
+    mypm.analyze()
+    mypm.choose_match(store)
+    return mypm
+
+class DistributedMatchTest(TestCase):
+    """Sharded matching (photomosaic_exec/distributed.py) against an in-memory pool."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.paths = _write_pool(self.tmp, 30)
+        self.store = MemoryPoolStore([pm.analyze_pool_image(path) for path in self.paths])
+        self.source = _write_source(os.path.join(self.tmp, 'source.jpg'))
+
+    def match(self, **kwargs):
+        mypm = pm.PhotoMosaic(self.source, (20, 10))
+        mypm.partition()
+        mypm.analyze()
+        mypm.choose_match(self.store, distribute=distributed.local_distribute, match_shards=3, **kwargs)
+        return mypm
+
+    def test_tombstoned_snapshot(self):
+        """Images removed after the snapshot was loaded are skipped, not mis-indexed."""
+        self.match()
+        removed = self.paths[-4:]
+        self.store.remove_paths(removed)
+        self.assertEqual(get_snapshot(self.store).dead, len(removed))
+        for options in ({}, {'orientations': 2}, {'sharded': True}):
+            mypm = self.match(**options)
+            matches = [tile.match for tile in mypm.tiles]
+            self.assertTrue(all(matches))
+            self.assertFalse(set(removed) & set(matches))
+
+class ShardedJobTest(TestCase):
+    """
+    test_mosaic with MOSAIC_MATCH_SHARDS > 1 on a memory:// broker and a
+    real (threaded) worker: the task is replaced by the shard chord, and
+    its result is the render callback's, even with a single worker slot.
+    """
+    def setUp(self):
+        from celery.contrib.testing.worker import start_worker
+        from mosaic import tasks
+
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        store_dir = os.path.join(self.tmp, 'store')
+        paths = _write_pool(self.tmp, 30)
+        sync_local_store(MemoryPoolStore([pm.analyze_pool_image(path) for path in paths]), store_dir)
+        self.source = _write_source(os.path.join(self.tmp, 'source.jpg'))
+        tasks.app.conf.update(broker_url='memory://', result_backend='cache+memory://',
+                              task_always_eager=False)
+        for name, value in (('POOL_DB_NAME', None), ('POOL_STORE_DIR', store_dir), ('POOL_MATCH_SHARDS', 3),
+                            ('_upload_result', lambda path, bucket: 'https://example/' + os.path.basename(path))):
+            patcher = mock.patch.object(tasks, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        media = override_settings(MEDIA_ROOT=self.tmp)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.tasks = tasks
+        self.worker = start_worker(tasks.app, concurrency=1, pool='threads', perform_ping_check=False,
+                                   queues=['celery'] + sorted(set(tasks.STAGE_QUEUES.values())))
+        self.worker.__enter__()
+        self.addCleanup(self.worker.__exit__, None, None, None)
+
+    def test_sharded_job(self):
+        result = self.tasks.test_mosaic.delay(self.source, [], (10, 8), None, 'sharded.png', False, None)
+        self.assertEqual(result.get(timeout=120), 'https://example/sharded.png')
+        with Image.open(os.path.join(self.tmp, 'results', 'sharded.png')) as im:
+            self.assertEqual(im.size, (1600, 1280))
+class PrefetchTest(TestCase):
+    """Rendering with TilePrefetcher (photomosaic_exec/prefetch.py) against decoding tile by tile."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.mypm = _matched_mosaic(self.tmp)
+
+    def test_prefetch_matches_serial(self):
+        self.mypm.mosaic(factor=2, prefetch=False)
+        serial = self.mypm.mos
+        self.mypm.mosaic(factor=2, prefetch=True, prefetch_workers=4, max_pending=2)
+        self.assertEqual(self.mypm.mos.tobytes(), serial.tobytes())
+
+    def test_groups_by_match(self):
+        """Every matched tile comes back exactly once, with the other tiles sharing its image."""
+        matched = [tile for tile in self.mypm.tiles if tile.match is not None]
+        seen = []
+        prefetcher = TilePrefetcher(matched, workers=2, max_pending=1)
+        for img, tiles in prefetcher:
+            self.assertIsNotNone(img)
+            self.assertEqual(len(set((tile.match, tile.match_size) for tile in tiles)), 1)
+            seen.extend(tiles)
+        self.assertEqual(len(set(map(id, seen))), len(matched))
+        self.assertEqual(len(prefetcher), len(set((tile.match, tile.match_size) for tile in matched)))
+
+class StreamingTest(TestCase):
+    """stream_mosaic (photomosaic_exec/streaming.py) writes the same pixels as mosaic()."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.mypm = _matched_mosaic(self.tmp)
+        self.mypm.mosaic(factor=2)
+        self.expected = self.mypm.mos.tobytes()
+
+    def assertStreamed(self, name, **kwargs):
+        path = os.path.join(self.tmp, name)
+        self.mypm.stream_mosaic(path, factor=2, workers=3, **kwargs)
+        with Image.open(path) as im:
+            self.assertEqual(im.size, self.mypm.mos.size)
+            self.assertEqual(im.convert('RGB').tobytes(), self.expected)
+
+    def test_png(self):
+        self.assertStreamed('strips.png')
+
+    def test_tiff(self):
+        self.assertStreamed('strips.tif', tile=64)
+
+    def test_memmap_canvas(self):
+        self.assertStreamed('memmap.png', canvas='memmap', canvas_dir=self.tmp)
+
+    def test_reband(self):
+        strips = [np.full((height, 4, 3), i, dtype=np.uint8) for i, height in enumerate((5, 1, 9, 2))]
+        bands = list(reband(strips, 4))
+        self.assertEqual([band.shape[0] for band in bands], [4, 4, 4, 4, 1])
+        self.assertTrue((np.concatenate(bands) == np.concatenate(strips)).all())
+
+    def test_unstreamable_format(self):
+        self.assertFalse(streamable('mosaic.webp'))
+        with self.assertRaises(ValueError):
+            self.mypm.stream_mosaic(os.path.join(self.tmp, 'mosaic.webp'), factor=2)
+
+class FusedFadeTest(TestCase):
+    """Fading fused into the strip render gives exactly what fading() gives over the full canvas."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.mypm = _matched_mosaic(self.tmp)
+        self.mypm.mosaic(factor=2)
+        self.mypm.fading(0.7)
+        self.expected = self.mypm.mos.tobytes()
+
+    def test_mosaic(self):
+        self.mypm.mosaic(factor=2, fade=0.7, prefetch_workers=3)
+        self.assertEqual(self.mypm.mos.tobytes(), self.expected)
+
+    def test_stream_mosaic(self):
+        path = os.path.join(self.tmp, 'faded.png')
+        self.mypm.stream_mosaic(path, factor=2, fade=0.7, canvas='memmap', workers=2)
+        with Image.open(path) as im:
+            self.assertEqual(im.convert('RGB').tobytes(), self.expected)
+
+class DeepZoomTest(TestCase):
+    """DeepZoomWriter (photomosaic_exec/deepzoom.py) level sizes and tile layout."""
+    size = (701, 389)
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.source = Image.open(_write_source(os.path.join(self.tmp, 'source.png'), self.size))
+        self.addCleanup(self.source.close)
+
+    def pyramid(self, strip_height=37):
+        writer = DeepZoomWriter(DirectorySink(self.tmp), 'dz', self.size, tile_size=64, overlap=1, format='png',
+                                workers=3)
+        for top in range(0, self.size[1], strip_height):
+            writer.feed(self.source.crop((0, top, self.size[0], min(self.size[1], top + strip_height))))
+        return writer.close()
+
+    def test_level_sizes(self):
+        manifest = self.pyramid()
+        self.assertEqual(manifest['maxLevel'], 10)
+        tiles = 0
+        for level in range(manifest['maxLevel'] + 1):
+            scale = 2 ** (manifest['maxLevel'] - level)
+            width, height = -(-self.size[0] // scale), -(-self.size[1] // scale)
+            cols, rows = -(-width // 64), -(-height // 64)
+            files = os.listdir(os.path.join(self.tmp, 'dz_files', str(level)))
+            self.assertEqual(len(files), cols * rows)
+            tiles += len(files)
+            for col, row in ((0, 0), (cols - 1, rows - 1)):
+                with Image.open(os.path.join(self.tmp, 'dz_files', str(level), '%d_%d.png' % (col, row))) as tile:
+                    self.assertEqual(tile.size, (min(width, (col + 1) * 64 + 1) - max(0, col * 64 - 1),
+                                                 min(height, (row + 1) * 64 + 1) - max(0, row * 64 - 1)))
+        self.assertEqual(manifest['tileCount'], tiles)
+        with open(os.path.join(self.tmp, 'dz.dzi')) as f:
+            self.assertIn('<Size Width="701" Height="389"/>', f.read())
+
+    def test_full_resolution_tiles(self):
+        """Top-level tiles are lossless crops of the fed image, overlap included."""
+        self.pyramid()
+        with Image.open(os.path.join(self.tmp, 'dz_files', '10', '2_3.png')) as tile:
+            expected = self.source.convert('RGB').crop((127, 191, 192 + 1, 256 + 1))
+            self.assertEqual(tile.convert('RGB').tobytes(), expected.tobytes())
+
+    def test_strip_checks(self):
+        writer = DeepZoomWriter(DirectorySink(self.tmp), 'dz', self.size)
+        with self.assertRaises(ValueError):
+            writer.feed(self.source.crop((0, 0, 700, 10)))
+        writer.feed(self.source.crop((0, 0, self.size[0], 10)))
+        with self.assertRaises(ValueError):
+            writer.close()
+
+class PreviewTest(TestCase):
+    """PhotoMosaic.preview: nearest mean-colour thumbnails pasted at 1x."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        paths = _write_pool(self.tmp, 30)
+        self.store = MemoryPoolStore([pm.analyze_pool_image(path) for path in paths])
+        self.mypm = pm.PhotoMosaic(_write_source(os.path.join(self.tmp, 'source.jpg')), (20, 10))
+        self.mypm.partition()
+        self.mypm.analyze()
+
+    def test_preview(self):
+        preview = self.mypm.preview(self.store, workers=2)
+        self.assertEqual(preview.size, self.mypm.im.size)
+        self.assertIsNone(getattr(self.mypm, 'mos', None))
+        features, paths = self.mypm.load_pool(self.store)
+        pool_means = features.mean(axis=1)
+        for tile in self.mypm.tiles[::17]:
+            nearest = ((pool_means - np.mean(tile.rgb, axis=0)) ** 2).sum(axis=1).argmin()
+            thumb = self.mypm.crop_to_fit(decode_tile(paths[nearest], tile.ancestor_size), tile.size)
+            x, y = tile.x * tile.size[0], tile.y * tile.size[1]
+            region = preview.crop((x, y, x + tile.size[0], y + tile.size[1]))
+            self.assertEqual(region.tobytes(), thumb.tobytes())
+
+    def test_empty_pool(self):
+        preview = self.mypm.preview(MemoryPoolStore([]), background=(1, 2, 3))
+        self.assertEqual(preview.getcolors(), [(preview.size[0] * preview.size[1], (1, 2, 3))])
+
+def _legacy_manifest(magic, manifest, fields):
+    """manifest encoded as a pre-version-3 binary blob (magic b'MZM1' or b'MZM2', no grid)."""
+    strings = [path.encode('utf-8') for path in manifest["pool"]] + [(manifest["source"] or '').encode('utf-8')]
+    parts = [LEGACY_HEADER.pack(magic, manifest["width"], manifest["height"], manifest["factor"],
+                                len(manifest["pool"]), len(manifest["placements"]), manifest["fade"] or 0.0)]
+    for blob in strings:
+        parts += [struct.pack('<I', len(blob)), blob]
+    parts.append(np.array([p[:fields] for p in manifest["placements"]], dtype='<i4').tobytes())
+    return b''.join(parts)
+
+class ManifestTest(TestCase):
+    """Placement manifests (photomosaic_exec/manifest.py): encodings and rendering."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.mypm = _matched_mosaic(self.tmp)
+        self.manifest = self.mypm.placement_manifest(factor=2, fade=0.5, source='/data/source.jpg')
+
+    def test_round_trip(self):
+        for fmt in ('json', 'binary'):
+            data = encode_manifest(self.manifest, fmt)
+            self.assertEqual(decode_manifest(data), self.manifest, fmt)
+        self.assertEqual(encode_manifest(self.manifest, 'binary')[:4], b'MZM3')
+        self.assertEqual(decode_manifest(encode_manifest(self.manifest).decode('utf-8')), self.manifest)
+        with self.assertRaises(ValueError):
+            encode_manifest(self.manifest, 'xml')
+
+    def test_legacy_binary(self):
+        for magic, version, fields in ((b'MZM1', 1, 5), (b'MZM2', 2, 6)):
+            decoded = decode_manifest(_legacy_manifest(magic, self.manifest, fields))
+            self.assertEqual(decoded["version"], version)
+            self.assertIsNone(decoded["grid"])
+            self.assertEqual(decoded["placements"], [p[:fields] for p in self.manifest["placements"]])
+            self.assertEqual(dict(decoded, version=3, grid=self.manifest["grid"], placements=None),
+                             dict(self.manifest, placements=None))
+
+    def test_render_matches_mosaic(self):
+        # Manifests carry no decode size: with pool images smaller than every
+        # box both renders paste the undecimated image, so pixels must agree.
+        for path in set(tile.match for tile in self.mypm.tiles):
+            with Image.open(path) as im:
+                small = im.resize((40, 30), Image.BILINEAR)
+            small.save(path)
+        self.mypm.mosaic(factor=2)
+        manifest = dict(self.manifest, fade=None)
+        self.assertEqual(pm.render_manifest(manifest, workers=2).tobytes(), self.mypm.mos.tobytes())
+        legacy = decode_manifest(_legacy_manifest(b'MZM1', manifest, 5))
+        self.assertEqual(pm.render_manifest(legacy).tobytes(), self.mypm.mos.tobytes())
+
+    def test_browser_manifest(self):
+        published = browser_manifest(self.manifest, '/pool/tile/{}.jpg')
+        self.assertEqual(published["pool"], ['/pool/tile/%s.jpg' % tile_id(path) for path in self.manifest["pool"]])
+        self.assertFalse(set(published["pool"]) & set(self.manifest["pool"]))
+
+class ExportTest(TestCase):
+    """Parallel multi-format export (photomosaic_exec/export.py)."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        with Image.open(_write_source(os.path.join(self.tmp, 'source.png'), (421, 333))) as im:
+            self.im = im.convert('RGB')
+
+    def test_stitched_jpeg(self):
+        """Strips joined with restart markers decode to the same pixels as a one-shot save."""
+        stitched, single = os.path.join(self.tmp, 'stitched.jpg'), os.path.join(self.tmp, 'single.jpg')
+        encode_jpeg_parallel(self.im, stitched, quality=90, workers=4, rows_per_strip=3)
+        self.im.save(single, 'JPEG', quality=90, subsampling=2)
+        with Image.open(stitched) as a, Image.open(single) as b:
+            self.assertEqual(a.size, self.im.size)
+            self.assertEqual(a.tobytes(), b.tobytes())
+
+    def test_formats(self):
+        report = export(self.im, os.path.join(self.tmp, 'out.png'), ('jpg', 'webp'), web_size=100, workers=2)
+        self.assertEqual(sorted(report), ['jpg', 'web', 'webp'])
+        for name, entry in report.items():
+            self.assertNotIn('error', entry, name)
+            self.assertEqual(entry['bytes'], os.path.getsize(entry['path']))
+        with Image.open(report['web']['path']) as web:
+            self.assertEqual(max(web.size), 100)
+
+    @skipUnless(importlib.util.find_spec('tifffile'), 'tifffile is not installed')
+    def test_tiff(self):
+        report = export(self.im, os.path.join(self.tmp, 'out.png'), ('tif',), workers=2)
+        with Image.open(report['tiff']['path']) as tiff:
+            self.assertEqual(tiff.convert('RGB').tobytes(), self.im.tobytes())
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            export(self.im, os.path.join(self.tmp, 'out.jpg'), ('bmp',))
+        report = export(Image.new('RGB', (16384, 1)), os.path.join(self.tmp, 'wide.jpg'), ('webp',))
+        self.assertIn('error', report['webp'])
+
+def _mongomock_store(test, db_name='pool'):
+    """MongoPoolStore on a mongomock client, for as long as test runs."""
+    import mongomock
+
+    client = mongomock.MongoClient()
+    patcher = mock.patch.object(pool_store, 'get_mongo_client', lambda uri=None: client)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    return MongoPoolStore(db_name)
+
+@skipUnless(importlib.util.find_spec('mongomock'), 'mongomock is not installed')
+class ImagePoolTest(TestCase):
+    """Batched ImagePool ingestion into Mongo with unique path and content-hash indexes."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.pool_dir = os.path.join(self.tmp, 'pool')
+        os.mkdir(self.pool_dir)
+        self.paths = _write_pool(self.pool_dir, 12)
+        self.store = _mongomock_store(self)
+
+    def ingest(self):
+        return pm.ImagePool(self.pool_dir, store=self.store, batch_size=5, workers=2).pool()
+
+    def test_batches(self):
+        self.assertEqual(self.ingest()['inserted'], 12)
+        self.assertEqual(sorted(self.store.known_paths(self.paths)), sorted(self.paths))
+        shutil.copy(self.paths[0], os.path.join(self.pool_dir, 'copy.jpg'))
+        stats = self.ingest()
+        self.assertEqual((stats['known'], stats['inserted'], stats['duplicates']), (12, 0, 1))
+        self.assertEqual(self.store.count(), 12)
+
+    def test_unique_indexes(self):
+        self.store.ensure_indexes()
+        docs = [pm.analyze_pool_image(path) for path in self.paths[:3]]
+        self.assertEqual(self.store.add_batch([dict(doc) for doc in docs[:2]]), 2)
+        again = [dict(docs[0]), dict(docs[1], imgsrc='/elsewhere/copy.jpg'), dict(docs[2])]
+        self.assertEqual(self.store.add_batch(again), 1)
+        self.assertEqual(self.store.count(), 3)
+        legacy = [dict(doc, imgsrc='/legacy/%d.jpg' % i) for i, doc in enumerate(docs)]
+        for doc in legacy:
+            del doc['hash']
+        self.assertEqual(self.store.add_batch(legacy), 3)
+
+class FeatureEncodingTest(TestCase):
+    """Raw float32 pool features (photomosaic_exec/features.py), and legacy pickled float64 ones."""
+    def setUp(self):
+        self.values = np.random.RandomState(0).rand(5, 16, 3) * 255
+        self.docs = [{"imgsrc": "new%d" % i, "featureSchema": 1, "avgRGB": encode_features(v)}
+                     for i, v in enumerate(self.values[:3])]
+        self.docs += [{"imgsrc": "legacy%d" % i, "avgRGB": pickle.dumps(v)} for i, v in enumerate(self.values[3:])]
+
+    def test_round_trip(self):
+        self.assertEqual(len(self.docs[0]["avgRGB"]), 16 * 3 * 4)
+        for doc, expected in zip(self.docs, self.values):
+            decoded = decode_features(doc, "avgRGB")
+            self.assertEqual(decoded.dtype, FEATURE_DTYPE)
+            np.testing.assert_array_equal(decoded, expected.astype(FEATURE_DTYPE))
+
+    def test_decode_pool(self):
+        matrix, paths = decode_pool(iter(self.docs), "avgRGB", count=2)
+        self.assertEqual(matrix.dtype, FEATURE_DTYPE)
+        self.assertEqual(paths, [doc["imgsrc"] for doc in self.docs])
+        np.testing.assert_array_equal(matrix, self.values.astype(FEATURE_DTYPE))
+
+    def test_decode_pool_into(self):
+        out = np.zeros((3, 16, 3), dtype=FEATURE_DTYPE)
+        paths, (extra, extra_paths) = decode_pool_into(self.docs, "avgRGB", out)
+        self.assertEqual(paths + extra_paths, [doc["imgsrc"] for doc in self.docs])
+        np.testing.assert_array_equal(np.concatenate([out, extra]), self.values.astype(FEATURE_DTYPE))
+        self.assertEqual(decode_pool_into(self.docs[:2], "avgRGB", out), (["new0", "new1"], None))
+
+class LocalFeatureStoreTest(TestCase):
+    """Versioned, memory-mapped LocalFeatureStore (photomosaic_exec/feature_store.py)."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.store = LocalFeatureStore(os.path.join(self.tmp, 'store'))
+        rng = np.random.RandomState(0)
+        self.versions = [(rng.rand(n, 16, 3) * 255, rng.rand(n, 16, 3) * 100,
+                          ['/pool/%d/%d-é.jpg' % (n, i) for i in range(n)]) for n in (4, 6, 3)]
+
+    def assertSnapshot(self, snapshot, version):
+        rgb, lab, paths = self.versions[version - 1]
+        self.assertEqual(snapshot.version, version)
+        self.assertEqual(list(snapshot.paths), paths)
+        np.testing.assert_array_equal(snapshot.features('rgb'), rgb.astype('<f4'))
+        np.testing.assert_array_equal(snapshot.features('lab'), lab.astype('<f4'))
+        np.testing.assert_array_equal(snapshot.shards('lab'), shard_of(lab, 'lab'))
+
+    def test_version_switch(self):
+        self.assertIsNone(self.store.version())
+        self.assertEqual(self.store.write(*self.versions[0]), 1)
+        first = self.store.load()
+        self.assertEqual(self.store.write(*self.versions[1], active=[True, False] * 3), 2)
+        self.assertSnapshot(first, 1)
+        second = self.store.load()
+        self.assertSnapshot(second, 2)
+        self.assertEqual(list(second.active), [True, False] * 3)
+        self.store.write(*self.versions[2])
+        self.assertEqual(sorted(name for name in os.listdir(self.store.directory) if name.startswith('v')),
+                         ['v2', 'v3'])
+        self.assertSnapshot(self.store.load(), 3)
+
+    def test_rollback(self):
+        """A write that fails half way leaves the current version in place; an older one can be rewritten."""
+        self.store.write(*self.versions[0])
+        self.store.write(*self.versions[1])
+        with mock.patch('photomosaic_exec.feature_store.json.dump', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                self.store.write(*self.versions[2])
+        self.assertSnapshot(self.store.load(), 2)
+        self.store.write(*self.versions[0], version=1)
+        self.assertEqual(self.store.version(), 1)
+        self.assertSnapshot(self.store.load(), 1)
+
+    def test_empty(self):
+        self.store.write(np.empty((0, 16, 3)), np.empty((0, 16, 3)), [])
+        snapshot = self.store.load()
+        self.assertEqual((len(snapshot), list(snapshot.paths)), (0, []))
+
+def _pool_docs(count, seed=0, prefix='/pool/'):
+    """count synthetic image_pool documents with random features (no image files behind them)."""
+    rng = np.random.RandomState(seed)
+    docs = []
+    for i in range(count):
+        rgb, lab = rng.rand(16, 3) * 255, rng.rand(16, 3) * 100
+        docs.append({"imgsrc": '%s%d-%d.jpg' % (prefix, seed, i), "hash": '%d-%d' % (seed, i),
+                     "avgRGB": encode_features(rgb), "avgLab": encode_features(lab), "featureSchema": 1,
+                     "shardRGB": int(shard_of(rgb, 'rgb')), "shardLab": int(shard_of(lab, 'lab')), "usage": 0})
+    return docs
+
+class PoolStoreContract(object):
+    """Behaviour every PoolStore (photomosaic_exec/pool_store.py) shares; mixed into one TestCase per store."""
+    def make_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.store = self.make_store()
+        self.addCleanup(self.store.close)
+        if hasattr(self.store, 'ensure_indexes'):
+            self.store.ensure_indexes()
+        self.docs = _pool_docs(6)
+        self.paths = [doc["imgsrc"] for doc in self.docs]
+        self.assertEqual(self.store.add_batch([dict(doc) for doc in self.docs]), 6)
+
+    def test_add_batch(self):
+        copy = dict(self.docs[0], imgsrc='/pool/copy.jpg')
+        self.assertEqual(self.store.add_batch([dict(self.docs[1]), copy] + [dict(d) for d in _pool_docs(2, 1)]), 2)
+        self.assertEqual(self.store.count(), 8)
+        self.assertEqual(self.store.known_paths(self.paths[:2] + ['/pool/copy.jpg']), set(self.paths[:2]))
+        self.assertEqual(self.store.known_hashes(['0-3', 'nope']), {'0-3'})
+
+    def test_features(self):
+        for color_space, field in (('rgb', 'avgRGB'), ('lab', 'avgLab')):
+            matrix, paths, shards = self.store.features(color_space, shards=True)
+            self.assertEqual(paths, self.paths)
+            np.testing.assert_array_equal(matrix, [decode_features(doc, field) for doc in self.docs])
+            np.testing.assert_array_equal(shards, shard_of(matrix, color_space))
+        matrix, paths = self.store.features_for(self.paths[4:] + ['/pool/unknown.jpg'], 'lab')
+        self.assertEqual(sorted(paths), self.paths[4:])
+        rows = dict(zip(paths, matrix))
+        for doc in self.docs[4:]:
+            np.testing.assert_array_equal(rows[doc["imgsrc"]], decode_features(doc, 'avgLab'))
+
+    def test_change_log(self):
+        self.assertEqual(self.store.remove_paths(['/pool/unknown.jpg']), 0)
+        start = self.store.version()
+        self.assertEqual(self.store.remove_paths(self.paths[:2]), 2)
+        added = _pool_docs(1, 2)
+        self.store.add_batch(added)
+        self.assertEqual(self.store.changes_since(start, self.store.version()),
+                         [('remove', self.paths[:2]), ('add', [added[0]["imgsrc"]])])
+        self.assertEqual(self.store.features()[1], self.paths[2:] + [added[0]["imgsrc"]])
+        self.store.set_inactive([])
+        self.assertIsNone(self.store.changes_since(start, self.store.version()))
+
+    def test_active_only(self):
+        version = self.store.version()
+        self.store.set_inactive(self.paths[:2])
+        self.assertGreater(self.store.version(), version)
+        self.assertEqual(self.store.inactive_paths(), set(self.paths[:2]))
+        self.assertEqual(self.store.features(active_only=True)[1], self.paths[2:])
+        self.store.set_inactive(self.paths[5:])
+        self.assertEqual(self.store.features(active_only=True)[1], self.paths[:5])
+        self.assertEqual(self.store.features()[1], self.paths)
+
+    def test_usage(self):
+        counts = {self.paths[0]: 3, self.paths[1]: 1}
+        self.assertTrue(self.store.update_usage(counts, 'job-1'))
+        self.assertFalse(self.store.update_usage(counts, 'job-1'))
+        self.assertTrue(self.store.update_usage({self.paths[0]: 2}))
+        self.assertEqual(self.store.usage(), {self.paths[0]: 5, self.paths[1]: 1})
+        self.assertEqual(self.store.job_usage('job-1'), counts)
+        self.assertEqual(self.store.job_usage('job-2'), {})
+        self.store.reset_usage()
+        self.assertEqual(self.store.usage(), {})
+        self.assertEqual(self.store.job_usage('job-1'), counts)
+
+class MemoryPoolStoreTest(PoolStoreContract, TestCase):
+    def make_store(self):
+        return MemoryPoolStore()
+
+class SQLitePoolStoreTest(PoolStoreContract, TestCase):
+    def make_store(self):
+        return SQLitePoolStore(os.path.join(self.tmp, 'pool.db'))
+
+    def test_pickled_store_reconnects(self):
+        clone = pickle.loads(pickle.dumps(self.store))
+        self.addCleanup(clone.close)
+        self.assertEqual(clone.known_paths(self.paths), set(self.paths))
+        self.assertEqual(clone.cache_key(), self.store.cache_key())
+
+@skipUnless(importlib.util.find_spec('mongomock'), 'mongomock is not installed')
+class MongoPoolStoreTest(PoolStoreContract, TestCase):
+    def make_store(self):
+        return _mongomock_store(self)
+
+    def test_resolve_store(self):
+        self.assertIs(resolve_store(self.store), self.store)
+        self.assertIsNone(resolve_store(None))
+        self.assertEqual(resolve_store('pool').cache_key(), self.store.cache_key())
+
+    def test_usage(self):
+        from pymongo import UpdateOne
+        try:
+            self.store.db.probe.bulk_write([UpdateOne({}, {"$set": {"x": 1}})])
+        except TypeError:
+            self.skipTest('this mongomock does not support bulk_write with the installed pymongo')
+        super(MongoPoolStoreTest, self).test_usage()
+
+class MongoClientTest(TestCase):
+    """get_mongo_client: one pooled client per process and URI, never shared across fork."""
+    def test_per_process_client(self):
+        with mock.patch('pymongo.MongoClient', side_effect=lambda *args, **kwargs: object()), \
+                mock.patch.dict(pool_store._clients, clear=True):
+            client = pool_store.get_mongo_client('mongodb://a')
+            self.assertIs(pool_store.get_mongo_client('mongodb://a'), client)
+            self.assertIsNot(pool_store.get_mongo_client('mongodb://b'), client)
+            with mock.patch('os.getpid', return_value=os.getpid() + 1):
+                self.assertIsNot(pool_store.get_mongo_client('mongodb://a'), client)
+
+class PoolCacheTest(TestCase):
+    """Worker-resident snapshots (photomosaic_exec/pool_cache.py), invalidated by the pool version."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        pool_cache.clear()
+        self.addCleanup(pool_cache.clear)
+        docs = _pool_docs(20)
+        self.store = MemoryPoolStore(docs)
+        self.paths = [doc["imgsrc"] for doc in docs]
+
+    def test_store_keys_not_reused(self):
+        """A new in-memory store never inherits the snapshot of a collected one."""
+        self.assertEqual(len(set(MemoryPoolStore().cache_key() for _ in range(100))), 100)
+        get_snapshot(MemoryPoolStore(_pool_docs(5, 1)))
+        self.assertEqual(list(get_snapshot(MemoryPoolStore(_pool_docs(5, 2))).paths),
+                         [doc["imgsrc"] for doc in _pool_docs(5, 2)])
+
+    def test_version_invalidation(self):
+        first = get_snapshot(self.store)
+        self.assertIs(get_snapshot(self.store), first)
+        self.assertIsNot(get_snapshot(self.store, 'lab'), first)
+        added = _pool_docs(2, 1)
+        self.store.add_batch(added)
+        incremental = pool_cache.stats["incremental"]
+        second = get_snapshot(self.store)
+        self.assertEqual(pool_cache.stats["incremental"], incremental + 1)
+        self.assertEqual(list(second.paths), self.paths + [doc["imgsrc"] for doc in added])
+        self.assertEqual((first.version, len(first), list(first.paths)), (1, 20, self.paths))
+        np.testing.assert_array_equal(second.features[:20], first.features)
+
+    def test_full_reload(self):
+        """Large deltas and (de)activations are not replayed; the pool is loaded again."""
+        get_snapshot(self.store)
+        incremental = pool_cache.stats["incremental"]
+        self.store.remove_paths(self.paths[:12])
+        self.assertEqual(list(get_snapshot(self.store).paths), self.paths[12:])
+        self.store.set_inactive(self.paths[12:14])
+        self.assertEqual(list(get_snapshot(self.store, active_only=True).paths), self.paths[14:])
+        self.assertEqual(pool_cache.stats["incremental"], incremental)
+
+    def test_index_per_version(self):
+        builds = []
+        build = lambda snapshot: builds.append(snapshot.version) or len(builds)
+        self.assertEqual(get_snapshot(self.store).get_index('test', build), 1)
+        self.assertEqual(get_snapshot(self.store).get_index('test', build), 1)
+        self.store.remove_paths(self.paths[:1])
+        self.assertEqual(get_snapshot(self.store).get_index('test', build), 2)
+        self.assertEqual(builds, [1, 2])
+
+    def test_local_store(self):
+        local = os.path.join(self.tmp, 'local')
+        self.store.set_inactive(self.paths[:3])
+        version = sync_local_store(self.store, local)
+        with mock.patch.object(pool_cache.LocalFeatureStore, 'write') as write:
+            self.assertEqual(sync_local_store(self.store, local), version)
+            write.assert_not_called()
+        offline = get_snapshot(None, local_store=local)
+        self.assertEqual((offline.version, list(offline.paths)), (version, self.paths))
+        np.testing.assert_array_equal(offline.shards, shard_of(offline.features, 'rgb'))
+        self.assertEqual(list(get_snapshot(None, local_store=local, active_only=True).paths), self.paths[3:])
+
+class ScannerTest(TestCase):
+    """IncrementalScanner (photomosaic_exec/scanner.py) reports only what changed since the last commit."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.root = os.path.join(self.tmp, 'pool')
+        os.makedirs(os.path.join(self.root, 'a', 'b'))
+        self.paths = _write_pool(self.root, 3) + _write_pool(os.path.join(self.root, 'a', 'b'), 2, seed=1)
+        with open(os.path.join(self.root, 'a', 'notes.txt'), 'w') as f:
+            f.write('not an image')
+        self.scanner = IncrementalScanner(self.root, os.path.join(self.tmp, 'manifest.db'), workers=2)
+        self.addCleanup(self.scanner.close)
+
+    def changes(self):
+        return sorted((change.kind, change.path) for change in self.scanner.scan())
+
+    def test_scan_tree(self):
+        self.assertEqual(sorted(path for path, _, _ in scan_tree(self.root, workers=2)), sorted(self.paths))
+
+    def test_changes(self):
+        self.assertEqual(self.changes(), sorted(('added', path) for path in self.paths))
+        self.assertEqual(self.changes(), sorted(('added', path) for path in self.paths))
+        self.scanner.commit(self.scanner.scan())
+        self.assertEqual(self.changes(), [])
+        changed, touched, deleted = self.paths[:3]
+        with open(changed, 'ab') as f:
+            f.write(b'trailing bytes')
+        os.utime(touched, ns=(1, 10 ** 18))
+        os.remove(deleted)
+        added = _write_pool(os.path.join(self.root, 'a'), 1, seed=2)[0]
+        changes = list(self.scanner.scan())
+        self.assertEqual(sorted((change.kind, change.path) for change in changes),
+                         sorted([('changed', changed), ('deleted', deleted), ('added', added)]))
+        self.scanner.commit(changes)
+        self.assertEqual(self.changes(), [])
+
+    def test_commit_hashes(self):
+        """Hashes handed to commit() are stored as they are; other files are hashed."""
+        changes = list(self.scanner.scan())
+        hashes = dict((path, scanner.content_hash(path)) for path in self.paths[1:])
+        with mock.patch.object(scanner, 'content_hash', wraps=scanner.content_hash) as content_hash:
+            self.scanner.commit(changes, hashes)
+            content_hash.assert_called_once_with(self.paths[0])
+        os.utime(self.paths[0], ns=(1, 10 ** 18))
+        self.assertEqual(self.changes(), [])
+
+    def test_image_pool_manifest(self):
+        store = MemoryPoolStore()
+        ingest = lambda: pm.ImagePool(self.root, store=store, manifest=self.scanner.manifest_path, workers=2).pool()
+        self.assertEqual(ingest()['inserted'], len(self.paths))
+        os.remove(self.paths[0])
+        added = _write_pool(os.path.join(self.root, 'a'), 1, seed=2)[0]
+        stats = ingest()
+        self.assertEqual(stats['inserted'], 1)
+        self.assertEqual(sorted(store.features()[1]), sorted(self.paths[1:] + [added]))
+
+class DedupeTest(TestCase):
+    """Perceptual hashing (photomosaic_exec/dedupe.py) and near-duplicate skipping during ingestion."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.root = os.path.join(self.tmp, 'pool')
+        os.mkdir(self.root)
+        original = _write_source(os.path.join(self.root, 'original.jpg'))
+        with Image.open(original) as im:
+            im.resize((200, 150)).save(os.path.join(self.root, 'smaller.jpg'), quality=50)
+        _write_source(os.path.join(self.root, 'portrait.jpg'), (300, 400))
+
+    def hash(self, name):
+        with Image.open(os.path.join(self.root, name)) as im:
+            return dhash(im)
+
+    def test_dhash(self):
+        self.assertLessEqual(hamming(self.hash('original.jpg'), self.hash('smaller.jpg')), 4)
+        self.assertGreater(hamming(self.hash('original.jpg'), self.hash('portrait.jpg')), 8)
+        self.assertTrue(-2 ** 63 <= self.hash('portrait.jpg') < 2 ** 63)
+
+    def test_index_matches_brute_force(self):
+        rng = np.random.RandomState(0)
+        stored = [int(h) for h in rng.randint(-2 ** 63, 2 ** 63 - 1, 500, dtype=np.int64)]
+        index = PerceptualIndex(stored, max_distance=4)
+        self.assertEqual(len(index), 500)
+        queries = [h ^ sum(1 << int(bit) for bit in rng.choice(64, flips, replace=False))
+                   for h, flips in zip(stored[:100], rng.randint(0, 8, 100))]
+        for query in queries + stored[400:]:
+            found = index.find(query)
+            near = [h for h in stored if hamming(h, query) <= 4]
+            if near:
+                self.assertIn(found, near)
+            else:
+                self.assertIsNone(found)
+
+    def test_near_duplicates_skipped(self):
+        store = MemoryPoolStore()
+        stats = pm.ImagePool(self.root, store=store, near_duplicates=4, workers=2).pool()
+        self.assertEqual((stats['inserted'], stats['duplicates']), (2, 1))
+        self.assertIn(os.path.join(self.root, 'portrait.jpg'), store.features()[1])
+        stats = pm.ImagePool(self.root, store=MemoryPoolStore(), workers=2).pool()
+        self.assertEqual((stats['inserted'], stats['duplicates']), (3, 0))
+
+def _append_thumbnails(args):
+    """Worker for TilePackTest: append count solid thumbnails named after worker to the pack in directory."""
+    directory, worker, count = args
+    pack = TilePack(directory, segment_bytes=4096)
+    for i in range(count):
+        pack.append('%d/%d' % (worker, i), Image.new('RGB', (50, 40), (worker * 40, i * 10, 0)))
+
+class TilePackTest(TestCase):
+    """Packed, memory-mapped pool thumbnails (photomosaic_exec/tilepack.py)."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        with Image.open(_write_source(os.path.join(self.tmp, 'source.png'), (300, 200))) as im:
+            self.im = im.convert('RGB')
+        self.thumb = self.im.resize(TILE_SIZE, Image.ANTIALIAS)
+
+    def test_codecs(self):
+        jpeg, raw = TilePack(os.path.join(self.tmp, 'jpeg')), TilePack(os.path.join(self.tmp, 'raw'), codec='raw')
+        self.assertEqual(jpeg.codec, 'jpeg')
+        self.assertEqual(len(raw.encode(self.im)[0]), TILE_SIZE[0] * TILE_SIZE[1] * 3)
+        self.assertLess(len(jpeg.encode(self.im)[0]), len(raw.encode(self.im)[0]) // 4)
+        for pack in (jpeg, raw):
+            pack.append('/pool/a.jpg', self.im)
+            self.assertIn('/pool/a.jpg', pack)
+            self.assertNotIn('/pool/b.jpg', pack)
+            self.assertIsNone(pack.get('/pool/b.jpg'))
+        self.assertEqual(raw.get('/pool/a.jpg').tobytes(), self.thumb.tobytes())
+        decoded = np.asarray(jpeg.get('/pool/a.jpg'), dtype=float)
+        self.assertLess(np.abs(decoded - np.asarray(self.thumb, dtype=float)).mean(), 4)
+        self.assertEqual(raw.thumbnail('/pool/a.jpg', (64, 64)).size, (64, 64))
+        with self.assertRaises(ValueError):
+            TilePack(self.tmp, codec='png')
+
+    def test_segments_and_readers(self):
+        """Appends roll over to new segments and show up in a reader opened earlier; the last append wins."""
+        writer = TilePack(self.tmp, codec='raw', segment_bytes=3 * TILE_SIZE[0] * TILE_SIZE[1] * 3)
+        reader = TilePack(self.tmp)
+        colours = [(i * 20, 0, 255 - i * 20) for i in range(8)]
+        for i, colour in enumerate(colours):
+            writer.append('/pool/%d.jpg' % i, Image.new('RGB', (30, 30), colour))
+            self.assertEqual(reader.get('/pool/%d.jpg' % i).getpixel((5, 5)), colour)
+        self.assertEqual(len([name for name in os.listdir(self.tmp) if name.startswith('seg')]), 3)
+        writer.append('/pool/0.jpg', Image.new('RGB', (30, 30), (1, 2, 3)))
+        self.assertEqual(TilePack(self.tmp).get('/pool/0.jpg').getpixel((5, 5)), (1, 2, 3))
+        self.assertEqual(len(reader), 8)
+
+    def test_concurrent_appends(self):
+        with multiprocessing.get_context('fork').Pool(4) as workers:
+            workers.map(_append_thumbnails, [(self.tmp, worker, 15) for worker in range(4)])
+        pack = TilePack(self.tmp)
+        self.assertEqual(len(pack), 60)
+        for worker in range(4):
+            pixel = pack.get('%d/%d' % (worker, 14)).getpixel((96, 96))
+            self.assertLess(np.abs(np.subtract(pixel, (worker * 40, 140, 0))).max(), 8)
+
+    def test_render_from_pack(self):
+        """Ingestion packs every thumbnail; renders then never open the pool files."""
+        pool_dir, pack_dir = os.path.join(self.tmp, 'pool'), os.path.join(self.tmp, 'pack')
+        os.mkdir(pool_dir)
+        paths = _write_pool(pool_dir, 20)
+        store = MemoryPoolStore()
+        pm.ImagePool(pool_dir, store=store, tile_pack=pack_dir, workers=2).pool()
+        self.assertTrue(all(path in TilePack(pack_dir) for path in paths))
+        mypm = pm.PhotoMosaic(_write_source(os.path.join(self.tmp, 'source.jpg')), (20, 10), tile_pack=pack_dir)
+        mypm.partition()
+        mypm.analyze()
+        mypm.choose_match(store)
+        mypm.mosaic(factor=2)
+        expected = mypm.mos.tobytes()
+        manifest = mypm.placement_manifest(factor=2)
+        rendered = pm.render_manifest(manifest, tile_pack=pack_dir).tobytes()
+        shutil.rmtree(pool_dir)
+        mypm.mosaic(factor=2, prefetch=False)
+        self.assertEqual(mypm.mos.tobytes(), expected)
+        self.assertEqual(pm.render_manifest(manifest, tile_pack=pack_dir).tobytes(), rendered)
+
+class IngestPipelineTest(TestCase):
+    """Bounded worker pipeline for pool ingestion (photomosaic_exec/ingest.py)."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.paths = _write_pool(self.tmp, 16)
+        self.copy = os.path.join(self.tmp, 'copy.jpg')
+        shutil.copy(self.paths[3], self.copy)
+        self.broken = os.path.join(self.tmp, 'broken.jpg')
+        with open(self.broken, 'wb') as f:
+            f.write(b'not a jpeg')
+        self.store = MemoryPoolStore()
+
+    def test_run(self):
+        batches = []
+        pipeline = IngestPipeline(self.store, pm.analyze_pool_image, workers=2, batch_size=4,
+                                  on_batch=lambda paths, hashes: batches.append((paths, hashes)))
+        stats = pipeline.run(self.paths + [self.copy, self.broken])
+        self.assertEqual([stats[k] for k in ('analyzed', 'failed', 'duplicates', 'inserted')], [17, 1, 1, 16])
+        self.assertEqual(self.store.count(), 16)
+        self.assertEqual(sorted(path for paths, _ in batches for path in paths), sorted(self.paths + [self.copy]))
+        hashes = dict(item for _, batch in batches for item in batch.items())
+        self.assertEqual(hashes[self.copy], scanner.content_hash(self.copy))
+        self.assertEqual(hashes[self.copy], hashes[self.paths[3]])
+        stats = IngestPipeline(self.store, pm.analyze_pool_image, workers=2).run(self.paths + [self.broken])
+        self.assertEqual((stats['known'], stats['analyzed'], stats['failed']), (16, 0, 1))
+
+    def test_backpressure(self):
+        """The walker is never more than max_pending images (plus one lookup batch) ahead of the workers."""
+        pipeline = IngestPipeline(self.store, pm.analyze_pool_image, workers=2, batch_size=2, max_pending=3)
+        lead = []
+
+        def walk():
+            for i, path in enumerate(self.paths):
+                lead.append(i - pipeline.stats['analyzed'] - pipeline.stats['failed'])
+                yield path
+
+        self.assertEqual(pipeline.run(walk())['inserted'], 16)
+        self.assertLessEqual(max(lead), 3 + 2)
+
+@skipUnless(importlib.util.find_spec('mongomock'), 'mongomock is not installed')
+class MongoLoadTest(TestCase):
+    """Projected, partitioned feature loads from MongoPoolStore into a preallocated float32 matrix."""
+    def setUp(self):
+        self.store = _mongomock_store(self)
+        self.docs = _pool_docs(37)
+        self.store.add_batch([dict(doc, thumbnail=b'x' * 1000) for doc in self.docs])
+        self.paths = [doc["imgsrc"] for doc in self.docs]
+        self.expected = np.array([decode_features(doc, 'avgLab') for doc in self.docs])
+
+    def test_partitions(self):
+        for partitions in (1, 3, 4, 8):
+            matrix, paths, shards = self.store.features('lab', partitions=partitions, batch_size=2, shards=True)
+            self.assertEqual(paths, self.paths, partitions)
+            self.assertEqual(matrix.dtype, FEATURE_DTYPE)
+            np.testing.assert_array_equal(matrix, self.expected)
+            np.testing.assert_array_equal(shards, [doc["shardLab"] for doc in self.docs])
+
+    def test_projection(self):
+        collection = self.store.collection
+        with mock.patch.object(type(collection), 'find', autospec=True, side_effect=type(collection).find) as find:
+            self.store.features('rgb', partitions=3, batch_size=2)
+        projections = [call[0][2] for call in find.call_args_list if len(call[0]) > 2 and 'imgsrc' in call[0][2]]
+        self.assertEqual(len(projections), 3)
+        for projection in projections:
+            self.assertEqual(sorted(set(projection) - {'_id'}), ['avgRGB', 'featureSchema', 'imgsrc'])
+
+    def test_active_only(self):
+        self.store.set_inactive(self.paths[::2])
+        matrix, paths = self.store.features('lab', active_only=True, partitions=4, batch_size=2)
+        self.assertEqual(paths, self.paths[1::2])
+        np.testing.assert_array_equal(matrix, self.expected[1::2])
+
+    def test_pool_grows_during_load(self):
+        added = _pool_docs(3, 1)
+        id_at = self.store._id_at
+
+        def grow(rank, query=None):
+            if added:
+                self.store.add_batch([added.pop(0)])
+            return id_at(rank, query)
+
+        with mock.patch.object(self.store, '_id_at', side_effect=grow):
+            matrix, paths = self.store.features('rgb', partitions=4, batch_size=2)
+        self.assertEqual(paths[:37], self.paths)
+        self.assertEqual(len(paths), 40)
+        self.assertEqual(len(matrix), 40)
+        np.testing.assert_array_equal(matrix[:37], [decode_features(doc, 'avgRGB') for doc in self.docs])
+
+def _brute_nearest(queries, points):
+    """Reference for nearest_distances(): full pairwise Euclidean distances over flattened features."""
+    q, p = np.asarray(queries, dtype=float).reshape(-1, 48), np.asarray(points, dtype=float).reshape(-1, 48)
+    return np.sqrt(((q[:, None, :] - p[None, :, :]) ** 2).sum(axis=2)).min(axis=1)
+
+class CoresetTest(TestCase):
+    """Pool pruning to a colour-space coreset (photomosaic_exec/coreset.py, prune_pool)."""
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        centers = rng.rand(8, 16, 3) * 255
+        members = np.concatenate([c + rng.randn(20, 16, 3) * 2 for c in centers])
+        self.features = np.concatenate([members, members[::4]]).astype(np.float32)
+        rng.shuffle(self.features)
+
+    def test_coverage(self):
+        """Every pruned image lies within tolerance of a kept one."""
+        for method in ('kcenter', 'grid'):
+            keep = select_coreset(self.features, 40.0, method)
+            self.assertLessEqual(keep.sum(), 160, method)
+            loss = _brute_nearest(self.features[~keep], self.features[keep])
+            self.assertLessEqual(loss.max(), 40.0, method)
+        self.assertEqual(select_coreset(self.features, 40.0).sum(), 8)
+        self.assertEqual(select_coreset(self.features, 0.0, max_size=5).sum(), 5)
+        self.assertEqual(len(select_coreset(np.empty((0, 16, 3)), 1.0, 'grid')), 0)
+        with self.assertRaises(ValueError):
+            select_coreset(self.features, 40.0, 'random')
+
+    def test_nearest_distances(self):
+        keep = select_coreset(self.features, 40.0)
+        expected = _brute_nearest(self.features[~keep], self.features[keep])
+        np.testing.assert_allclose(nearest_distances(self.features[~keep], self.features[keep], budget=20), expected,
+                                   atol=1e-3)
+        report = coverage_report(self.features, keep)
+        self.assertEqual((report['total'], report['kept'], report['pruned'], report['speedup']), (200, 8, 192, 25.0))
+        self.assertAlmostEqual(report['max_loss'], expected.max(), places=2)
+        self.assertAlmostEqual(report['mean_loss'], expected.mean(), places=2)
+
+    def test_prune_pool(self):
+        docs = [{"imgsrc": '/pool/%d.jpg' % i, "avgRGB": encode_features(f), "avgLab": encode_features(f),
+                 "featureSchema": 1} for i, f in enumerate(self.features)]
+        store = MemoryPoolStore(docs)
+        report = pm.prune_pool(store, 40.0, dry_run=True)
+        self.assertEqual((report['kept'], store.inactive_paths()), (8, set()))
+        pm.prune_pool(store, 40.0)
+        kept = store.features(active_only=True)[1]
+        self.assertEqual(len(kept), 8)
+        self.assertEqual(len(store.inactive_paths()), 192)
+        self.assertEqual(list(get_snapshot(store, active_only=True).paths), kept)
+
+class CompactPoolTest(TestCase):
+    """Quantized pool features (photomosaic_exec/quantize.py) rank like the float features."""
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.rgb = (rng.rand(500, 16, 3) * 255).astype(np.float32)
+        self.lab = (rng.rand(500, 16, 3) * [100, 256, 256] - [0, 128, 128]).astype(np.float32)
+        self.queries = rng.rand(40, 16, 3) * 255
+
+    @staticmethod
+    def exact(features, query):
+        return np.sqrt(((np.asarray(features, dtype=np.float64).reshape(len(features), -1)
+                         - np.asarray(query, dtype=np.float64).reshape(-1)) ** 2).sum(axis=1))
+
+    def test_rounding_bound(self):
+        """Distances are off by at most half a quantization step per channel."""
+        for features, color_space, lab_dtype, step, nbytes in ((self.rgb, 'rgb', 'int16', 1, 1),
+                                                               (self.lab, 'lab', 'int16', 0.01, 2),
+                                                               (self.lab, 'lab', 'float16', 0.25, 2)):
+            compact = CompactPool(features, color_space, lab_dtype)
+            self.assertEqual(compact.nbytes, len(features) * 48 * nbytes)
+            for query in self.queries[:5]:
+                error = np.abs(compact.distances(query) - self.exact(features, query)).max()
+                self.assertLessEqual(error, np.sqrt(48) * step / 2 + 1e-9, (color_space, lab_dtype))
+
+    def test_rerank(self):
+        compact = CompactPool(self.rgb, 'rgb', rerank=16)
+        for query in self.queries:
+            exact, d = self.exact(self.rgb, query), compact.distances(query)
+            self.assertEqual(d.argmin(), exact.argmin())
+            self.assertAlmostEqual(d.min(), exact.min())
+            self.assertEqual(np.sum(d == exact), 16)
+
+    def test_verify_ranking(self):
+        report = verify_ranking(self.rgb, self.queries, 'rgb', k=10, rerank=32)
+        self.assertEqual((report['top1_agreement'], report['topk_overlap']), (1.0, 1.0))
+        report = verify_ranking(self.lab, self.queries / 2.55, 'lab', k=10)
+        self.assertEqual(report['top1_agreement'], 1.0)
+        self.assertGreaterEqual(report['topk_overlap'], 0.95)
+        self.assertEqual(report['compact_bytes'] * 4, report['float64_bytes'])
+
+    def test_apply(self):
+        """Rows appended to a snapshot are quantized onto the existing index."""
+        snapshot = PoolSnapshot(self.rgb[:300], ['/pool/%d' % i for i in range(300)], 1)
+        compact = CompactPool(snapshot.features, 'rgb', rerank=8)
+        added = ['/pool/%d' % i for i in range(300, 500)]
+        updated = snapshot.apply([('add', added)], 2, lambda paths: (self.rgb[300:], paths))
+        grown = compact.apply(updated, 300)
+        fresh = CompactPool(self.rgb, 'rgb', rerank=8)
+        self.assertEqual(len(grown), 500)
+        np.testing.assert_array_equal(grown.data, fresh.data)
+        np.testing.assert_array_equal(grown.distances(self.queries[0]), fresh.distances(self.queries[0]))
+
+    def test_choose_match(self):
+        """verify_compact compares both rankings on the job's own tiles; they agree."""
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        mypm = _matched_mosaic(tmp)
+        store = MemoryPoolStore([pm.analyze_pool_image(path) for path in _write_pool(tmp, 30)])
+        with self.assertLogs('photomosaic_exec.photomosaic', 'INFO') as logs:
+            mypm.choose_match(store, compact=True, verify_compact=True)
+        check = [line for line in logs.output if 'Compact ranking check' in line]
+        self.assertEqual(len(check), 1)
+        self.assertIn("'top1_agreement': 1.0", check[0])
+        self.assertTrue(all(tile.match for tile in mypm.tiles))
+
+class PoolSnapshotTest(TestCase):
+    """Incremental PoolSnapshot updates: tombstones, appends and compaction (photomosaic_exec/pool_cache.py)."""
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.features = dict(('/pool/%d.jpg' % i, rng.rand(16, 3).astype(np.float32)) for i in range(30))
+        self.paths = sorted(self.features)[:10]
+        self.snapshot = PoolSnapshot(np.array([self.features[p] for p in self.paths]), list(self.paths), 1)
+        self.fetched = []
+
+    def fetch(self, paths):
+        self.fetched.append(list(paths))
+        return np.array([self.features[p] for p in paths]).reshape(-1, 16, 3), list(paths)
+
+    def assertLive(self, snapshot, paths):
+        features, live = snapshot.live()
+        self.assertEqual(list(live), paths)
+        self.assertEqual(len(snapshot), len(paths))
+        np.testing.assert_array_equal(features, [self.features[p] for p in paths])
+        self.assertEqual(sorted(snapshot.rows()), sorted(paths))
+        for path, row in snapshot.rows().items():
+            np.testing.assert_array_equal(snapshot.features[row], self.features[path])
+
+    def test_tombstone_apply_compact(self):
+        new = sorted(self.features)[10:13]
+        changed = self.snapshot.apply([('remove', self.paths[:2]), ('add', new[:2]), ('add', [new[2]]),
+                                       ('remove', [new[2]])], 2, self.fetch)
+        self.assertEqual(self.fetched, [new[:2]])
+        self.assertEqual((changed.version, changed.dead, len(changed.paths)), (2, 2, 12))
+        self.assertLive(changed, self.paths[2:] + new[:2])
+        self.assertLive(self.snapshot, self.paths)
+        readded = changed.apply([('add', [self.paths[0]])], 3, self.fetch)
+        self.assertEqual((readded.dead, len(readded.paths)), (2, 13))
+        self.assertLive(readded, self.paths[2:] + new[:2] + [self.paths[0]])
+        compacted = readded.compacted()
+        self.assertEqual((compacted.dead, compacted.version, compacted.alive), (0, 3, None))
+        self.assertEqual(list(compacted.paths), self.paths[2:] + new[:2] + [self.paths[0]])
+        self.assertLive(compacted, list(compacted.paths))
+
+    def test_branches_do_not_share_rows(self):
+        """Two snapshots appended from the same parent keep their own rows despite the shared buffer."""
+        first = sorted(self.features)[10:12]
+        second = sorted(self.features)[12:20]
+        a = self.snapshot.apply([('add', first)], 2, self.fetch)
+        b = self.snapshot.apply([('add', second)], 2, self.fetch)
+        c = a.apply([('add', second[:1])], 3, self.fetch)
+        self.assertLive(a, self.paths + first)
+        self.assertLive(b, self.paths + second)
+        self.assertLive(c, self.paths + first + second[:1])
+
+    def test_background_compaction(self):
+        pool_cache.clear()
+        self.addCleanup(pool_cache.clear)
+        docs = _pool_docs(20)
+        store = MemoryPoolStore(docs)
+        get_snapshot(store)
+        compactions = pool_cache.stats["compactions"]
+        store.remove_paths([doc["imgsrc"] for doc in docs[:5]])
+        tombstoned = get_snapshot(store)
+        self.assertEqual(tombstoned.dead, 5)
+        deadline = time.time() + 10
+        while pool_cache.stats["compactions"] == compactions and time.time() < deadline:
+            time.sleep(0.01)
+        compacted = get_snapshot(store)
+        self.assertEqual((compacted.dead, compacted.version, list(compacted.paths)),
+                         (0, tombstoned.version, [doc["imgsrc"] for doc in docs[5:]]))
+
+class ShardIndexTest(TestCase):
+    """Dominant-colour sharding agrees with the exact ranking (photomosaic_exec/shards.py)."""
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.features = (rng.rand(200, 16, 3) * 255).astype(np.float32)
+        self.flat = self.features.reshape(200, 48).astype(np.float64)
+        self.query = rng.rand(16, 3) * 255
+
+    def exact(self, query, mask=None, penalty=0):
+        d = np.sqrt(((self.flat - query.reshape(-1)) ** 2).sum(axis=1)) + penalty
+        return [(d[j], j) for j in np.argsort(d, kind='stable') if mask is None or not mask[j]]
+
+    def assertRanking(self, pairs, expected):
+        self.assertEqual([j for _, j in pairs], [j for _, j in expected])
+        np.testing.assert_allclose([d for d, _ in pairs], [d for d, _ in expected])
+
+    def test_ranked_matches_exact(self):
+        index = ShardIndex(self.features)
+        self.assertGreater(len(index), 1)
+        self.assertRanking(list(index.ranked(self.query, distances=True)), self.exact(self.query))
+        exhausted = np.zeros(200, dtype=bool)
+        exhausted[[j for _, j in self.exact(self.query)[:5]]] = True
+        self.assertRanking(list(index.ranked(self.query, exhausted, distances=True)),
+                           self.exact(self.query, exhausted))
+        penalty = np.random.RandomState(1).rand(200) * 50
+        self.assertRanking(list(index.ranked(self.query, distances=True, penalty=penalty)),
+                           self.exact(self.query, penalty=penalty))
+
+    def test_any_partition(self):
+        """Stored shard ids need only partition the pool."""
+        shards = np.random.RandomState(2).randint(0, 7, 200)
+        index = ShardIndex(self.features, shards)
+        self.assertEqual(len(index), 7)
+        self.assertRanking(list(index.ranked(self.query, distances=True)), self.exact(self.query))
+
+    def test_ranked_variants(self):
+        queries = [self.query, self.query[::-1]]
+        index = ShardIndex(self.features, color_space='rgb')
+        exhausted = np.zeros(400, dtype=bool)
+        exhausted[::3] = True
+        expected = sorted((d, k * 200 + j) for k, q in enumerate(queries)
+                          for d, j in self.exact(q, exhausted[k * 200:(k + 1) * 200]))
+        self.assertEqual(list(index.ranked_variants(queries, exhausted)), [j for _, j in expected])
+
+    def test_shard_of(self):
+        self.assertEqual(shard_of(np.zeros((16, 3))), 0)
+        self.assertEqual(shard_of(np.full((16, 3), 300.)), 63)
+        self.assertEqual(shard_of(np.tile([[100., -128., 127.]], (16, 1)), 'lab'), 3 * 16 + 0 * 4 + 3)
+        ids = shard_of(self.features)
+        self.assertEqual(list(ids), [shard_of(f) for f in self.features])
+        self.assertEqual((shard_field('rgb'), shard_field('lab'), shard_field('LAB')), ('shardRGB', 'shardLab', 'shardLab'))
+
+class OrientationTest(TestCase):
+    """Oriented variants reorder the stored region averages exactly (photomosaic_exec/orientations.py)."""
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.img = Image.fromarray((rng.rand(64, 64, 3) * 255).astype(np.uint8))
+
+    @staticmethod
+    def regions(img):
+        return np.asarray(img, dtype=np.float64).reshape(4, 16, 4, 16, 3).mean(axis=(1, 3)).reshape(16, 3)
+
+    def test_permutations_match_transpose(self):
+        features = self.regions(self.img)
+        for o, method in enumerate(ORIENTATION_TRANSPOSE):
+            expected = self.img if method is None else self.img.transpose(method)
+            oriented = orient_image(self.img, o)
+            self.assertEqual(oriented.tobytes(), expected.tobytes())
+            np.testing.assert_allclose(orient_features(features, o), self.regions(expected))
+        self.assertEqual(len(set(tuple(orient_features(np.arange(16)[:, None], o).ravel()) for o in range(8))), 8)
+
+    def test_query_variants(self):
+        rng = np.random.RandomState(1)
+        query, pool = rng.rand(16, 3), rng.rand(5, 16, 3)
+        orientations = orientation_set(8)
+        for o, variant in zip(orientations, query_variants(query, orientations)):
+            np.testing.assert_allclose(((variant - pool) ** 2).sum(axis=(1, 2)),
+                                       ((query - orient_features(pool, o)) ** 2).sum(axis=(1, 2)))
+        self.assertEqual([orientation_set(n) for n in (1, 2)], [[0], [0, 1]])
+        with self.assertRaises(ValueError):
+            orientation_set(3)
+        self.assertIsNone(orient_image(None, 3))
+
+    def test_choose_match(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        store = MemoryPoolStore([pm.analyze_pool_image(path) for path in _write_pool(tmp, 30)])
+        mypm = pm.PhotoMosaic(_write_source(os.path.join(tmp, 'source.jpg')), (20, 10))
+        mypm.partition()
+        mypm.analyze()
+        mypm.choose_match(store, orientations=4)
+        self.assertTrue(all(tile.match for tile in mypm.tiles))
+        self.assertTrue({tile.orientation for tile in mypm.tiles} <= set(range(4)))
+        self.assertTrue(any(tile.orientation for tile in mypm.tiles))
+
+class UsageTest(TestCase):
+    """Cumulative pool usage recorded per job and turned into matching penalties."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.mypm = _matched_mosaic(self.tmp)
+        self.store = SQLitePoolStore(os.path.join(self.tmp, 'pool.db'))
+        self.addCleanup(self.store.close)
+        self.store.add_batch([pm.analyze_pool_image(os.path.join(self.tmp, name))
+                              for name in sorted(os.listdir(self.tmp)) if name != 'source.jpg'])
+
+    def test_record_usage(self):
+        counts = self.mypm.usage_counts()
+        self.assertEqual(sum(counts.values()), len(self.mypm.tiles))
+        self.assertEqual(self.mypm.record_usage(self.store, 'job-1'), counts)
+        self.mypm.record_usage(self.store, 'job-1')
+        self.assertEqual(self.store.usage(), counts)
+        self.assertEqual(self.store.job_usage('job-1'), counts)
+        self.assertEqual(self.mypm.record_usage(None, 'job-2'), counts)
+
+    def test_usage_penalties(self):
+        snapshot = get_snapshot(self.store)
+        self.assertIsNone(pm.PhotoMosaic.usage_penalties(None, snapshot, 1.0))
+        np.testing.assert_array_equal(pm.PhotoMosaic.usage_penalties(self.store, snapshot, 2.0), np.zeros(len(snapshot)))
+        self.store.update_usage({snapshot.paths[1]: 3})
+        penalty = pm.PhotoMosaic.usage_penalties(self.store, snapshot, 2.0)
+        self.assertAlmostEqual(penalty[1], 2.0 * np.log(4))
+        self.assertEqual(np.count_nonzero(penalty), 1)
+
+class StagesTest(TestCase):
+    """The staged job (photomosaic_exec/stages.py) resumes from its artifacts and renders what mosaic() renders."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        paths = _write_pool(self.tmp, 30)
+        self.store = MemoryPoolStore([pm.analyze_pool_image(path) for path in paths])
+        self.source = _write_source(os.path.join(self.tmp, 'source.jpg'))
+        self.job_dir = os.path.join(self.tmp, 'job')
+        stages.create_job(self.job_dir, self.source, (20, 10), factor=2)
+
+    def test_analyze(self):
+        stages.analyze(self.job_dir)
+        expected = pm.PhotoMosaic(self.source, (20, 10))
+        expected.partition()
+        expected.analyze()
+        resumed = stages.open_mosaic(self.job_dir)
+        self.assertEqual(len(resumed.tiles), len(expected.tiles))
+        for tile, other in zip(resumed.tiles, expected.tiles):
+            np.testing.assert_array_equal(tile.rgb, other.rgb)
+            np.testing.assert_array_equal(tile.lab, other.lab)
+        with mock.patch.object(pm.PhotoMosaic, 'analyze') as analyze:
+            stages.analyze(self.job_dir)
+        analyze.assert_not_called()
+
+    def test_match_records_usage_once(self):
+        stages.analyze(self.job_dir)
+        stages.match(self.job_dir, self.store, 'job-1', orientations=2)
+        resumed = stages.open_mosaic(self.job_dir)
+        self.assertTrue(all(tile.match for tile in resumed.tiles))
+        self.assertEqual(self.store.job_usage('job-1'), resumed.usage_counts())
+        with mock.patch.object(pm.PhotoMosaic, 'choose_match') as choose_match:
+            stages.match(self.job_dir, self.store, 'job-1')
+        choose_match.assert_not_called()
+        os.remove(os.path.join(self.job_dir, stages.PLAN_FILE))
+        matches = [[i, tile.match, tile.orientation] for i, tile in enumerate(resumed.tiles)]
+        stages.save_plan(self.job_dir, matches, self.store, 'job-1')
+        self.assertEqual(self.store.usage(), resumed.usage_counts())
+        replanned = stages.open_mosaic(self.job_dir)
+        self.assertEqual([(t.match, t.orientation) for t in replanned.tiles],
+                         [(t.match, t.orientation) for t in resumed.tiles])
+
+    def test_render_resumes(self):
+        stages.analyze(self.job_dir)
+        stages.match(self.job_dir, self.store)
+        expected = stages.open_mosaic(self.job_dir)
+        expected.mosaic(factor=2)
+        strips = stages.render(self.job_dir, workers=2)
+        os.remove(os.path.join(strips, '00003.npy'))
+        with mock.patch.object(pm.PhotoMosaic, 'iter_strips', autospec=True,
+                               side_effect=pm.PhotoMosaic.iter_strips) as iter_strips:
+            stages.render(self.job_dir)
+        self.assertEqual(iter_strips.call_args[1]['only'], [3])
+        path = stages.encode(self.job_dir, 'out.png')
+        with Image.open(path) as im:
+            self.assertEqual(im.size, expected.mos.size)
+            self.assertEqual(im.convert('RGB').tobytes(), expected.mos.convert('RGB').tobytes())
@@ -13,6 +13,8 @@ urlpatterns = [
     # 3) Other actions
     path('remove/',   views.remove,     name='remove'),
     path('results/',  views.results,    name='results'),
+    path('results/download/', views.download_full, name='download_full'),
+    path('results/tiles/<str:key>/', views.pool_tile, name='pool_tile'),
 
     # 4) AJAX upload endpoints
     path('upload/',           views.PictureCreateView.as_view(), name='upload_new'),
@@ -10,32 +10,36 @@ HOW IT WORKS:
     - Provides upload gallery via AJAX with JSON responses.
     - Deletes uploaded pictures and local image cleanup.
     - Shows mosaic results including status and generated output.
+    - Serves the pool thumbnails a client-rendered mosaic is composited from.
     - Routes for main menu navigation.
 
 INTERACTIONS:
     - Interacts with `models.py` for Picture ORM objects.
     - Uses `forms.py` for ImageForm for upload validation.
-    - Launches Celery task `test_mosaic` from `tasks.py`.
+    - Launches Celery task `test_mosaic` from `tasks.py` (or the staged chain `staged_mosaic` with MOSAIC_STAGED_PIPELINE=1).
     - Uses Django generic views for AJAX upload handling.
     - Templates used: home.html, main_menu.html, results.html, remove_images.html, error_rm.html
 """
 
 # mosaic/views.py
 
+import io
 import os
 import re
 import glob
+from functools import lru_cache
 
 from django.shortcuts import render, redirect
 from django.urls import reverse
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
 from django.views.generic import CreateView, DeleteView
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.conf import settings
 from celery.result import AsyncResult
 
-from .tasks import test_mosaic
+from .tasks import (test_mosaic, render_from_manifest, staged_mosaic, stage_ids, pm, decode_manifest, tile_id,
+                    CLIENT_RENDER, DEEP_ZOOM, POOL_TILE_PACK, STAGED_PIPELINE)
 from .models import Picture
 from .forms import ImageForm
 
@@ -91,7 +95,13 @@ def home(request):
         except (ValueError, TypeError):
             fade = 0.0
 
-        # 4) Launch Celery task
+        # 4) Launch Celery task (or the staged chain of tasks)
+        if STAGED_PIPELINE:
+            task = staged_mosaic(main_url, dimensions, shape, outfile, artistic, fade)
+            request.session['task_id'] = task.task_id
+            request.session['stage_ids'] = stage_ids(task)
+            return redirect('mosaic:results')
+        request.session.pop('stage_ids', None)
         task = test_mosaic.delay(
             main_url,
             pool_urls,
@@ -99,7 +109,10 @@ def home(request):
             shape,
             outfile,
             artistic,
-            fade
+            fade,
+            deep_zoom=DEEP_ZOOM,
+            client_render=CLIENT_RENDER,
+            tile_url=request.build_absolute_uri(reverse('mosaic:pool_tile', args=['TILE_ID'])).replace('TILE_ID', '{}')
         )
         request.session['task_id'] = task.task_id
         return redirect('mosaic:results')
@@ -188,13 +201,33 @@ def results(request):
     task_id = request.session.get('task_id')
     ready = AsyncResult(task_id).ready() if task_id else False
 
+    # A failed stage leaves the later stages of a staged job pending forever
+    failed = [AsyncResult(i) for i in request.session.get('stage_ids', []) if AsyncResult(i).failed()]
+
+    preview_url = None
+    if task_id and not ready:
+        info = AsyncResult(task_id).info
+        if isinstance(info, dict):
+            preview_url = info.get('preview')
+
     s3_url = None
+    deep_zoom = None
+    manifest_url = None
     total_time = None
     error = None
 
-    if ready:
+    if failed:
+        ready = True
+        error = str(failed[0].result)
+    elif ready:
         result = AsyncResult(task_id).result
-        if isinstance(result, str) and result.startswith('http'):
+        if isinstance(result, dict) and 'url' in result:
+            s3_url = result['url']
+            deep_zoom = result.get('deep_zoom')
+            manifest_url = result.get('manifest')
+            if manifest_url:
+                request.session['manifest_job'] = [result['manifest_path'], result['fileout']]
+        elif isinstance(result, str) and result.startswith('http'):
             s3_url = result
         elif isinstance(result, (float, int)):
             total_time = result
@@ -211,7 +244,55 @@ def results(request):
 
     return render(request, 'mosaic/results.html', {
         'im': ready,
+        'preview_url': preview_url,
         's3_url': s3_url,
+        'deep_zoom': deep_zoom,
+        'manifest_url': manifest_url,
         'total_time': total_time,
         'error': error,
     })
+
+
+def download_full(request):
+    """
+    Render the full raster of a client-rendered mosaic on demand, then
+    reuse the results page to poll for it.
+    """
+    job = request.session.get('manifest_job')
+    if not job:
+        return redirect('mosaic:results')
+    manifest_path, fileout = job
+    task = render_from_manifest.delay(manifest_path, fileout)
+    request.session['task_id'] = task.task_id
+    return redirect('mosaic:results')
+
+
+@lru_cache(maxsize=32)
+def _manifest_tiles(manifest_path):
+    """{tile id: pool image path} of a stored placement manifest."""
+    with open(manifest_path, 'rb') as f:
+        manifest = decode_manifest(f.read())
+    return dict((tile_id(path), path) for path in manifest['pool'])
+
+
+def pool_tile(request, key):
+    """
+    Serve one pool thumbnail of the session's client-rendered mosaic, by the
+    tile id (key) its browser manifest references. Only images of that
+    manifest can be fetched.
+    """
+    job = request.session.get('manifest_job')
+    if not job or pm is None:
+        raise Http404
+    try:
+        path = _manifest_tiles(job[0]).get(key)
+    except OSError:
+        path = None
+    img = pm.decode_tile(path, (192, 192), pm.open_pack(POOL_TILE_PACK)) if path else None
+    if img is None:
+        raise Http404
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=85)
+    response = HttpResponse(buf.getvalue(), content_type='image/jpeg')
+    response['Cache-Control'] = 'private, max-age=86400'
+    return response
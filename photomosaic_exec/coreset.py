@@ -0,0 +1,116 @@
+"""
+coreset.py
+
+PURPOSE:
+    Offline pool pruning. Selects a subset ("coreset") of pool images whose features cover every
+    pool image to within a tolerance, so bursts of near-identical photos collapse to a few
+    representatives, and reports how much colour coverage that costs against the search speedup.
+
+HOW IT COMMUNICATES:
+    - Used by photomosaic.py (prune_pool) and the `prune_pool` management command.
+    - Works on feature matrices only; flagging pruned images is left to the PoolStore.
+
+PATHS TO CHECK:
+    - No paths to configure.
+
+MODERNIZATION NOTES:
+    - Distances are the Euclidean norm over the flattened 4x4x3 features, the same metric
+      choose_match() uses, so the tolerance is in matching units.
+    - 'grid' snaps features to cubes small enough that any two members are within tolerance
+      (fast, conservative); 'kcenter' is greedy farthest-point selection, which guarantees the
+      tolerance with far fewer representatives at O(n * kept) cost.
+    - coverage_report() computes losses in float64, in query blocks sized so that each block of
+      distances stays under CHUNK_ELEMENTS whatever the pool size.
+"""
+
+import logging
+import math
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Elements (float64) in one query x pool distance block of nearest_distances(), about 32 MB.
+CHUNK_ELEMENTS = 1 << 22
+
+def _flat(features, dtype=np.float32):
+    x = np.asarray(features)
+    return np.ascontiguousarray(x.reshape(x.shape[0], int(np.prod(x.shape[1:]))), dtype=dtype)
+
+def grid_coreset(features, tolerance):
+    """Keep the first image in every grid cell of side tolerance / sqrt(dims)."""
+    x = _flat(features)
+    if not len(x):
+        return np.zeros(0, dtype=bool)
+    cell = tolerance / math.sqrt(x.shape[1])
+    keys = np.floor(x / cell).astype(np.int64)
+    _, first = np.unique(keys, axis=0, return_index=True)
+    keep = np.zeros(len(x), dtype=bool)
+    keep[first] = True
+    return keep
+
+def kcenter_coreset(features, tolerance, max_size=None):
+    """
+    Greedy k-center: repeatedly keep the image farthest from everything
+    kept so far, until all images are within tolerance (or max_size images
+    are kept).
+    """
+    x = _flat(features)
+    keep = np.zeros(len(x), dtype=bool)
+    if not len(x):
+        return keep
+    nearest = np.full(len(x), np.inf, dtype=np.float32)
+    center, kept = 0, 0
+    limit = max_size or len(x)
+    while kept < limit:
+        keep[center] = True
+        kept += 1
+        np.minimum(nearest, np.sqrt(((x - x[center]) ** 2).sum(axis=1)), out=nearest)
+        center = int(nearest.argmax())
+        if nearest[center] <= tolerance:
+            break
+    return keep
+
+def select_coreset(features, tolerance, method='kcenter', max_size=None):
+    """Boolean mask of the images to keep active."""
+    if method == 'grid':
+        return grid_coreset(features, tolerance)
+    if method == 'kcenter':
+        return kcenter_coreset(features, tolerance, max_size)
+    raise ValueError("Unknown coreset method %r" % method)
+
+def nearest_distances(queries, points, budget=CHUNK_ELEMENTS):
+    """
+    Distance from each query row to its nearest row of points. Queries are
+    taken in chunks of budget // len(points) rows, so the distance block
+    never exceeds budget float64 elements however large the pool is.
+    """
+    if not len(points):
+        return np.full(len(queries), np.inf)
+    q, p = _flat(queries, np.float64), _flat(points, np.float64)
+    out = np.empty(len(q), dtype=np.float64)
+    chunk = max(1, budget // len(p))
+    p_sq = np.einsum('ij,ij->i', p, p)
+    for start in range(0, len(q), chunk):
+        block = q[start:start + chunk]
+        d = block.dot(p.T)
+        d *= -2
+        d += p_sq[None, :]
+        d += np.einsum('ij,ij->i', block, block)[:, None]
+        out[start:start + chunk] = np.sqrt(np.maximum(d.min(axis=1), 0))
+    return out
+
+def coverage_report(features, keep):
+    """
+    Coverage loss (distance from each pruned image to its nearest kept one)
+    against the expected search speedup (pool size / kept size).
+    """
+    total, kept = len(keep), int(keep.sum())
+    report = {"total": total, "kept": kept, "pruned": total - kept,
+              "speedup": round(total / float(kept), 2) if kept else None,
+              "max_loss": 0.0, "mean_loss": 0.0, "p95_loss": 0.0}
+    if kept and kept < total:
+        loss = nearest_distances(np.asarray(features)[~keep], np.asarray(features)[keep])
+        report.update(max_loss=round(float(loss.max()), 3), mean_loss=round(float(loss.mean()), 3),
+                      p95_loss=round(float(np.percentile(loss, 95)), 3))
+    return report
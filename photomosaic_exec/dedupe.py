@@ -0,0 +1,82 @@
+"""
+dedupe.py
+
+PURPOSE:
+    Perceptual hashing for pool ingestion. dhash() turns an image into a 64-bit difference hash
+    that survives re-encoding, resizing and small edits; PerceptualIndex finds stored hashes
+    within a small Hamming distance so near-duplicate photos can be skipped.
+
+HOW IT COMMUNICATES:
+    - Used by photomosaic.py (analyze_pool_image) and ingest.py (IngestPipeline).
+    - Seeded from PoolStore.perceptual_hashes(); no direct database access.
+
+PATHS TO CHECK:
+    - None; works on decoded PIL images and integers only.
+
+MODERNIZATION NOTES:
+    - Hashes are stored as signed 64-bit integers so MongoDB and SQLite keep them natively.
+    - Lookups use multi-index hashing: the hash is cut into max_distance + 1 bands, and any hash
+      within max_distance bits must match at least one band exactly, so only a handful of
+      candidates get a full Hamming comparison instead of the whole pool.
+"""
+
+import logging
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+
+def dhash(img, hash_size=8):
+    """64-bit difference hash of a PIL image, as a signed int."""
+    small = np.asarray(img.convert('L').resize((hash_size + 1, hash_size), Image.ANTIALIAS), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+def hamming(a, b):
+    return bin((a ^ b) & ((1 << HASH_BITS) - 1)).count('1')
+
+class PerceptualIndex(object):
+    """
+    Set of perceptual hashes answering "is anything within max_distance
+    bits of this hash?".
+
+    Example usage:
+        index = PerceptualIndex(store.perceptual_hashes(), max_distance=4)
+        if index.find(doc["phash"]) is None:
+            index.add(doc["phash"])
+    """
+    def __init__(self, hashes=(), max_distance=4):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        edges = np.linspace(0, HASH_BITS, bands + 1).astype(int)
+        self._bands = [(int(lo), (1 << int(hi - lo)) - 1) for lo, hi in zip(edges[:-1], edges[1:])]
+        self._tables = [{} for _ in self._bands]
+        self._count = 0
+        for h in hashes:
+            self.add(h)
+
+    def _keys(self, h):
+        u = h & ((1 << HASH_BITS) - 1)
+        return [(u >> shift) & mask for shift, mask in self._bands]
+
+    def add(self, h):
+        for table, key in zip(self._tables, self._keys(h)):
+            table.setdefault(key, []).append(h)
+        self._count += 1
+
+    def find(self, h):
+        """Return a stored hash within max_distance of h, or None."""
+        for table, key in zip(self._tables, self._keys(h)):
+            for candidate in table.get(key, ()):
+                if hamming(candidate, h) <= self.max_distance:
+                    return candidate
+        return None
+
+    def __len__(self):
+        return self._count
@@ -0,0 +1,242 @@
+"""
+deepzoom.py
+
+PURPOSE:
+    Builds a Deep Zoom (DZI) tile pyramid directly from the mosaic render pass.
+    Every level is produced from the incoming strips (each level feeds a 2x2-reduced copy of its
+    rows to the next), so the full-resolution mosaic is never assembled or re-read.
+
+HOW IT COMMUNICATES:
+    - Used by photomosaic.py (PhotoMosaic.deep_zoom) with strips from PhotoMosaic.iter_strips().
+    - Writes tiles, the .dzi descriptor and a JSON manifest through a sink:
+        DirectorySink -> local filesystem (also the stand-in for S3 in tests)
+        S3Sink        -> AWS S3 via boto3
+
+PATHS TO CHECK:
+    - DirectorySink root must be writable.
+    - S3Sink needs the same AWS credentials/region as upload_to_s3() in photomosaic.py.
+
+MODERNIZATION NOTES:
+    - Tile encoding runs in a concurrent.futures thread pool (Pillow releases the GIL);
+      the number of tiles in flight is capped to keep memory bounded.
+    - Layout follows the DZI convention: <name>_files/<level>/<col>_<row>.<format>.
+"""
+
+import io
+import json
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+DZI_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{tile_size}" '
+    'Overlap="{overlap}" Format="{format}"><Size Width="{width}" Height="{height}"/></Image>\n'
+)
+
+CONTENT_TYPES = {'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp',
+                 'dzi': 'application/xml', 'json': 'application/json'}
+
+class DirectorySink(object):
+    """
+    Writes pyramid files below a local directory. Mirrors the S3 key layout,
+    so it doubles as an offline stand-in for S3Sink.
+    """
+    def __init__(self, root, base_url=None):
+        self.root = root
+        self.base_url = base_url or root
+
+    def write(self, key, data):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def url(self, key):
+        return self.base_url.rstrip('/') + '/' + key
+
+class S3Sink(object):
+    """
+    Writes pyramid files to an S3 bucket under a key prefix.
+    """
+    def __init__(self, bucket, prefix='', region=None, aws_access_key_id=None, aws_secret_access_key=None):
+        import boto3
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.region = region
+        self.s3 = boto3.client(
+            's3',
+            region_name=region,
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key
+        )
+
+    def _key(self, key):
+        return self.prefix + '/' + key if self.prefix else key
+
+    def write(self, key, data):
+        ext = key.rsplit('.', 1)[-1].lower()
+        self.s3.put_object(Bucket=self.bucket, Key=self._key(key), Body=data,
+                           ContentType=CONTENT_TYPES.get(ext, 'application/octet-stream'))
+
+    def url(self, key):
+        return f"https://{self.bucket}.s3.{self.region}.amazonaws.com/{self._key(key)}"
+
+class _Level(object):
+    """
+    One pyramid level: buffers incoming rows, cuts complete tile rows, and
+    forwards 2x2-reduced rows to the next (smaller) level.
+    """
+    def __init__(self, writer, level, width, height, lower):
+        self.writer = writer
+        self.level = level
+        self.width = width
+        self.height = height
+        self.lower = lower
+        self.buffer = None      # rows not yet needed by any tile row
+        self.buffer_top = 0     # absolute y of self.buffer's first row
+        self.tile_row = 0
+        self.carry = None       # odd row waiting for its pair before reduction
+
+    def feed(self, rows):
+        self._tile(rows)
+        if self.lower is None:
+            return
+        if self.carry is not None:
+            rows = _vstack(self.carry, rows)
+            self.carry = None
+        even = rows.size[1] - rows.size[1] % 2
+        if rows.size[1] != even:
+            self.carry = rows.crop((0, even, rows.size[0], rows.size[1]))
+        if even:
+            self.lower.feed(rows.crop((0, 0, rows.size[0], even)).reduce(2))
+
+    def _tile(self, rows):
+        self.buffer = rows if self.buffer is None else _vstack(self.buffer, rows)
+        ts, ov = self.writer.tile_size, self.writer.overlap
+        while True:
+            bottom = min(self.height, (self.tile_row + 1) * ts + ov)
+            if self.buffer_top + self.buffer.size[1] < bottom:
+                break
+            top = max(0, self.tile_row * ts - ov)
+            band = self.buffer.crop((0, top - self.buffer_top, self.width, bottom - self.buffer_top))
+            self.writer.emit_row(self.level, self.tile_row, band)
+            self.tile_row += 1
+            keep_from = max(0, self.tile_row * ts - ov)
+            if keep_from >= self.height:
+                self.buffer = None
+                return
+            self.buffer = self.buffer.crop((0, keep_from - self.buffer_top, self.width, self.buffer.size[1]))
+            self.buffer_top = keep_from
+
+    def close(self):
+        if self.carry is not None and self.lower is not None:
+            self.lower.feed(self.carry.reduce(2))
+            self.carry = None
+        if self.lower is not None:
+            self.lower.close()
+
+def _vstack(a, b):
+    out = Image.new('RGB', (a.size[0], a.size[1] + b.size[1]))
+    out.paste(a, (0, 0))
+    out.paste(b, (0, a.size[1]))
+    return out
+
+class DeepZoomWriter(object):
+    """
+    Consumes full-width strips top to bottom and writes a DZI pyramid.
+
+    Example usage:
+        writer = DeepZoomWriter(DirectorySink("/tmp/dz"), "mosaic", (width, height))
+        for strip in strips:
+            writer.feed(strip)
+        manifest = writer.close()
+    """
+    def __init__(self, sink, name, size, tile_size=254, overlap=1, format='jpg', quality=85,
+                 workers=None, max_pending=256):
+        self.sink = sink
+        self.name = name
+        self.size = size
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.format = format
+        self.quality = quality
+        self.max_pending = max_pending
+        self.max_level = int(math.ceil(math.log2(max(size)))) if max(size) > 1 else 0
+        self.executor = ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1))
+        self.futures = []
+        self.tile_count = 0
+        self.rows_fed = 0
+        lower = None
+        for level in range(self.max_level + 1):
+            scale = 2 ** (self.max_level - level)
+            lower = _Level(self, level,
+                           int(math.ceil(size[0] / scale)),
+                           int(math.ceil(size[1] / scale)),
+                           lower)
+        self.top = lower
+
+    def feed(self, strip):
+        if strip.size[0] != self.size[0]:
+            raise ValueError("Strip width %d does not match image width %d" % (strip.size[0], self.size[0]))
+        self.rows_fed += strip.size[1]
+        self.top.feed(strip)
+
+    def emit_row(self, level, row, band):
+        ts, ov = self.tile_size, self.overlap
+        width = band.size[0]
+        for col in range(int(math.ceil(width / ts))):
+            left = max(0, col * ts - ov)
+            right = min(width, (col + 1) * ts + ov)
+            tile = band.crop((left, 0, right, band.size[1]))
+            key = f"{self.name}_files/{level}/{col}_{row}.{self.format}"
+            self._submit(key, tile)
+
+    def _submit(self, key, tile):
+        if len(self.futures) >= self.max_pending:
+            self.futures.pop(0).result()
+        self.futures.append(self.executor.submit(self._write_tile, key, tile))
+        self.tile_count += 1
+
+    def _write_tile(self, key, tile):
+        buf = io.BytesIO()
+        if self.format in ('jpg', 'jpeg'):
+            tile.save(buf, 'JPEG', quality=self.quality)
+        else:
+            tile.save(buf, self.format.upper())
+        self.sink.write(key, buf.getvalue())
+
+    def close(self):
+        """Flush all levels, write the .dzi descriptor and return the manifest."""
+        try:
+            if self.rows_fed != self.size[1]:
+                raise ValueError("Fed %d rows, expected %d" % (self.rows_fed, self.size[1]))
+            self.top.close()
+            for future in self.futures:
+                future.result()
+        finally:
+            self.executor.shutdown(wait=True)
+        dzi = DZI_TEMPLATE.format(tile_size=self.tile_size, overlap=self.overlap, format=self.format,
+                                  width=self.size[0], height=self.size[1])
+        self.sink.write(f"{self.name}.dzi", dzi.encode('utf-8'))
+        manifest = {
+            "type": "dzi",
+            "name": self.name,
+            "width": self.size[0],
+            "height": self.size[1],
+            "tileSize": self.tile_size,
+            "overlap": self.overlap,
+            "format": self.format,
+            "maxLevel": self.max_level,
+            "tileCount": self.tile_count,
+            "dzi": self.sink.url(f"{self.name}.dzi"),
+            "tilesUrl": self.sink.url(f"{self.name}_files/"),
+        }
+        self.sink.write(f"{self.name}.json", json.dumps(manifest).encode('utf-8'))
+        logger.info("Wrote %d Deep Zoom tiles over %d levels for %s", self.tile_count, self.max_level + 1, self.name)
+        return manifest
@@ -0,0 +1,176 @@
+"""
+distributed.py
+
+PURPOSE:
+    Matching split across machines. The tiles of a job are cut into shards
+    (PhotoMosaic.match_payloads), every shard is matched independently on any worker that can
+    load the pool, returning a short list of the best candidates per tile, and a merge step
+    assigns candidates globally (nearest pairs first) so the usage limits of choose_match()
+    hold across shards.
+
+HOW IT COMMUNICATES:
+    - match_shard() and merge_shards() take and return plain lists / dicts, so they can run as
+      Celery tasks (mosaic/tasks.py runs the shards as a group and the merge as the chord
+      callback) or in-process (local_distribute).
+    - Each worker loads the pool through get_snapshot() (pool_cache.py) from the store named by
+      db_name and / or a local feature store, and keeps it between jobs.
+
+PATHS TO CHECK:
+    - local_store must exist at the same path on every worker (or db_name must name a store
+      every worker can reach).
+
+MODERNIZATION NOTES:
+    - The merge only needs the pool again for tiles whose candidates were all taken by nearer
+      tiles; those are matched against the images still available, so the result never
+      exceeds the usage limits.
+    - Candidate distances are in feature units (as PhotoMosaic.distances), plus the usage
+      penalty, so lists from different workers are directly comparable.
+"""
+
+import heapq
+import itertools
+import logging
+import math
+
+import numpy as np
+
+from .photomosaic import COMPACT_RERANK, PhotoMosaic
+from .pool_cache import get_snapshot
+from .quantize import CompactPool
+from .shards import ShardIndex
+from .orientations import orientation_set, query_variants
+
+logger = logging.getLogger(__name__)
+
+MATCH_CANDIDATES = 16
+
+class _ShardMatcher(object):
+    """Pool snapshot and search index shared by match_shard() and the merge fallback."""
+    def __init__(self, db_name, color_space='rgb', metric='euclidean', local_store=None, active_only=False,
+                 compact=False, sharded=False, orientations=1, usage_penalty=0.0):
+        self.snapshot = snapshot = get_snapshot(db_name, color_space, local_store, active_only)
+        self.metric = metric
+        self.orientations = orientation_set(orientations)
+        self.shards = self.compact = None
+        if sharded and metric == 'euclidean':
+            self.shards = snapshot.get_index(('shards', color_space),
+                                             lambda snap: ShardIndex(snap.features, snap.shards, color_space))
+        elif compact and metric == 'euclidean':
+            self.compact = snapshot.get_index(('compact', color_space),
+                                              lambda snap: CompactPool(snap.features, color_space, rerank=COMPACT_RERANK))
+        self.penalty = PhotoMosaic.usage_penalties(db_name, snapshot, usage_penalty) if usage_penalty else None
+        # Candidate j is variant orientations[j // n] of pool row j % n; n counts tombstoned rows,
+        # which stay in the snapshot matrices (masked by dead), live only the candidates left.
+        self.n = len(snapshot.paths)
+        self.live = len(snapshot) * len(self.orientations)
+        self.features = snapshot.features
+        self.dead = np.tile(~snapshot.alive if snapshot.dead else np.zeros(self.n, dtype=bool), len(self.orientations))
+
+    def __len__(self):
+        return self.n * len(self.orientations)
+
+    def candidate(self, j):
+        return self.snapshot.paths[j % self.n], self.orientations[j // self.n]
+
+    def index(self, key):
+        """Candidate j of a (path, orientation) pair, or None when it is not a live candidate."""
+        path, orientation = key
+        row = self.snapshot.rows().get(path)
+        if row is None or orientation not in self.orientations:
+            return None
+        return self.orientations.index(orientation) * self.n + row
+
+    def distances(self, queries):
+        """Distances from a tile (its query variants) to every candidate."""
+        if self.compact is not None:
+            d = np.concatenate([self.compact.distances(q) for q in queries])
+        elif self.metric == 'euclidean':
+            d = np.concatenate([np.sqrt(((self.features - np.asarray(q, dtype=np.float64)) ** 2).sum(axis=(1, 2)))
+                                for q in queries])
+        else:
+            d = np.concatenate([PhotoMosaic.distances(q, self.features, self.metric) for q in queries])
+        if self.penalty is not None:
+            d += np.tile(self.penalty, len(queries))
+        return d
+
+    def ranked(self, rgb, exhausted):
+        """(distance, candidate) pairs for a tile, nearest first, skipping exhausted candidates."""
+        queries = query_variants(np.asarray(rgb, dtype=np.float64), self.orientations)
+        if self.shards is not None:
+            for j in self.shards.ranked_variants(queries, exhausted, self.penalty):
+                yield self._exact(queries[j // self.n], j), j
+            return
+        d = self.distances(queries)
+        for j in np.argsort(d, kind='stable'):
+            if not exhausted[j]:
+                yield float(d[j]), int(j)
+
+    def _exact(self, query, j):
+        row = j % self.n
+        d = float(np.sqrt(((np.asarray(self.features[row], dtype=np.float64) - query) ** 2).sum()))
+        return d + (float(self.penalty[row]) if self.penalty is not None else 0.)
+
+def match_shard(payload, db_name, candidates=MATCH_CANDIDATES, **options):
+    """
+    Best candidates of every tile of one shard (a PhotoMosaic.match_payloads
+    entry), ignoring usage. options are the choose_match options (color_space,
+    metric, local_store, active_only, compact, sharded, orientations,
+    usage_penalty). Returns the payload with 'candidates': per tile, a list of
+    [distance, path, orientation], nearest first.
+    """
+    matcher = _ShardMatcher(db_name, **_matcher_options(options))
+    result = dict(payload, candidates=[], pool_size=matcher.live)
+    for rgb in payload['rgb']:
+        best = itertools.islice(matcher.ranked(rgb, matcher.dead), candidates)
+        result['candidates'].append([[d] + list(matcher.candidate(j)) for d, j in best])
+    logger.info('Matched a shard of %d tiles against %d candidates', len(payload['tiles']), matcher.live)
+    return result
+
+def merge_shards(results, db_name, ntiles, **options):
+    """
+    Chord callback: assign every tile of the shard results a pool image,
+    nearest (tile, candidate) pairs first, each candidate used at most as
+    often as choose_match() allows for ntiles (non-blank) tiles. Tiles left without a free candidate
+    are matched against the remaining images. Returns [tile, path,
+    orientation] triples, tile being an index from match_payloads.
+    """
+    pool_size = max([r['pool_size'] for r in results] or [0])
+    if not pool_size:
+        return []
+    limit = 1 if ntiles < pool_size else int(math.ceil(1.0 * ntiles / pool_size))
+    pairs = heapq.merge(*[sorted((d, tile, path, orientation) for d, path, orientation in candidates)
+                          for r in results for tile, candidates in zip(r['tiles'], r['candidates'])])
+    usage, assigned = {}, {}
+    for d, tile, path, orientation in pairs:
+        if tile in assigned or usage.get((path, orientation), 0) >= limit:
+            continue
+        usage[(path, orientation)] = usage.get((path, orientation), 0) + 1
+        assigned[tile] = (path, orientation)
+    unresolved = [(tile, rgb) for r in results for tile, rgb in zip(r['tiles'], r['rgb']) if tile not in assigned]
+    if unresolved:
+        matcher = _ShardMatcher(db_name, **_matcher_options(options))
+        exhausted = matcher.dead.copy()
+        for key, count in usage.items():
+            j = matcher.index(key) if count >= limit else None
+            if j is not None:
+                exhausted[j] = True
+        for tile, rgb in unresolved:
+            for _, j in matcher.ranked(rgb, exhausted):
+                key = matcher.candidate(j)
+                usage[key] = usage.get(key, 0) + 1
+                assigned[tile] = key
+                if usage[key] >= limit:
+                    exhausted[j] = True
+                break
+        logger.info('Merged shards: %d of %d tiles re-matched after usage conflicts', len(unresolved), len(assigned))
+    return [[tile, path, orientation] for tile, (path, orientation) in sorted(assigned.items())]
+
+def local_distribute(payloads, options):
+    """
+    In-process stand-in for a Celery chord: match every shard, then merge.
+    The distribute argument of choose_match() has this signature.
+    """
+    return merge_shards([match_shard(payload, **options) for payload in payloads], **options)
+
+def _matcher_options(options):
+    return dict((k, v) for k, v in options.items() if k not in ('ntiles', 'candidates'))
@@ -0,0 +1,175 @@
+"""
+export.py
+
+PURPOSE:
+    Encodes a finished mosaic to one or more output formats using all cores.
+    JPEG is encoded strip by strip in parallel and stitched into a single baseline file using
+    restart markers; WebP, tiled TIFF and a downscaled web copy are produced concurrently.
+
+HOW IT COMMUNICATES:
+    - Used by photomosaic.py (PhotoMosaic.export) on the rendered mosaic image.
+    - Writes image files to the local filesystem; no database access.
+
+PATHS TO CHECK:
+    - The output directory must be writable.
+
+MODERNIZATION NOTES:
+    - Pillow releases the GIL while encoding, so strips encode in parallel threads.
+    - Tiled TIFF (lossless, deflate) uses the optional `tifffile` package (imported lazily),
+      which compresses tiles in its own worker pool.
+    - Progressive or Huffman-optimized JPEG cannot be stitched from independent strips;
+      those options fall back to a single Pillow save.
+"""
+
+import io
+import logging
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# MCU (width, height) for Pillow's JPEG `subsampling` values 0 (4:4:4), 1 (4:2:2), 2 (4:2:0)
+MCU_SIZES = {0: (8, 8), 1: (16, 8), 2: (16, 16)}
+MAX_RESTART_INTERVAL = 65535
+SOF_MARKERS = (0xC0, 0xC1, 0xC2)
+
+def _split_jpeg(data):
+    """
+    Split a baseline JPEG into (header segments before SOS, SOS segment,
+    entropy-coded data). The trailing EOI is dropped.
+    """
+    pos = 2
+    segments = []
+    while True:
+        if data[pos] != 0xFF:
+            raise ValueError("Malformed JPEG: expected marker at offset %d" % pos)
+        marker = data[pos + 1]
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        segment = data[pos:pos + 2 + length]
+        pos += 2 + length
+        if marker == 0xDA:
+            end = data.rindex(b'\xff\xd9')
+            return segments, segment, data[pos:end]
+        segments.append(segment)
+
+def _patch_height(segments, height):
+    out = []
+    for seg in segments:
+        if seg[1] in SOF_MARKERS:
+            seg = seg[:5] + struct.pack('>H', height) + seg[7:]
+        out.append(seg)
+    return out
+
+def encode_jpeg_parallel(im, outfile, quality=90, subsampling=2, workers=None, rows_per_strip=None):
+    """
+    Encode im as one baseline JPEG by compressing horizontal strips in
+    parallel and joining their entropy-coded data with RSTn markers.
+    Every strip except the last is a whole number of MCU rows, and the
+    restart interval equals one strip, so the result is a standard JPEG.
+    """
+    width, height = im.size
+    mcu_w, mcu_h = MCU_SIZES[subsampling]
+    mcus_per_row = -(-width // mcu_w)
+    if mcus_per_row > MAX_RESTART_INTERVAL:
+        logger.warning("Image too wide for restart-marker stitching; encoding on one core.")
+        im.save(outfile, 'JPEG', quality=quality, subsampling=subsampling)
+        return
+    workers = workers or os.cpu_count() or 1
+    max_rows = MAX_RESTART_INTERVAL // mcus_per_row
+    if rows_per_strip is None:
+        mcu_rows = -(-height // mcu_h)
+        rows_per_strip = -(-mcu_rows // (4 * workers))
+    rows_per_strip = max(1, min(max_rows, rows_per_strip))
+    strip_h = rows_per_strip * mcu_h
+
+    def encode(top):
+        buf = io.BytesIO()
+        im.crop((0, top, width, min(height, top + strip_h))).save(
+            buf, 'JPEG', quality=quality, subsampling=subsampling, optimize=False, progressive=False)
+        return buf.getvalue()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        parts = list(executor.map(encode, range(0, height, strip_h)))
+
+    header, sos, _ = _split_jpeg(parts[0])
+    header = _patch_height(header, height)
+    dri = b'\xff\xdd' + struct.pack('>HH', 4, mcus_per_row * rows_per_strip)
+    with open(outfile, 'wb') as f:
+        f.write(b'\xff\xd8')
+        for seg in header:
+            f.write(seg)
+        f.write(dri)
+        f.write(sos)
+        for i, part in enumerate(parts):
+            f.write(_split_jpeg(part)[2])
+            if i < len(parts) - 1:
+                f.write(bytes((0xFF, 0xD0 + i % 8)))
+        f.write(b'\xff\xd9')
+
+def _save_jpeg(im, outfile, quality, progressive, optimize, workers):
+    if progressive or optimize:
+        im.save(outfile, 'JPEG', quality=quality, progressive=progressive, optimize=optimize)
+    else:
+        encode_jpeg_parallel(im, outfile, quality=quality, workers=workers)
+
+def _save_webp(im, outfile, quality):
+    if max(im.size) > 16383:
+        raise ValueError("WebP is limited to 16383 pixels per side (got %dx%d)" % im.size)
+    im.save(outfile, 'WEBP', quality=quality, method=4)
+
+def _save_tiff(im, outfile, workers):
+    import tifffile
+    data = np.asarray(im)
+    tifffile.imwrite(outfile, data, photometric='rgb', tile=(256, 256),
+                     compression='zlib', bigtiff=data.nbytes > 2 ** 32 - 2 ** 25,
+                     maxworkers=workers)
+
+def _save_web_copy(im, outfile, web_size, quality):
+    web = im.copy()
+    web.thumbnail((web_size, web_size), Image.ANTIALIAS)
+    web.save(outfile, 'JPEG', quality=quality, optimize=True, progressive=True)
+
+def export(im, outfile, formats=('jpg',), quality=90, progressive=False, optimize=False,
+           web_size=None, workers=None):
+    """
+    Write im in every requested format ('jpg', 'webp', 'tiff') next to
+    outfile, plus an optional web copy (longest side web_size) named
+    <base>_web.jpg. Formats are encoded concurrently and JPEG/TIFF also use
+    several cores each. Returns {format: {"path", "seconds", "bytes"}};
+    failed formats get an "error" entry instead.
+    """
+    workers = workers or os.cpu_count() or 1
+    base = os.path.splitext(outfile)[0]
+    jobs = {}
+    for fmt in formats:
+        fmt = fmt.lower().lstrip('.')
+        if fmt in ('jpg', 'jpeg'):
+            jobs['jpg'] = (base + '.jpg', _save_jpeg, (quality, progressive, optimize, workers))
+        elif fmt == 'webp':
+            jobs['webp'] = (base + '.webp', _save_webp, (quality,))
+        elif fmt in ('tif', 'tiff'):
+            jobs['tiff'] = (base + '.tif', _save_tiff, (workers,))
+        else:
+            raise ValueError("Unsupported export format: %s" % fmt)
+    if web_size:
+        jobs['web'] = (base + '_web.jpg', _save_web_copy, (web_size, min(quality, 85)))
+
+    def run(item):
+        name, (path, func, args) = item
+        start = time.perf_counter()
+        try:
+            func(im, path, *args)
+        except Exception as e:
+            logger.warning("Export to %s failed: %s", name, e)
+            return name, {"path": path, "error": str(e)}
+        report = {"path": path, "seconds": time.perf_counter() - start, "bytes": os.path.getsize(path)}
+        logger.info("Encoded %s in %.2f s (%d bytes)", name, report["seconds"], report["bytes"])
+        return name, report
+
+    with ThreadPoolExecutor(max_workers=len(jobs) or 1) as executor:
+        return dict(executor.map(run, jobs.items()))
@@ -0,0 +1,174 @@
+"""
+feature_store.py
+
+PURPOSE:
+    Local, memory-mapped pool store. Holds the pool feature matrices (.npy, float32), a compact
+    path table (one UTF-8 blob plus an offsets array) and a version stamp, so the engine can load
+    a pool zero-copy in milliseconds without contacting MongoDB.
+
+HOW IT COMMUNICATES:
+    - Written by photomosaic.py (ImagePool.pool with local_store, build_local_store, sync_local_store).
+    - Read by photomosaic.py (PhotoMosaic.load_pool with local_store).
+    - Reads and writes files below the store directory only.
+
+PATHS TO CHECK:
+    - The store directory must be on local disk and writable by the ingestion process.
+
+MODERNIZATION NOTES:
+    - Each version lives in its own subdirectory; a CURRENT file is swapped with os.replace,
+      so readers never observe a half-written store. The version it replaces is kept until the
+      next write, so a reader that has just read CURRENT can still map its arrays.
+    - Matrices are opened with np.load(mmap_mode='r'): pages are shared between worker processes.
+    - Dominant-colour shard ids (shards.py) are written next to each matrix, so a sharded
+      search over a local store needs no extra pass over the features.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .shards import shard_of
+
+logger = logging.getLogger(__name__)
+
+STORE_FORMAT = 1
+CURRENT = 'CURRENT'
+FEATURE_FILES = {'rgb': 'rgb.npy', 'lab': 'lab.npy'}
+SHARD_FILES = {'rgb': 'shards_rgb.npy', 'lab': 'shards_lab.npy'}
+
+class PathTable(object):
+    """
+    Immutable list of image paths stored as one UTF-8 blob and an int64
+    offsets array; strings are decoded on access.
+    """
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_paths(cls, paths):
+        encoded = [p.encode('utf-8') for p in paths]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return cls(b''.join(encoded), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class FeatureSnapshot(object):
+    """
+    One loaded version of a store: rgb/lab matrices, paths, version, an
+    optional boolean mask of active (not pruned) images and the shard id
+    arrays (None for stores written before sharding).
+    """
+    def __init__(self, rgb, lab, paths, version, meta=None, active=None, shards=None):
+        self.rgb = rgb
+        self.lab = lab
+        self.paths = paths
+        self.version = version
+        self.meta = meta or {}
+        self.active = active
+        self._shards = shards or {}
+
+    def features(self, color_space='rgb'):
+        return self.rgb if color_space == 'rgb' else self.lab
+
+    def shards(self, color_space='rgb'):
+        return self._shards.get('rgb' if color_space == 'rgb' else 'lab')
+
+    def __len__(self):
+        return len(self.paths)
+
+class LocalFeatureStore(object):
+    """
+    Versioned on-disk pool store.
+
+    Example usage:
+        store = LocalFeatureStore("/var/lib/mozay/pool")
+        store.write(rgb, lab, paths, version=3)
+        snap = store.load()
+        snap.features('lab')[i], snap.paths[i]
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def version(self):
+        """Version stamp of the current store, or None if nothing was written yet."""
+        try:
+            with open(os.path.join(self.directory, CURRENT)) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def write(self, rgb, lab, paths, version=None, active=None, **meta):
+        """
+        Write a new version and atomically make it current. The previous
+        version is kept for readers still opening it; older ones are removed
+        once the switch is done. active is an optional boolean mask of images
+        not pruned from the pool.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        previous = self.version()
+        if version is None:
+            version = (previous or 0) + 1
+        table = PathTable.from_paths(list(paths))
+        tmp = tempfile.mkdtemp(prefix='.v%d-' % version, dir=self.directory)
+        np.save(os.path.join(tmp, FEATURE_FILES['rgb']), np.ascontiguousarray(rgb, dtype='<f4'))
+        np.save(os.path.join(tmp, FEATURE_FILES['lab']), np.ascontiguousarray(lab, dtype='<f4'))
+        for color_space, features in (('rgb', rgb), ('lab', lab)):
+            np.save(os.path.join(tmp, SHARD_FILES[color_space]),
+                    shard_of(np.asarray(features).reshape(-1, 16, 3), color_space).astype(np.int16))
+        np.save(os.path.join(tmp, 'offsets.npy'), table.offsets)
+        with open(os.path.join(tmp, 'paths.bin'), 'wb') as f:
+            f.write(table.blob)
+        if active is not None:
+            np.save(os.path.join(tmp, 'active.npy'), np.asarray(active, dtype=bool))
+        meta.update({"format": STORE_FORMAT, "version": version, "count": len(table)})
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        final = os.path.join(self.directory, 'v%d' % version)
+        if os.path.exists(final):
+            shutil.rmtree(final)
+        os.rename(tmp, final)
+        pointer = os.path.join(self.directory, CURRENT + '.tmp')
+        with open(pointer, 'w') as f:
+            f.write(str(version))
+        os.replace(pointer, os.path.join(self.directory, CURRENT))
+        for name in os.listdir(self.directory):
+            if name[:1] == 'v' and name[1:].isdigit() and int(name[1:]) not in (version, previous):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        logger.info("Wrote local pool store version %d with %d images", version, len(table))
+        return version
+
+    def load(self):
+        """Memory-map the current version. Returns a FeatureSnapshot."""
+        version = self.version()
+        if version is None:
+            raise IOError("No pool store in %s" % self.directory)
+        path = os.path.join(self.directory, 'v%d' % version)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        rgb = np.load(os.path.join(path, FEATURE_FILES['rgb']), mmap_mode='r')
+        lab = np.load(os.path.join(path, FEATURE_FILES['lab']), mmap_mode='r')
+        offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        if os.path.getsize(os.path.join(path, 'paths.bin')):
+            blob = np.memmap(os.path.join(path, 'paths.bin'), dtype=np.uint8, mode='r')
+        else:
+            blob = b''
+        active = None
+        if os.path.exists(os.path.join(path, 'active.npy')):
+            active = np.load(os.path.join(path, 'active.npy'), mmap_mode='r')
+        shards = dict((color_space, np.load(os.path.join(path, name), mmap_mode='r'))
+                      for color_space, name in SHARD_FILES.items() if os.path.exists(os.path.join(path, name)))
+        return FeatureSnapshot(rgb, lab, PathTable(blob, offsets), version, meta, active, shards)
@@ -0,0 +1,127 @@
+"""
+features.py
+
+PURPOSE:
+    Compact on-disk encoding for pool features (the 4x4 region averages stored as avgRGB/avgLab).
+    Features are stored as contiguous little-endian float32 bytes, tagged with a schema version,
+    and decoded with np.frombuffer straight into a preallocated float32 pool matrix.
+
+HOW IT COMMUNICATES:
+    - Used by photomosaic.py when writing (analyze_pool_image) and reading (load_pool) image_pool documents.
+    - Used by migrate_pool_features() and the `migrate_pool_features` management command to
+      convert legacy pickled documents in place.
+    - No direct file or database access of its own.
+
+PATHS TO CHECK:
+    - No paths to configure.
+
+MODERNIZATION NOTES:
+    - Schema 1 halves the payload of the legacy pickled float64 arrays and keeps pickle out
+      of the load path. Legacy documents (no "featureSchema" field) are still readable.
+    - Decoded pools stay float32 in memory too (half the float64 matrix). Distances against a
+      float64 query are still accumulated in float64 by numpy's type promotion.
+"""
+
+import itertools
+import logging
+import pickle
+
+import numpy as np
+from bson.binary import Binary
+
+logger = logging.getLogger(__name__)
+
+FEATURE_SCHEMA_VERSION = 1
+FEATURE_DTYPE = np.dtype('<f4')
+# 4x4 regions, 3 channels
+FEATURE_SHAPE = (16, 3)
+FEATURE_FIELDS = {'rgb': 'avgRGB', 'lab': 'avgLab'}
+
+def feature_field(color_space):
+    return FEATURE_FIELDS['rgb' if color_space == 'rgb' else 'lab']
+
+def encode_features(values):
+    """Encode a (16, 3) feature array as raw little-endian float32 bytes."""
+    return Binary(np.ascontiguousarray(values, dtype=FEATURE_DTYPE).tobytes())
+
+def decode_features(doc, field, out=None):
+    """
+    Decode one document's feature field. With out given (a row of a
+    preallocated pool matrix), the values are written into it in place.
+    """
+    blob = doc[field]
+    if doc.get("featureSchema") == FEATURE_SCHEMA_VERSION:
+        values = np.frombuffer(blob, dtype=FEATURE_DTYPE).reshape(FEATURE_SHAPE)
+    else:
+        values = np.asarray(pickle.loads(blob)).reshape(FEATURE_SHAPE)
+    if out is None:
+        return values.astype(FEATURE_DTYPE, copy=False)
+    out[...] = values
+    return out
+
+def decode_pool(docs, field, count=None):
+    """
+    Decode an iterable of image_pool documents into an (n, 16, 3) matrix
+    and the matching list of image paths. count preallocates the matrix;
+    it grows if more documents arrive.
+    """
+    matrix = np.empty((count or 0,) + FEATURE_SHAPE, dtype=FEATURE_DTYPE)
+    paths = []
+    legacy = 0
+    for i, doc in enumerate(docs):
+        if i >= matrix.shape[0]:
+            matrix = np.resize(matrix, (max(16, 2 * matrix.shape[0]),) + FEATURE_SHAPE)
+        decode_features(doc, field, matrix[i])
+        if doc.get("featureSchema") != FEATURE_SCHEMA_VERSION:
+            legacy += 1
+        paths.append(doc["imgsrc"])
+    if legacy:
+        logger.warning("%d pool documents still use pickled features; run migrate_pool_features.", legacy)
+    return matrix[:len(paths)], paths
+
+def decode_pool_into(docs, field, out):
+    """
+    Decode documents straight into the rows of a preallocated matrix.
+    Returns (paths, extra): paths of the rows written, and the
+    decode_pool() result for any documents beyond out's capacity (None if
+    everything fitted).
+    """
+    paths = []
+    docs = iter(docs)
+    legacy = 0
+    for doc in docs:
+        if len(paths) == len(out):
+            return paths, decode_pool(itertools.chain([doc], docs), field)
+        decode_features(doc, field, out[len(paths)])
+        if doc.get("featureSchema") != FEATURE_SCHEMA_VERSION:
+            legacy += 1
+        paths.append(doc["imgsrc"])
+    if legacy:
+        logger.warning("%d pool documents still use pickled features; run migrate_pool_features.", legacy)
+    return paths, None
+
+def migrate_pool_features(image_pool, batch_size=1000):
+    """
+    Rewrite legacy pickled avgRGB/avgLab blobs in place as schema-1 float32
+    bytes, one bulk_write per batch. Safe to re-run. Returns the number of
+    documents migrated.
+    """
+    from pymongo import UpdateOne
+
+    query = {"featureSchema": {"$ne": FEATURE_SCHEMA_VERSION}}
+    projection = {"avgRGB": 1, "avgLab": 1}
+    migrated = 0
+    ops = []
+    for doc in image_pool.find(query, projection, batch_size=batch_size):
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {
+            "avgRGB": encode_features(pickle.loads(doc["avgRGB"])),
+            "avgLab": encode_features(pickle.loads(doc["avgLab"])),
+            "featureSchema": FEATURE_SCHEMA_VERSION,
+        }}))
+        if len(ops) >= batch_size:
+            migrated += image_pool.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        migrated += image_pool.bulk_write(ops, ordered=False).modified_count
+    logger.info("Migrated %d pool documents to feature schema %d", migrated, FEATURE_SCHEMA_VERSION)
+    return migrated
@@ -0,0 +1,173 @@
+"""
+ingest.py
+
+PURPOSE:
+    Implements the IngestPipeline class, the streaming pool ingestion used by ImagePool: a walker
+    feeds paths through a bounded window into a process pool that decodes and analyzes images,
+    and a single writer batches the resulting documents into the PoolStore.
+
+HOW IT COMMUNICATES:
+    - Used by photomosaic.py (ImagePool.pool), which supplies the analyze function.
+    - Only the writer (the calling process) talks to the PoolStore and the tile pack; workers just
+      read image files and return documents (with an encoded thumbnail when a pack is configured).
+
+PATHS TO CHECK:
+    - Image paths must be readable by every worker process.
+
+MODERNIZATION NOTES:
+    - Work is handed out one image at a time, so a folder of huge files no longer pins a single
+      process while the others sit idle.
+    - At most max_pending images are queued or in flight; the walker blocks when workers fall behind.
+    - Throughput (images/s) is logged every report_interval seconds.
+    - Thumbnails are appended to the tile pack only for documents the writer accepted, so
+      duplicates never grow the pack.
+    - Files are read and hashed once, by the worker that analyzes them; the writer drops exact
+      duplicates by that hash (pooled or seen earlier in the run) before writing.
+    - Resumable: paths already in the store are skipped in batches, and on_batch(paths, hashes)
+      is called after each write with the paths analyzed (inserted or duplicate) and their content
+      hashes, so callers can checkpoint without re-reading files (ImagePool commits its scanner
+      manifest there). Failed paths are left out and retried on the next run.
+"""
+
+import logging
+import queue
+import time
+from multiprocessing import Pool, cpu_count
+
+from .dedupe import PerceptualIndex
+from .tilepack import open_pack
+
+logger = logging.getLogger(__name__)
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class IngestPipeline(object):
+    """
+    Streams paths through analyze(path) -> document in a worker pool and
+    writes the documents to store in batches. With tile_pack, the
+    "thumbnail" each document carries (see TilePack.encode) is appended to
+    the pack once the document is written, and never reaches the store.
+
+    Example usage:
+        pipeline = IngestPipeline(store, analyze_pool_image, workers=8)
+        stats = pipeline.run(paths)
+    """
+    def __init__(self, store, analyze, workers=None, batch_size=500, max_pending=None,
+                 near_duplicates=0, report_interval=10, on_batch=None, tile_pack=None):
+        self.store = store
+        self.analyze = analyze
+        self.workers = workers or cpu_count()
+        self.batch_size = batch_size
+        self.max_pending = max_pending or 4 * self.workers
+        self.near_duplicates = near_duplicates
+        self.report_interval = report_interval
+        self.on_batch = on_batch
+        self.tile_pack = open_pack(tile_pack)
+        self.stats = {"known": 0, "analyzed": 0, "failed": 0, "duplicates": 0, "inserted": 0}
+
+    def _candidates(self, paths):
+        """Drop paths already in the store, one known_paths() lookup per batch."""
+        for batch in _batches(paths, self.batch_size):
+            known = self.store.known_paths(batch)
+            self.stats["known"] += len(known)
+            for path in batch:
+                if path not in known:
+                    yield path
+
+    def run(self, paths):
+        """Ingest every path from the iterable. Returns the stats dict."""
+        self._start = self._last_report = time.perf_counter()
+        self._seen = set()
+        self._index = None
+        if self.near_duplicates:
+            self._index = PerceptualIndex(self.store.perceptual_hashes(), self.near_duplicates)
+        results = queue.Queue()
+        docs, processed = [], []
+        inflight = 0
+        with Pool(self.workers) as workers:
+            def drain(block):
+                nonlocal inflight
+                while inflight:
+                    try:
+                        path, doc = results.get(block=block, timeout=None)
+                    except queue.Empty:
+                        return
+                    inflight -= 1
+                    block = False
+                    if doc is None:
+                        self.stats["failed"] += 1
+                    else:
+                        self.stats["analyzed"] += 1
+                        processed.append(path)
+                        docs.append(doc)
+                    self._report()
+                    if len(processed) >= self.batch_size:
+                        self._write(docs, processed)
+                        del docs[:], processed[:]
+
+            for path in self._candidates(paths):
+                while inflight >= self.max_pending:
+                    drain(True)
+                workers.apply_async(_analyze_one, (self.analyze, path), callback=results.put,
+                                    error_callback=lambda e, path=path: results.put((path, None)))
+                inflight += 1
+                drain(False)
+            while inflight:
+                drain(True)
+        self._write(docs, processed)
+        elapsed = time.perf_counter() - self._start
+        self.stats["seconds"] = round(elapsed, 2)
+        self.stats["rate"] = round(self.stats["analyzed"] / elapsed, 1) if elapsed else 0.0
+        logger.info("Ingestion done: %(inserted)d inserted, %(duplicates)d duplicates, %(known)d already pooled, "
+                    "%(failed)d failed, %(rate).1f images/s", self.stats)
+        return self.stats
+
+    def _write(self, docs, processed):
+        if not processed:
+            return
+        hashes = [doc["hash"] for doc in docs if doc.get("hash")]
+        pooled = self.store.known_hashes(hashes) if hashes else set()
+        fresh, thumbnails = [], []
+        for doc in docs:
+            thumbnail = doc.pop("thumbnail", None)
+            if doc.get("hash") in pooled or doc.get("hash") in self._seen:
+                self.stats["duplicates"] += 1
+                continue
+            self._seen.add(doc.get("hash"))
+            if self._index is not None and doc.get("phash") is not None:
+                if self._index.find(doc["phash"]) is not None:
+                    self.stats["duplicates"] += 1
+                    continue
+                self._index.add(doc["phash"])
+            fresh.append(doc)
+            if thumbnail is not None:
+                thumbnails.append((doc["imgsrc"], thumbnail))
+        self.stats["inserted"] += self.store.add_batch(fresh)
+        if self.tile_pack is not None:
+            for path, thumbnail in thumbnails:
+                self.tile_pack.append_encoded(path, *thumbnail)
+        if self.on_batch is not None:
+            self.on_batch(list(processed), dict((doc["imgsrc"], doc.get("hash")) for doc in docs))
+
+    def _report(self):
+        now = time.perf_counter()
+        if now - self._last_report >= self.report_interval:
+            self._last_report = now
+            logger.info("%d images analyzed (%.1f images/s), %d inserted",
+                        self.stats["analyzed"], self.stats["analyzed"] / (now - self._start),
+                        self.stats["inserted"])
+
+def _analyze_one(analyze, path):
+    try:
+        return path, analyze(path)
+    except Exception as e:
+        logger.warning("Cannot analyze %s: %s", path, e)
+        return path, None
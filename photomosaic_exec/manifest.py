@@ -0,0 +1,112 @@
+"""
+manifest.py
+
+PURPOSE:
+    Encodes and decodes placement manifests: a compact description of a finished match
+    (canvas size, tile positions and sizes, pool image ids, fade parameters) that a browser
+    can composite on a <canvas> from cached pool thumbnails, instead of the server compositing
+    every pixel. The full raster can still be produced lazily with photomosaic.render_manifest().
+
+HOW IT COMMUNICATES:
+    - Manifests are built by photomosaic.py (PhotoMosaic.placement_manifest) after choose_match().
+    - Used by mosaic/tasks.py to publish manifests and to render the raster on download.
+    - The stored manifest lists pool image paths; the copy published to the browser
+      (browser_manifest) lists thumbnail URLs keyed by tile_id(), served by the mosaic app
+      (views.pool_tile).
+    - No file or database access of its own.
+
+PATHS TO CHECK:
+    - No paths to configure.
+
+MODERNIZATION NOTES:
+    - JSON for the browser; a little-endian binary form (magic b'MZM3') for storage,
+      with placements as a flat int32 array readable via np.frombuffer.
+    - Version 2 adds the tile orientation (orientations.py) as a sixth placement field;
+      version 1 manifests (b'MZM1', five fields) still decode, with orientation 0.
+    - Version 3 stores the tile grid in the binary header, so both forms round-trip the same
+      dict; b'MZM2' manifests decode without a grid.
+"""
+
+import hashlib
+import json
+import logging
+import struct
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 3
+BINARY_MAGIC = b'MZM3'
+# width, height, factor, pool count, placement count, fade, grid columns, grid rows
+BINARY_HEADER = struct.Struct('<4sIIIIIfII')
+LEGACY_HEADER = struct.Struct('<4sIIIIIf')
+# magic: (manifest version, placement fields)
+LEGACY_MAGIC = {b'MZM1': (1, 5), b'MZM2': (2, 6)}
+# x, y, width, height, pool index, orientation per placement
+PLACEMENT_FIELDS = 6
+
+def encode_manifest(manifest, fmt='json'):
+    """Serialize a manifest dict to bytes, as 'json' or 'binary'."""
+    if fmt == 'json':
+        return json.dumps(manifest, separators=(',', ':')).encode('utf-8')
+    if fmt != 'binary':
+        raise ValueError("Unknown manifest format: %s" % fmt)
+    placements = np.zeros((len(manifest["placements"]), PLACEMENT_FIELDS), dtype='<i4')
+    for i, p in enumerate(manifest["placements"]):
+        placements[i, :len(p)] = p
+    pool = [p.encode('utf-8') for p in manifest["pool"]]
+    source = (manifest.get("source") or '').encode('utf-8')
+    grid = manifest.get("grid") or (0, 0)
+    parts = [BINARY_HEADER.pack(BINARY_MAGIC, manifest["width"], manifest["height"], manifest["factor"],
+                                len(pool), len(placements), manifest.get("fade") or 0.0, grid[0], grid[1])]
+    for blob in pool + [source]:
+        parts.append(struct.pack('<I', len(blob)))
+        parts.append(blob)
+    parts.append(placements.tobytes())
+    return b''.join(parts)
+
+def decode_manifest(data):
+    """Inverse of encode_manifest(); accepts either format."""
+    if isinstance(data, str):
+        return json.loads(data)
+    if data[:len(BINARY_MAGIC)] not in (BINARY_MAGIC,) + tuple(LEGACY_MAGIC):
+        return json.loads(data.decode('utf-8'))
+    magic = data[:len(BINARY_MAGIC)]
+    if magic in LEGACY_MAGIC:
+        version, fields = LEGACY_MAGIC[magic]
+        _, width, height, factor, npool, nplace, fade = LEGACY_HEADER.unpack_from(data, 0)
+        grid, offset = None, LEGACY_HEADER.size
+    else:
+        version, fields = MANIFEST_VERSION, PLACEMENT_FIELDS
+        _, width, height, factor, npool, nplace, fade, columns, rows = BINARY_HEADER.unpack_from(data, 0)
+        grid, offset = ([columns, rows] if columns or rows else None), BINARY_HEADER.size
+    strings = []
+    for _ in range(npool + 1):
+        (length,) = struct.unpack_from('<I', data, offset)
+        offset += 4
+        strings.append(data[offset:offset + length].decode('utf-8'))
+        offset += length
+    placements = np.frombuffer(data, dtype='<i4', count=nplace * fields, offset=offset)
+    return {
+        "version": version,
+        "width": width,
+        "height": height,
+        "factor": factor,
+        "grid": grid,
+        "fade": round(fade, 4) or None,
+        "source": strings[-1] or None,
+        "pool": strings[:-1],
+        "placements": placements.reshape(-1, fields).tolist(),
+    }
+
+def tile_id(path):
+    """Opaque id of a pool image in browser manifests (no server paths leave the server)."""
+    return hashlib.sha1(path.encode('utf-8')).hexdigest()
+
+def browser_manifest(manifest, tile_url):
+    """
+    Copy of manifest for the browser: pool paths are replaced by thumbnail
+    URLs, tile_url being a format string with one {} for the tile_id().
+    """
+    return dict(manifest, pool=[tile_url.format(tile_id(path)) for path in manifest["pool"]])
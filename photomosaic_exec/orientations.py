@@ -0,0 +1,73 @@
+"""
+orientations.py
+
+PURPOSE:
+    Flipped and rotated variants of pool images. Mirroring or rotating an image by 90 degrees
+    only reorders its 4x4 region averages (the grid split_regions() produces), so up to 8
+    oriented variants of every pool image can be matched from the stored features, and the
+    renderer applies the orientation to the decoded thumbnail at paste time.
+
+HOW IT COMMUNICATES:
+    - Used by photomosaic.py: choose_match(orientations=...) matches against the variants,
+      Tile.orientation records the chosen one, and the renderers / render_manifest() call
+      orient_image() before pasting.
+    - No file or database access of its own.
+
+PATHS TO CHECK:
+    - No paths to configure.
+
+MODERNIZATION NOTES:
+    - Orientation ids follow the order of ORIENTATION_TRANSPOSE (Pillow transpose methods):
+      the first 2 or 4 keep the image's aspect ratio, the last 4 swap width and height and are
+      meant for square tiles.
+    - Variants are never materialized: the distance from a tile to variant o of an image equals
+      the distance from the inversely permuted tile to the stored features, so matching against
+      k orientations costs k distance passes over the unchanged pool matrix.
+"""
+
+import logging
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+ORIENTATION_TRANSPOSE = [None, Image.FLIP_LEFT_RIGHT, Image.FLIP_TOP_BOTTOM, Image.ROTATE_180,
+                         Image.TRANSPOSE, Image.ROTATE_90, Image.ROTATE_270, Image.TRANSVERSE]
+ORIENTATION_COUNTS = (1, 2, 4, 8)
+
+def _grid_permutation(orientation, split=4):
+    grid = np.arange(split * split).reshape(split, split)
+    oriented = [grid, grid[:, ::-1], grid[::-1, :], grid[::-1, ::-1],
+                grid.T, np.rot90(grid, 1), np.rot90(grid, 3), grid[::-1, ::-1].T][orientation]
+    return oriented.reshape(-1)
+
+# Region i of variant o is region PERMUTATIONS[o][i] of the original.
+PERMUTATIONS = [_grid_permutation(o) for o in range(len(ORIENTATION_TRANSPOSE))]
+INVERSE_PERMUTATIONS = [np.argsort(p) for p in PERMUTATIONS]
+
+def orientation_set(count):
+    """Orientation ids used when matching against count variants per image (1, 2, 4 or 8)."""
+    if count not in ORIENTATION_COUNTS:
+        raise ValueError("orientations must be one of %s" % (ORIENTATION_COUNTS,))
+    return list(range(count))
+
+def orient_features(features, orientation):
+    """Features of an oriented image, from a (16, 3) grid or an (n, 16, 3) matrix."""
+    if not orientation:
+        return features
+    return np.asarray(features)[..., PERMUTATIONS[orientation], :]
+
+def query_variants(query, orientations):
+    """
+    One query per orientation: distance(query_variants(q)[k], f) equals
+    distance(q, orient_features(f, orientations[k])).
+    """
+    query = np.asarray(query)
+    return [query if not o else query[..., INVERSE_PERMUTATIONS[o], :] for o in orientations]
+
+def orient_image(img, orientation):
+    """Apply an orientation id to a Pillow image."""
+    if not orientation or img is None:
+        return img
+    return img.transpose(ORIENTATION_TRANSPOSE[orientation])
@@ -0,0 +1,248 @@
+"""
+pool_cache.py
+
+PURPOSE:
+    Worker-resident pool snapshots. Each worker process keeps the decoded pool matrix, the path
+    table and any search index built over them in memory across tasks, and only rebuilds when
+    the pool version counter (bumped by ingestion) changes. Small changes are applied in place:
+    new images are appended, removed ones are tombstoned, and the snapshot is compacted in the
+    background once tombstones pile up.
+
+HOW IT COMMUNICATES:
+    - Used by photomosaic.py (PhotoMosaic.load_pool) for every job.
+    - Talks to the pool through the PoolStore interface (pool_store.py): one version lookup per
+      task when the cache is current, changes_since() + features_for() for the new images when
+      the store's change log covers the gap, a full features() load otherwise.
+    - Optionally refreshes and memory-maps a LocalFeatureStore (feature_store.py).
+
+PATHS TO CHECK:
+    - Local store directories, if used, must be readable by every worker.
+
+MODERNIZATION NOTES:
+    - Plain module-level dict guarded by a lock; Celery prefork children each hold their own copy
+      and inherit whatever the parent had loaded before fork.
+    - Appends go into spare capacity of the feature buffer (grown geometrically), so adding a
+      hundred images to a million-image snapshot costs a few milliseconds, not a reload.
+    - Snapshots are never mutated once published: apply() returns a new snapshot, so jobs that
+      already hold the old one keep a consistent view.
+"""
+
+import logging
+import threading
+import time
+
+import numpy as np
+
+from .feature_store import LocalFeatureStore
+from .pool_store import resolve_store
+
+logger = logging.getLogger(__name__)
+
+_snapshots = {}
+_lock = threading.Lock()
+stats = {"hits": 0, "misses": 0, "incremental": 0, "compactions": 0}
+
+# Compact a snapshot in the background once this share of its rows are tombstones.
+COMPACT_THRESHOLD = 0.2
+# Fall back to a full reload when a delta would touch more than this share of the pool.
+MAX_DELTA_FRACTION = 0.5
+
+class PoolSnapshot(object):
+    """
+    Decoded pool for one colour space at one version, plus any search
+    indexes built over it (see get_index).
+
+    Rows of removed images stay in features/paths until compaction;
+    alive marks the rows that are still in the pool (None when all are).
+    Use live() for a tombstone-free view. shards holds the shard ids
+    stored with the pool (local store or PoolStore documents), or None
+    when they have to be computed from the features.
+    """
+    def __init__(self, features, paths, version, alive=None, _buffer=None, shards=None):
+        self.features = features
+        self.paths = paths
+        self.version = version
+        self.alive = alive
+        self.shards = shards
+        self._buffer = _buffer if _buffer is not None else [features, len(features)]
+        self._rows = None
+        self._indexes = {}
+        self._index_lock = threading.Lock()
+
+    def get_index(self, name, build):
+        """Return the index called name, building it with build(snapshot) once per version."""
+        with self._index_lock:
+            if name not in self._indexes:
+                self._indexes[name] = build(self)
+            return self._indexes[name]
+
+    def __len__(self):
+        return len(self.paths) - self.dead
+
+    @property
+    def dead(self):
+        """Number of tombstoned rows."""
+        return 0 if self.alive is None else int(len(self.alive) - self.alive.sum())
+
+    def live(self):
+        """(features, paths) of the rows still in the pool."""
+        if not self.dead:
+            return self.features, self.paths
+        rows = np.flatnonzero(self.alive)
+        return self.features[rows], [self.paths[i] for i in rows]
+
+    def rows(self):
+        """path -> row of the live rows, built on first use."""
+        if self._rows is None:
+            alive = self.alive
+            self._rows = dict((p, i) for i, p in enumerate(self.paths) if alive is None or alive[i])
+        return self._rows
+
+    def _append(self, features):
+        """
+        Features matrix with rows appended, reusing spare buffer capacity
+        when no other snapshot has appended past this one.
+        """
+        buffer, used = self._buffer
+        n, k = len(self.features), len(features)
+        if used != n or n + k > len(buffer):
+            capacity = max(n + k, int(1.5 * n) + 16)
+            grown = np.empty((capacity,) + self.features.shape[1:], dtype=self.features.dtype)
+            grown[:n] = self.features
+            self._buffer = holder = [grown, n]
+        else:
+            holder = self._buffer
+        holder[0][n:n + k] = features
+        holder[1] = n + k
+        return holder[0][:n + k], holder
+
+    def apply(self, changes, version, fetch):
+        """
+        New snapshot at version with changes (as from PoolStore.changes_since)
+        applied; fetch(paths) returns (features, paths) of added images.
+        Indexes that have an apply(snapshot, start) method are carried over,
+        others are rebuilt on demand.
+        """
+        rows = dict(self.rows())
+        alive = np.ones(len(self.paths), dtype=bool) if self.alive is None else self.alive.copy()
+        added = []
+        for kind, paths in changes:
+            for path in paths:
+                row = rows.pop(path, None)
+                if row is not None:
+                    alive[row] = False
+                elif kind == 'remove' and path in added:
+                    added.remove(path)
+            if kind == 'add':
+                added.extend(paths)
+        features, paths = fetch(added) if added else (self.features[:0], [])
+        start = len(self.paths)
+        with self._index_lock:
+            matrix, holder = self._append(features) if len(paths) else (self.features, self._buffer)
+        alive = np.concatenate([alive, np.ones(len(paths), dtype=bool)])
+        rows.update((p, start + i) for i, p in enumerate(paths))
+        snapshot = PoolSnapshot(matrix, self.paths + list(paths), version, alive if not alive.all() else None, holder)
+        snapshot._rows = rows
+        with self._index_lock:
+            for name, index in self._indexes.items():
+                if hasattr(index, 'apply'):
+                    snapshot._indexes[name] = index.apply(snapshot, start)
+        return snapshot
+
+    def compacted(self):
+        """Copy of this snapshot without tombstoned rows (indexes are rebuilt on demand)."""
+        features, paths = self.live()
+        return PoolSnapshot(np.ascontiguousarray(features), list(paths), self.version)
+
+def sync_local_store(pool, store_dir, force=False):
+    """
+    Refresh a LocalFeatureStore from a PoolStore (or database name) when its
+    version stamp differs from the pool's version. Costs a single version
+    lookup when the cache is current. Returns the version.
+    """
+    pool = resolve_store(pool)
+    store = LocalFeatureStore(store_dir)
+    version = pool.version()
+    if not force and store.version() == version:
+        return version
+    rgb, paths = pool.features('rgb')
+    lab, _ = pool.features('lab')
+    inactive = pool.inactive_paths()
+    active = [p not in inactive for p in paths] if inactive else None
+    return store.write(rgb, lab, paths, version=version, active=active,
+                       source=getattr(pool, 'db_name', type(pool).__name__))
+
+def get_snapshot(pool, color_space='rgb', local_store=None, active_only=False):
+    """
+    Return the worker's PoolSnapshot for pool, rebuilding it only when the
+    pool version differs from the cached one. pool may be a PoolStore, a
+    database name, or None together with local_store (offline mode).
+    With active_only, images pruned from the pool are left out.
+    """
+    store = resolve_store(pool)
+    key = (store.cache_key() if store is not None else None, local_store, color_space, active_only)
+    if store is not None:
+        version = store.version()
+    else:
+        version = LocalFeatureStore(local_store).version()
+    with _lock:
+        cached = _snapshots.get(key)
+        if cached is not None and cached.version == version:
+            stats["hits"] += 1
+            return cached
+        stats["misses"] += 1
+    start = time.perf_counter()
+    if cached is not None and store is not None and not local_store:
+        snapshot = _apply_changes(store, cached, version, color_space)
+        if snapshot is not None:
+            with _lock:
+                if _snapshots.get(key) is cached:
+                    _snapshots[key] = snapshot
+                stats["incremental"] += 1
+            logger.info("Updated pool snapshot %s -> %s (%d images, %d tombstones) in %.3f s",
+                        cached.version, version, len(snapshot), snapshot.dead, time.perf_counter() - start)
+            if snapshot.dead > COMPACT_THRESHOLD * len(snapshot.paths):
+                threading.Thread(target=_compact, args=(key, snapshot), daemon=True).start()
+            return snapshot
+    if local_store:
+        if store is not None:
+            sync_local_store(store, local_store)
+        local = LocalFeatureStore(local_store).load()
+        shards = local.shards(color_space)
+        if active_only and local.active is not None:
+            rows = np.flatnonzero(local.active)
+            snapshot = PoolSnapshot(local.features(color_space)[rows], [local.paths[i] for i in rows], version,
+                                    shards=shards[rows] if shards is not None else None)
+        else:
+            snapshot = PoolSnapshot(local.features(color_space), local.paths, version, shards=shards)
+    else:
+        features, paths, shards = store.features(color_space, active_only=active_only, shards=True)
+        snapshot = PoolSnapshot(features, paths, version, shards=shards)
+    with _lock:
+        _snapshots[key] = snapshot
+    logger.info("Loaded pool snapshot version %s (%d images) in %.2f s",
+                version, len(snapshot), time.perf_counter() - start)
+    return snapshot
+
+def _apply_changes(store, cached, version, color_space):
+    """cached brought up to version from the store's change log, or None if it cannot be."""
+    if version < cached.version:
+        return None
+    changes = store.changes_since(cached.version, version)
+    if changes is None or sum(len(paths) for _, paths in changes) > MAX_DELTA_FRACTION * max(1, len(cached)):
+        return None
+    return cached.apply(changes, version, lambda paths: store.features_for(paths, color_space))
+
+def _compact(key, snapshot):
+    """Swap a compacted copy of snapshot into the cache unless it has moved on meanwhile."""
+    compacted = snapshot.compacted()
+    with _lock:
+        if _snapshots.get(key) is snapshot:
+            _snapshots[key] = compacted
+            stats["compactions"] += 1
+    logger.info("Compacted pool snapshot version %s: %d tombstones dropped", snapshot.version, snapshot.dead)
+
+def clear():
+    """Drop every cached snapshot in this process."""
+    with _lock:
+        _snapshots.clear()
@@ -0,0 +1,689 @@
+"""
+pool_store.py
+
+PURPOSE:
+    Defines the PoolStore interface the photomosaic engine uses for its image pool
+    (list features, add a batch, update usage, version) and three implementations:
+        MongoPoolStore  -> MongoDB Atlas image_pool collection (production)
+        SQLitePoolStore -> single local SQLite file (offline use, benchmarks)
+        MemoryPoolStore -> in-process dicts (tests)
+
+HOW IT COMMUNICATES:
+    - Used by photomosaic.py (PhotoMosaic, ImagePool, reset_usage) and ingest.py (IngestPipeline).
+    - MongoPoolStore connects to MONGO_ATLAS_URI through one pooled, fork-aware
+      MongoClient per process (see get_mongo_client).
+    - SQLitePoolStore reads and writes a local database file.
+
+PATHS TO CHECK:
+    - MONGO_ATLAS_URI must be set in the environment (or .env) for MongoPoolStore.
+    - The SQLite file's directory must be writable.
+
+MODERNIZATION NOTES:
+    - Documents share one shape across stores: imgsrc, hash, phash, avgRGB, avgLab, featureSchema, usage,
+      and an optional active flag (false once pruned).
+    - Clients and SQLite connections are tied to the creating process id and re-created after
+      fork, so store objects can be handed to multiprocessing workers safely.
+    - Every version bump is logged (pool_log) with the paths added or removed, so worker
+      snapshots can be updated incrementally (see changes_since and pool_cache.py).
+    - Usage is written once per job: one batched update of the cumulative usage counters plus
+      one per-job record (pool_usage). Recording the same job twice is a no-op, so retried
+      tasks do not double count.
+"""
+
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from .features import FEATURE_DTYPE, FEATURE_SHAPE, decode_pool, decode_pool_into, feature_field
+from .shards import shard_field
+
+logger = logging.getLogger(__name__)
+
+MONGO_ATLAS_URI = os.environ.get('MONGO_ATLAS_URI', '')
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '20'))
+# Feature loads: documents per cursor batch, and parallel _id-range cursors.
+MONGO_LOAD_BATCH_SIZE = int(os.environ.get('MONGO_LOAD_BATCH_SIZE', '10000'))
+MONGO_LOAD_PARTITIONS = int(os.environ.get('MONGO_LOAD_PARTITIONS', '4'))
+
+_clients = {}
+_clients_lock = threading.Lock()
+# Per-instance cache keys: id() is reused once a store is garbage collected.
+_store_tokens = itertools.count()
+
+def get_mongo_client(uri=None):
+    """
+    Process-wide MongoClient for uri, with connection pooling. A client
+    created before fork is never reused in the child: a new one is opened
+    the first time the child asks for it.
+    """
+    from pymongo import MongoClient
+
+    uri = uri or MONGO_ATLAS_URI
+    if not uri:
+        raise RuntimeError("MONGO_ATLAS_URI environment variable not set")
+    key = (os.getpid(), uri)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            for stale in [k for k in _clients if k[0] != key[0]]:
+                del _clients[stale]
+            client = MongoClient(uri, maxPoolSize=MONGO_MAX_POOL_SIZE, connect=False)
+            _clients[key] = client
+        return client
+
+class PoolStore(object):
+    """
+    Interface for image pool storage. Subclasses implement the methods
+    below; the engine depends only on these.
+    """
+
+    def features(self, color_space='rgb', active_only=False, shards=False):
+        """
+        Return (matrix of shape (n, 16, 3), list of image paths). With
+        active_only, images flagged inactive by set_inactive() are left out.
+        With shards=True, returns (matrix, paths, shard ids), the ids being
+        the stored shardRGB / shardLab values in row order (None if any
+        document lacks them; see shards.py).
+        """
+        raise NotImplementedError
+
+    def known_paths(self, paths):
+        """Return the subset of paths already in the pool."""
+        raise NotImplementedError
+
+    def known_hashes(self, hashes):
+        """Return the subset of content hashes already in the pool."""
+        raise NotImplementedError
+
+    def perceptual_hashes(self):
+        """Return the perceptual hashes (phash) of every image that has one."""
+        raise NotImplementedError
+
+    def add_batch(self, docs):
+        """Insert documents, skipping duplicates. Returns the number inserted."""
+        raise NotImplementedError
+
+    def remove_paths(self, paths):
+        """Delete the given images from the pool. Returns the number removed."""
+        raise NotImplementedError
+
+    def set_inactive(self, paths):
+        """
+        Flag exactly these images as inactive (pruned, see coreset.py); every
+        other image becomes active again. Nothing is deleted.
+        """
+        raise NotImplementedError
+
+    def inactive_paths(self):
+        """Return the set of images currently flagged inactive."""
+        raise NotImplementedError
+
+    def update_usage(self, counts, job=None):
+        """
+        Add {imgsrc: count} to each image's usage in one batched write. With
+        job (a task id), the counts are also kept as that job's usage, and a
+        job that was already recorded is skipped. Returns True if written.
+        """
+        raise NotImplementedError
+
+    def usage(self):
+        """{imgsrc: cumulative usage} of every image used at least once."""
+        raise NotImplementedError
+
+    def job_usage(self, job):
+        """{imgsrc: count} recorded for job ({} if unknown)."""
+        raise NotImplementedError
+
+    def reset_usage(self):
+        raise NotImplementedError
+
+    def version(self):
+        """Pool version counter; changes whenever images are added, removed or (de)activated."""
+        raise NotImplementedError
+
+    def changes_since(self, since, until):
+        """
+        Change log between two versions: a list of ('add' | 'remove', paths)
+        for versions since+1 .. until, in order. Returns None when the log
+        cannot describe the whole range (a gap, a reactivation, an older
+        pool), in which case callers reload the pool from scratch.
+        """
+        return None
+
+    def features_for(self, paths, color_space='rgb'):
+        """(matrix, paths) for the given images; unknown paths are left out."""
+        raise NotImplementedError
+
+    def count(self):
+        raise NotImplementedError
+
+    def cache_key(self):
+        """Identifies the underlying pool across store instances (see pool_cache.py)."""
+        if '_cache_token' not in self.__dict__:
+            self._cache_token = next(_store_tokens)
+        return (type(self).__name__, self._cache_token)
+
+    def close(self):
+        pass
+
+class MemoryPoolStore(PoolStore):
+    """In-process pool store for tests and benchmarks."""
+
+    def __init__(self, docs=()):
+        self.docs = {}
+        self.hashes = set()
+        self._version = 0
+        self.log = {}
+        self.jobs = {}
+        self.add_batch(list(docs))
+
+    def features(self, color_space='rgb', active_only=False, shards=False):
+        docs = [doc for doc in self.docs.values() if not active_only or doc.get("active", True)]
+        matrix, paths = decode_pool(docs, feature_field(color_space), len(docs))
+        if shards:
+            return matrix, paths, _shard_ids([doc.get(shard_field(color_space)) for doc in docs])
+        return matrix, paths
+
+    def known_paths(self, paths):
+        return set(p for p in paths if p in self.docs)
+
+    def known_hashes(self, hashes):
+        return set(h for h in hashes if h in self.hashes)
+
+    def perceptual_hashes(self):
+        return [doc["phash"] for doc in self.docs.values() if doc.get("phash") is not None]
+
+    def add_batch(self, docs):
+        inserted = []
+        for doc in docs:
+            if doc["imgsrc"] in self.docs or (doc.get("hash") and doc["hash"] in self.hashes):
+                continue
+            self.docs[doc["imgsrc"]] = dict(doc)
+            if doc.get("hash"):
+                self.hashes.add(doc["hash"])
+            inserted.append(doc["imgsrc"])
+        if inserted:
+            self._bump_version('add', inserted)
+        return len(inserted)
+
+    def remove_paths(self, paths):
+        removed = []
+        for path in paths:
+            doc = self.docs.pop(path, None)
+            if doc is not None:
+                self.hashes.discard(doc.get("hash"))
+                removed.append(path)
+        if removed:
+            self._bump_version('remove', removed)
+        return len(removed)
+
+    def _bump_version(self, kind, paths=()):
+        self._version += 1
+        self.log[self._version] = (kind, list(paths))
+
+    def changes_since(self, since, until):
+        return _ordered_changes([(v, self.log.get(v)) for v in range(since + 1, until + 1)])
+
+    def features_for(self, paths, color_space='rgb'):
+        docs = [self.docs[p] for p in paths if p in self.docs]
+        return decode_pool(docs, feature_field(color_space), len(docs))
+
+    def set_inactive(self, paths):
+        paths = set(paths)
+        for path, doc in self.docs.items():
+            doc["active"] = path not in paths
+        self._bump_version('reset')
+
+    def inactive_paths(self):
+        return set(path for path, doc in self.docs.items() if not doc.get("active", True))
+
+    def update_usage(self, counts, job=None):
+        if job is not None:
+            if job in self.jobs:
+                return False
+            self.jobs[job] = dict(counts)
+        for path, n in counts.items():
+            if path in self.docs:
+                self.docs[path]["usage"] = self.docs[path].get("usage", 0) + n
+        return True
+
+    def usage(self):
+        return dict((path, doc["usage"]) for path, doc in self.docs.items() if doc.get("usage"))
+
+    def job_usage(self, job):
+        return dict(self.jobs.get(job, {}))
+
+    def reset_usage(self):
+        for doc in self.docs.values():
+            doc["usage"] = 0
+
+    def version(self):
+        return self._version
+
+    def count(self):
+        return len(self.docs)
+
+class MongoPoolStore(PoolStore):
+    """image_pool collection in MongoDB, via the shared per-process client."""
+    def __init__(self, db_name='temp', uri=None):
+        self.db_name = db_name
+        self.uri = uri
+
+    @property
+    def db(self):
+        return get_mongo_client(self.uri)[self.db_name]
+
+    def cache_key(self):
+        return ('mongo', self.uri or MONGO_ATLAS_URI, self.db_name)
+
+    @property
+    def collection(self):
+        return self.db.image_pool
+
+    def ensure_indexes(self):
+        """
+        Unique indexes used for dedupe: one on the image path and one on the
+        content hash (partial, so documents ingested before hashing are allowed).
+        """
+        self.collection.create_index("imgsrc", unique=True)
+        self.collection.create_index("hash", unique=True,
+                                     partialFilterExpression={"hash": {"$exists": True}})
+
+    def features(self, color_space='rgb', active_only=False, partitions=None, batch_size=None, shards=False):
+        """
+        Stream one colour space's features straight into a preallocated
+        matrix. Only imgsrc, featureSchema and the requested feature field
+        (plus the shard field with shards=True) are fetched, in _id order.
+        With partitions > 1, _id ranges are read by parallel cursors, each
+        filling its own slice of the matrix.
+        """
+        field = feature_field(color_space)
+        projection = {"imgsrc": 1, "featureSchema": 1, field: 1}
+        field_shard = shard_field(color_space) if shards else None
+        if field_shard:
+            projection[field_shard] = 1
+        base = {"active": {"$ne": False}} if active_only else {}
+        partitions = partitions or MONGO_LOAD_PARTITIONS
+        batch_size = batch_size or MONGO_LOAD_BATCH_SIZE
+        total = self.collection.count_documents(base)
+        if partitions <= 1 or total < partitions * batch_size:
+            cursor = self.collection.find(base, projection, batch_size=batch_size).sort("_id", 1)
+            values = []
+            matrix, paths = decode_pool(_collect(cursor, field_shard, values), field, total)
+            return (matrix, paths, _shard_ids(values)) if shards else (matrix, paths)
+        starts = [total * k // partitions for k in range(partitions)] + [total]
+        bounds = [self._id_at(rank, base) for rank in starts[1:-1]]
+        matrix = np.empty((total,) + FEATURE_SHAPE, dtype=FEATURE_DTYPE)
+        values = [[] for _ in range(partitions)]
+
+        def load(k):
+            query = dict(base)
+            if k > 0:
+                query.setdefault("_id", {})["$gte"] = bounds[k - 1]
+            if k < partitions - 1:
+                query.setdefault("_id", {})["$lt"] = bounds[k]
+            cursor = self.collection.find(query, dict(projection), batch_size=batch_size).sort("_id", 1)
+            docs = _collect(cursor, field_shard, values[k])
+            return decode_pool_into(docs, field, matrix[starts[k]:starts[k + 1]])
+
+        with ThreadPoolExecutor(max_workers=partitions) as executor:
+            parts = list(executor.map(load, range(partitions)))
+        shard_ids = _shard_ids([v for part in values for v in part]) if shards else None
+        if all(extra is None and len(p) == starts[k + 1] - starts[k] for k, (p, extra) in enumerate(parts)):
+            paths = [path for p, _ in parts for path in p]
+            return (matrix, paths, shard_ids) if shards else (matrix, paths)
+        # The collection changed while loading: stitch the partitions together.
+        logger.info("Pool changed during a partitioned load; compacting.")
+        blocks, paths = [], []
+        for k, (p, extra) in enumerate(parts):
+            blocks.append(matrix[starts[k]:starts[k] + len(p)])
+            paths.extend(p)
+            if extra is not None:
+                blocks.append(extra[0])
+                paths.extend(extra[1])
+        return (np.concatenate(blocks), paths, shard_ids) if shards else (np.concatenate(blocks), paths)
+
+    def _id_at(self, rank, query=None):
+        """_id of the document at the given rank in _id order."""
+        doc = next(self.collection.find(query or {}, {"_id": 1}).sort("_id", 1).skip(rank).limit(1))
+        return doc["_id"]
+
+    def known_paths(self, paths):
+        found = self.collection.find({"imgsrc": {"$in": list(paths)}}, {"imgsrc": 1, "_id": 0})
+        return set(x["imgsrc"] for x in found)
+
+    def known_hashes(self, hashes):
+        found = self.collection.find({"hash": {"$in": list(hashes)}}, {"hash": 1, "_id": 0})
+        return set(x["hash"] for x in found)
+
+    def perceptual_hashes(self):
+        found = self.collection.find({"phash": {"$exists": True}}, {"phash": 1, "_id": 0}).batch_size(10000)
+        return [x["phash"] for x in found]
+
+    def add_batch(self, docs):
+        """
+        Insert with one unordered insert_many. Documents rejected by the
+        unique indexes (a concurrent worker or an identical file got there
+        first) are skipped.
+        """
+        from pymongo.errors import BulkWriteError
+
+        if not docs:
+            return 0
+        try:
+            self.collection.insert_many(docs, ordered=False)
+            inserted = [doc["imgsrc"] for doc in docs]
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != 11000 for err in errors):
+                raise
+            logger.warning("Skipped %d duplicate images in batch.", len(errors))
+            failed = set(err.get("index") for err in errors)
+            inserted = [doc["imgsrc"] for i, doc in enumerate(docs) if i not in failed]
+        if inserted:
+            self._bump_version('add', inserted)
+        return len(inserted)
+
+    def remove_paths(self, paths):
+        paths = list(paths)
+        if not paths:
+            return 0
+        removed = self.collection.delete_many({"imgsrc": {"$in": paths}}).deleted_count
+        if removed:
+            self._bump_version('remove', paths)
+        return removed
+
+    def _bump_version(self, kind, paths=()):
+        """
+        Increment the version and record what changed under the new number
+        in pool_log, after the data itself was written.
+        """
+        from pymongo import ReturnDocument
+
+        meta = self.db.pool_meta.find_one_and_update({"_id": "image_pool"}, {"$inc": {"version": 1}},
+                                                     upsert=True, return_document=ReturnDocument.AFTER)
+        self.db.pool_log.insert_one({"_id": meta["version"], "kind": kind, "paths": list(paths)})
+
+    def changes_since(self, since, until):
+        entries = self.db.pool_log.find({"_id": {"$gt": since, "$lte": until}}).sort("_id", 1)
+        found = dict((e["_id"], (e["kind"], e["paths"])) for e in entries)
+        return _ordered_changes([(v, found.get(v)) for v in range(since + 1, until + 1)])
+
+    def features_for(self, paths, color_space='rgb'):
+        field = feature_field(color_space)
+        docs = self.collection.find({"imgsrc": {"$in": list(paths)}}, {"imgsrc": 1, "featureSchema": 1, field: 1})
+        return decode_pool(docs, field, len(paths))
+
+    def set_inactive(self, paths):
+        paths = list(paths)
+        self.collection.update_many({"active": False}, {"$unset": {"active": ""}})
+        for start in range(0, len(paths), 1000):
+            self.collection.update_many({"imgsrc": {"$in": paths[start:start + 1000]}},
+                                        {"$set": {"active": False}})
+        self._bump_version('reset')
+
+    def inactive_paths(self):
+        return set(x["imgsrc"] for x in self.collection.find({"active": False}, {"imgsrc": 1, "_id": 0}))
+
+    def update_usage(self, counts, job=None):
+        """
+        The counters are incremented first and the job record (its _id is
+        the job id) inserted only once that write succeeded, so a failed
+        write leaves nothing behind and the retry applies the counts. A
+        retried job whose record exists is skipped; a crash between the two
+        writes can count a job twice, never lose it.
+        """
+        from pymongo import UpdateOne
+        from pymongo.errors import DuplicateKeyError
+
+        if job is not None and self.db.pool_usage.find_one({"_id": job}, {"_id": 1}) is not None:
+            logger.info("Usage of job %s already recorded.", job)
+            return False
+        if counts:
+            self.collection.bulk_write([UpdateOne({"imgsrc": path}, {"$inc": {"usage": n}})
+                                        for path, n in counts.items()], ordered=False)
+        if job is not None:
+            try:
+                self.db.pool_usage.insert_one({"_id": job, "created": datetime.utcnow(),
+                                               "tiles": sum(counts.values()),
+                                               "counts": [[path, n] for path, n in counts.items()]})
+            except DuplicateKeyError:
+                logger.warning("Usage of job %s was recorded concurrently.", job)
+        return True
+
+    def usage(self):
+        found = self.collection.find({"usage": {"$gt": 0}}, {"imgsrc": 1, "usage": 1, "_id": 0}).batch_size(10000)
+        return dict((x["imgsrc"], x["usage"]) for x in found)
+
+    def job_usage(self, job):
+        doc = self.db.pool_usage.find_one({"_id": job}, {"counts": 1})
+        return dict((path, n) for path, n in doc["counts"]) if doc else {}
+
+    def reset_usage(self):
+        self.collection.update_many({}, {"$set": {"usage": 0}})
+
+    def version(self):
+        doc = self.db.pool_meta.find_one({"_id": "image_pool"}, {"version": 1})
+        return doc["version"] if doc else 0
+
+    def count(self):
+        return self.collection.estimated_document_count()
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_pool (
+    id INTEGER PRIMARY KEY,
+    imgsrc TEXT NOT NULL UNIQUE,
+    hash TEXT UNIQUE,
+    avgRGB BLOB NOT NULL,
+    avgLab BLOB NOT NULL,
+    featureSchema INTEGER,
+    usage INTEGER NOT NULL DEFAULT 0,
+    phash INTEGER,
+    active INTEGER NOT NULL DEFAULT 1,
+    shardRGB INTEGER,
+    shardLab INTEGER
+);
+CREATE TABLE IF NOT EXISTS pool_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS pool_log (version INTEGER PRIMARY KEY, kind TEXT NOT NULL, paths TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS pool_jobs (job TEXT PRIMARY KEY, created TEXT NOT NULL, tiles INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS pool_usage (job TEXT NOT NULL, imgsrc TEXT NOT NULL, count INTEGER NOT NULL,
+                                       PRIMARY KEY (job, imgsrc));
+"""
+
+class SQLitePoolStore(PoolStore):
+    """Pool stored in a local SQLite file; needs no external service."""
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.executescript(SQLITE_SCHEMA)
+            self._migrate(self._conn)
+            self._pid = os.getpid()
+        return self._conn
+
+    @staticmethod
+    def _migrate(conn):
+        """Add columns introduced after a database file was created."""
+        columns = set(r[1] for r in conn.execute("PRAGMA table_info(image_pool)"))
+        if 'phash' not in columns:
+            conn.execute("ALTER TABLE image_pool ADD COLUMN phash INTEGER")
+        if 'active' not in columns:
+            conn.execute("ALTER TABLE image_pool ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+        for field in ('shardRGB', 'shardLab'):
+            if field not in columns:
+                conn.execute(f"ALTER TABLE image_pool ADD COLUMN {field} INTEGER")
+
+    def cache_key(self):
+        return ('sqlite', os.path.abspath(self.path))
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_conn'] = None
+        return state
+
+    def features(self, color_space='rgb', active_only=False, shards=False):
+        field = feature_field(color_space)
+        field_shard = shard_field(color_space)
+        where = "WHERE active = 1" if active_only else ""
+        count = self.conn.execute(f"SELECT COUNT(*) FROM image_pool {where}").fetchone()[0]
+        rows = self.conn.execute(f"SELECT imgsrc, {field}, featureSchema, {field_shard} FROM image_pool {where} "
+                                 "ORDER BY id")
+        values = []
+        matrix, paths = decode_pool(_collect((dict(r) for r in rows), field_shard, values), field, count)
+        return (matrix, paths, _shard_ids(values)) if shards else (matrix, paths)
+
+    def _known(self, column, values):
+        values = list(values)
+        known = set()
+        for start in range(0, len(values), 500):
+            chunk = values[start:start + 500]
+            marks = ','.join('?' * len(chunk))
+            known.update(r[0] for r in self.conn.execute(
+                f"SELECT {column} FROM image_pool WHERE {column} IN ({marks})", chunk))
+        return known
+
+    def known_paths(self, paths):
+        return self._known('imgsrc', paths)
+
+    def known_hashes(self, hashes):
+        return self._known('hash', hashes)
+
+    def perceptual_hashes(self):
+        return [r[0] for r in self.conn.execute("SELECT phash FROM image_pool WHERE phash IS NOT NULL")]
+
+    def add_batch(self, docs):
+        inserted = []
+        with self.conn:
+            for d in docs:
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO image_pool (imgsrc, hash, avgRGB, avgLab, featureSchema, usage, phash, "
+                    "shardRGB, shardLab) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (d["imgsrc"], d.get("hash"), bytes(d["avgRGB"]), bytes(d["avgLab"]),
+                     d.get("featureSchema"), d.get("usage", 0), d.get("phash"), d.get("shardRGB"), d.get("shardLab")))
+                if cursor.rowcount:
+                    inserted.append(d["imgsrc"])
+            if inserted:
+                self._bump_version('add', inserted)
+        return len(inserted)
+
+    def remove_paths(self, paths):
+        removed = []
+        with self.conn:
+            for path in paths:
+                if self.conn.execute("DELETE FROM image_pool WHERE imgsrc = ?", (path,)).rowcount:
+                    removed.append(path)
+            if removed:
+                self._bump_version('remove', removed)
+        return len(removed)
+
+    def _bump_version(self, kind, paths=()):
+        """Increment the version and log the change; runs inside the caller's transaction."""
+        self.conn.execute("INSERT INTO pool_meta (key, value) VALUES ('version', 1) "
+                          "ON CONFLICT(key) DO UPDATE SET value = value + 1")
+        version = self.conn.execute("SELECT value FROM pool_meta WHERE key = 'version'").fetchone()[0]
+        self.conn.execute("INSERT OR REPLACE INTO pool_log (version, kind, paths) VALUES (?, ?, ?)",
+                          (version, kind, json.dumps(list(paths))))
+
+    def changes_since(self, since, until):
+        rows = self.conn.execute("SELECT version, kind, paths FROM pool_log WHERE version > ? AND version <= ?",
+                                 (since, until))
+        found = dict((r[0], (r[1], json.loads(r[2]))) for r in rows)
+        return _ordered_changes([(v, found.get(v)) for v in range(since + 1, until + 1)])
+
+    def features_for(self, paths, color_space='rgb'):
+        field = feature_field(color_space)
+        paths = list(paths)
+        docs = []
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            marks = ','.join('?' * len(chunk))
+            docs.extend(dict(r) for r in self.conn.execute(
+                f"SELECT imgsrc, {field}, featureSchema FROM image_pool WHERE imgsrc IN ({marks})", chunk))
+        return decode_pool(docs, field, len(docs))
+
+    def set_inactive(self, paths):
+        with self.conn:
+            self.conn.execute("UPDATE image_pool SET active = 1 WHERE active = 0")
+            self.conn.executemany("UPDATE image_pool SET active = 0 WHERE imgsrc = ?", [(p,) for p in paths])
+            self._bump_version('reset')
+
+    def inactive_paths(self):
+        return set(r[0] for r in self.conn.execute("SELECT imgsrc FROM image_pool WHERE active = 0"))
+
+    def update_usage(self, counts, job=None):
+        with self.conn:
+            if job is not None:
+                cursor = self.conn.execute("INSERT OR IGNORE INTO pool_jobs (job, created, tiles) VALUES (?, ?, ?)",
+                                           (job, datetime.utcnow().isoformat(), sum(counts.values())))
+                if not cursor.rowcount:
+                    logger.info("Usage of job %s already recorded.", job)
+                    return False
+                self.conn.executemany("INSERT INTO pool_usage (job, imgsrc, count) VALUES (?, ?, ?)",
+                                      [(job, path, n) for path, n in counts.items()])
+            self.conn.executemany("UPDATE image_pool SET usage = usage + ? WHERE imgsrc = ?",
+                                  [(n, path) for path, n in counts.items()])
+        return True
+
+    def usage(self):
+        return dict((r[0], r[1]) for r in self.conn.execute("SELECT imgsrc, usage FROM image_pool WHERE usage > 0"))
+
+    def job_usage(self, job):
+        return dict((r[0], r[1]) for r in self.conn.execute("SELECT imgsrc, count FROM pool_usage WHERE job = ?",
+                                                             (job,)))
+
+    def reset_usage(self):
+        with self.conn:
+            self.conn.execute("UPDATE image_pool SET usage = 0")
+
+    def version(self):
+        row = self.conn.execute("SELECT value FROM pool_meta WHERE key = 'version'").fetchone()
+        return row[0] if row else 0
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM image_pool").fetchone()[0]
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+def _ordered_changes(entries):
+    """Validate (version, entry) pairs for changes_since(): no gaps, no resets."""
+    changes = []
+    for version, entry in entries:
+        if entry is None or entry[0] not in ('add', 'remove'):
+            return None
+        changes.append(entry)
+    return changes
+
+def _collect(docs, field, values):
+    """Pass docs through, appending each one's field to values (nothing without a field)."""
+    for doc in docs:
+        if field:
+            values.append(doc.get(field))
+        yield doc
+
+def _shard_ids(values):
+    """Stored shard ids as an array, or None when any document has none (they are then recomputed)."""
+    if any(v is None for v in values):
+        return None
+    return np.array(values, dtype=np.int64)
+
+def resolve_store(pool):
+    """Accept a PoolStore, a database name (MongoDB) or None (no store)."""
+    if pool is None or isinstance(pool, PoolStore):
+        return pool
+    return MongoPoolStore(pool)
@@ -0,0 +1,126 @@
+"""
+prefetch.py
+
+PURPOSE:
+    Implements the TilePrefetcher class, which decodes matched tile images in a thread pool
+    ahead of the renderer so that decode I/O overlaps with scaling and pasting.
+
+HOW IT COMMUNICATES:
+    - Used by photomosaic.py (PhotoMosaic.mosaic) once choose_match() has assigned matches.
+    - Reads match images from the local filesystem (with Pillow), or from a memory-mapped
+      TilePack (tilepack.py) when one is given; no database access.
+
+PATHS TO CHECK:
+    - The match paths stored on each Tile must be readable from the rendering worker.
+
+MODERNIZATION NOTES:
+    - Uses concurrent.futures threads: Pillow releases the GIL while decoding and resampling.
+    - A bounded queue.Queue provides backpressure, so at most `max_pending` decoded
+      images (plus one per thread) are held in memory at any time.
+"""
+
+import logging
+import os
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+def decode_tile(filename, temp_size, tile_pack=None):
+    """
+    Decode a single match image and shrink it to temp_size.
+    Uses JPEG draft mode so large sources are decoded at reduced scale.
+    Packed thumbnails in tile_pack are used instead when present.
+    """
+    try:
+        if tile_pack is not None:
+            im = tile_pack.thumbnail(filename, temp_size)
+            if im is not None:
+                return im
+        im = Image.open(filename)
+        im.draft('RGB', temp_size)
+        if im.mode == 'RGBA':
+            im.load()
+            rgb = Image.new('RGB', im.size, (255, 255, 255))
+            rgb.paste(im, mask=im.split()[3])
+            im = rgb
+        else:
+            im = im.convert('RGB')
+        im.thumbnail(temp_size, Image.ANTIALIAS)
+        return im
+    except Exception as e:
+        logger.warning(f"Cannot open {filename}: {e}")
+        return None
+
+class TilePrefetcher(object):
+    """
+    Iterates over (image, tiles) pairs, one per unique (match, size) key.
+
+    Tiles sharing the same match image at the same size are grouped so every
+    image is decoded exactly once. Decoding runs in a thread pool; a feeder
+    thread submits work into a bounded queue and blocks when the renderer
+    falls behind.
+
+    Example usage:
+        for img, tiles in TilePrefetcher(mypm.tiles):
+            for tile in tiles:
+                ...
+    """
+    def __init__(self, tiles, workers=None, max_pending=32, tile_pack=None):
+        self.tile_pack = tile_pack
+        self.workers = workers or min(32, 2 * (os.cpu_count() or 1))
+        self.max_pending = max(1, max_pending)
+        self.groups = OrderedDict()
+        for tile in tiles:
+            if getattr(tile, "blank", False) or tile.match is None:
+                continue
+            self.groups.setdefault((tile.match, tile.match_size), []).append(tile)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __iter__(self):
+        pending = queue.Queue(maxsize=self.max_pending)
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        def feed():
+            try:
+                for key, tiles in self.groups.items():
+                    future = executor.submit(decode_tile, key[0], key[1], self.tile_pack)
+                    while not stop.is_set():
+                        try:
+                            pending.put((future, tiles), timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+                    if stop.is_set():
+                        future.cancel()
+                        return
+            finally:
+                while not stop.is_set():
+                    try:
+                        pending.put(_DONE, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+
+        feeder = threading.Thread(target=feed, name="tile-prefetch", daemon=True)
+        feeder.start()
+        try:
+            while True:
+                item = pending.get()
+                if item is _DONE:
+                    break
+                future, tiles = item
+                yield future.result(), tiles
+        finally:
+            stop.set()
+            feeder.join()
+            executor.shutdown(wait=True)
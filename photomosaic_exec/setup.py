@@ -52,6 +52,82 @@ ext_modules = [
               include_dirs=["."],
               library_dirs=[],
               libraries=[]),
+    Extension("prefetch", ["prefetch.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("streaming", ["streaming.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("deepzoom", ["deepzoom.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("manifest", ["manifest.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("export", ["export.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("features", ["features.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("feature_store", ["feature_store.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("pool_store", ["pool_store.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("pool_cache", ["pool_cache.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("scanner", ["scanner.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("dedupe", ["dedupe.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("tilepack", ["tilepack.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("ingest", ["ingest.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("coreset", ["coreset.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("quantize", ["quantize.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("shards", ["shards.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("orientations", ["orientations.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("stages", ["stages.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
+    Extension("distributed", ["distributed.py"],
+              include_dirs=["."],
+              library_dirs=[],
+              libraries=[]),
     Extension("color_metrics", [
         "PhotoMosaic_source/color_metrics/color_metrics.pyx",
         "PhotoMosaic_source/color_metrics/deltaE2000.c",
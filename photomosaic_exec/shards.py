@@ -0,0 +1,139 @@
+"""
+shards.py
+
+PURPOSE:
+    Dominant-colour sharding of the pool. Every image falls into one cell of a coarse grid over
+    its mean colour (4 buckets per channel: red/green/blue, or luminance/a/b for Lab), and
+    matching visits only the shards whose colours are close enough to the tile to hold its best
+    match, widening to neighbouring shards as near ones run out.
+
+HOW IT COMMUNICATES:
+    - shard_of() is called by photomosaic.py at ingestion (the shardRGB / shardLab document
+      fields) and by feature_store.py when writing a local store.
+    - ShardIndex is built once per pool snapshot through PoolSnapshot.get_index (pool_cache.py)
+      and used by choose_match(sharded=True).
+
+PATHS TO CHECK:
+    - No paths to configure.
+
+MODERNIZATION NOTES:
+    - The search is exact, not approximate: the distance between two 4x4 feature grids is at
+      least sqrt(16) times the distance between their mean colours, so a shard whose colour
+      range is farther than the best match found so far cannot contain a better one.
+    - Shard bounds are taken from the images actually in each shard, so stored shard ids only
+      need to be a partition; they stay correct if the bucketing changes between ingestions.
+"""
+
+import heapq
+import logging
+import math
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SHARD_BINS = 4
+SHARD_RANGES = {'rgb': ((0., 255.), (0., 255.), (0., 255.)),
+                'lab': ((0., 100.), (-128., 128.), (-128., 128.))}
+SHARD_FIELDS = {'rgb': 'shardRGB', 'lab': 'shardLab'}
+
+def shard_field(color_space):
+    """Document field holding the stored shard id for color_space."""
+    return SHARD_FIELDS['rgb' if color_space == 'rgb' else 'lab']
+
+def _means(features, dtype=np.float32):
+    x = np.asarray(features, dtype=dtype)
+    return x.reshape(-1, x.shape[-2], x.shape[-1]).mean(axis=1)
+
+def shard_of(features, color_space='rgb', bins=SHARD_BINS):
+    """
+    Shard id of one (16, 3) feature grid (an int), or of every row of an
+    (n, 16, 3) matrix (an int array).
+    """
+    means = _means(features)
+    ranges = np.array(SHARD_RANGES['rgb' if color_space == 'rgb' else 'lab'], dtype=np.float32)
+    cells = np.floor((means - ranges[:, 0]) / (ranges[:, 1] - ranges[:, 0]) * bins)
+    cells = np.clip(cells, 0, bins - 1).astype(np.int64)
+    ids = (cells[:, 0] * bins + cells[:, 1]) * bins + cells[:, 2]
+    return int(ids[0]) if np.ndim(features) == 2 else ids
+
+class ShardIndex(object):
+    """
+    Pool rows grouped by shard, with the bounding box of each shard's mean
+    colours.
+
+    Example usage:
+        index = ShardIndex(features, color_space='rgb')
+        for row in index.ranked(tile.rgb, exhausted):
+            ...                                 # nearest usable image first
+    """
+    def __init__(self, features, shards=None, color_space='rgb'):
+        features = np.asarray(features)
+        self.features = features.reshape(len(features), features.shape[1] * features.shape[2])
+        if shards is None:
+            shards = shard_of(features, color_space)
+        shards = np.asarray(shards)
+        order = np.argsort(shards, kind='stable')
+        self.ids, starts = np.unique(shards[order], return_index=True)
+        self.rows = np.split(order, starts[1:]) if len(order) else []
+        means = _means(features, np.float64)
+        self.lo = np.array([means[rows].min(axis=0) for rows in self.rows]).reshape(-1, 3)
+        self.hi = np.array([means[rows].max(axis=0) for rows in self.rows]).reshape(-1, 3)
+        # sqrt(number of regions): grid distance >= this * mean colour distance
+        self.scale = math.sqrt(features.shape[1])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def bounds(self, query):
+        """Lower bound of the distance from query to any image of each shard."""
+        m = _means(query, np.float64)[0]
+        gap = np.maximum(self.lo - m, 0) + np.maximum(m - self.hi, 0)
+        return self.scale * np.sqrt((gap ** 2).sum(axis=1))
+
+    def ranked(self, query, exhausted=None, distances=False, penalty=None):
+        """
+        Yield pool rows in order of increasing distance to query, skipping
+        rows flagged in exhausted. Shards are opened lazily, nearest first,
+        so a consumer that stops after a few rows only scans nearby shards.
+        With distances=True, (distance, row) pairs are yielded instead.
+        penalty (non-negative, one value per row) is added to the distances;
+        the shard bounds stay valid lower bounds.
+        """
+        q = np.asarray(query, dtype=np.float64).reshape(-1)
+        bounds = self.bounds(query)
+        heap = []
+        for s in np.argsort(bounds):
+            while heap and heap[0][0] <= bounds[s]:
+                item = heapq.heappop(heap)
+                yield item if distances else item[1]
+            rows = self.rows[s]
+            if exhausted is not None:
+                rows = rows[~exhausted[rows]]
+            if not len(rows):
+                continue
+            d = np.sqrt(((self.features[rows] - q) ** 2).sum(axis=1))
+            if penalty is not None:
+                d += penalty[rows]
+            heap.extend(zip(d.tolist(), rows.tolist()))
+            heapq.heapify(heap)
+        while heap:
+            item = heapq.heappop(heap)
+            yield item if distances else item[1]
+
+    def ranked_variants(self, queries, exhausted=None, penalty=None):
+        """
+        ranked() for several queries against the same rows (the oriented
+        variants of a tile), merged by distance. Query k's rows are yielded
+        as k * len(pool) + row, and exhausted is a mask over that range.
+        """
+        n = len(self.features)
+        streams = [_offset(self.ranked(q, None if exhausted is None else exhausted[k * n:(k + 1) * n], True, penalty),
+                           k * n)
+                   for k, q in enumerate(queries)]
+        for _, j in heapq.merge(*streams):
+            yield j
+
+def _offset(pairs, offset):
+    for d, row in pairs:
+        yield d, offset + row
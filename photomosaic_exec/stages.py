@@ -0,0 +1,201 @@
+"""
+stages.py
+
+PURPOSE:
+    The mosaic job split into resumable stages (analyze -> match -> render -> encode) that hand
+    compact artifacts to each other through a job directory, so each stage can run as its own
+    task, on its own queue, and a failure late in the job only reruns what is missing.
+
+HOW IT COMMUNICATES:
+    - Used by mosaic/tasks.py, which runs each stage as a Celery task in a chain (the match
+      stage optionally as a chord over match_payloads() shards, see distributed.py).
+    - Reads the source image and pool thumbnails, talks to the pool through PoolStore in the
+      match stage only, and reads and writes artifacts below the job directory:
+        job.json        job parameters (source image, grid, shape, depth, tile pack)
+        analysis.npz    per-tile rgb / lab features
+        plan.npz        match plan: pool image index and orientation per tile
+        strips/*.npy    rendered strips (uint8 rows), one file per grid row
+        <outfile>       the encoded mosaic
+
+PATHS TO CHECK:
+    - The job directory must be on storage shared by every worker that runs a stage of the job
+      (local disk if all queues are served by one node).
+
+MODERNIZATION NOTES:
+    - Artifacts are written to a temporary name and renamed, so a crashed stage never leaves a
+      partial artifact; a stage whose artifact exists returns at once, and render only
+      renders the strips that are missing.
+    - Later stages rebuild the tile grid with partition() (cheap and deterministic) and attach
+      the stored features and matches by tile key instead of pickling Tile objects.
+"""
+
+import json
+import logging
+import os
+
+import numpy as np
+
+from .photomosaic import PhotoMosaic
+from .streaming import write_streaming
+
+logger = logging.getLogger(__name__)
+
+JOB_FILE = 'job.json'
+ANALYSIS_FILE = 'analysis.npz'
+PLAN_FILE = 'plan.npz'
+STRIPS_DIR = 'strips'
+
+def tile_key(tile):
+    """Identifies a tile across partition() runs of the same job."""
+    return [tile.x, tile.y] + [list(pos) for pos in tile.ancestry]
+
+def _replace_npz(path, **arrays):
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, **arrays)
+    os.replace(tmp, path)
+
+def create_job(job_dir, im_path, dimensions, shape=None, depth=0, tile_pack=None, factor=4, fade=None):
+    """Write job.json for a new job. Returns the job parameters."""
+    os.makedirs(job_dir, exist_ok=True)
+    params = {"im_path": im_path, "dimensions": list(dimensions), "shape": shape, "depth": depth,
+              "tile_pack": tile_pack, "factor": factor, "fade": fade}
+    tmp = os.path.join(job_dir, JOB_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(params, f)
+    os.replace(tmp, os.path.join(job_dir, JOB_FILE))
+    return params
+
+def load_job(job_dir):
+    with open(os.path.join(job_dir, JOB_FILE)) as f:
+        return json.load(f)
+
+def open_mosaic(job_dir):
+    """
+    PhotoMosaic for the job, partitioned, with the analysis and match plan
+    attached when those artifacts exist.
+    """
+    params = load_job(job_dir)
+    mypm = PhotoMosaic(params["im_path"], tuple(params["dimensions"]), params["shape"],
+                       tile_pack=params["tile_pack"])
+    mypm.partition(depth=params["depth"])
+    tiles = dict((json.dumps(tile_key(t)), t) for t in mypm.tiles)
+    analysis = os.path.join(job_dir, ANALYSIS_FILE)
+    if os.path.exists(analysis):
+        with np.load(analysis) as data:
+            for key, rgb, lab in zip(json.loads(str(data["keys"])), data["rgb"], data["lab"]):
+                tile = tiles[json.dumps(key)]
+                tile.rgb, tile.lab = rgb, lab
+    plan = os.path.join(job_dir, PLAN_FILE)
+    if os.path.exists(plan):
+        with np.load(plan) as data:
+            pool = json.loads(str(data["pool"]))
+            for key, (index, orientation) in zip(json.loads(str(data["keys"])), data["matches"].tolist()):
+                tile = tiles[json.dumps(key)]
+                tile.match = pool[index]
+                tile.orientation = orientation
+    return mypm
+
+def analyze(job_dir):
+    """Stage 1: per-tile features -> analysis.npz."""
+    path = os.path.join(job_dir, ANALYSIS_FILE)
+    if os.path.exists(path):
+        return path
+    mypm = open_mosaic(job_dir)
+    mypm.analyze()
+    tiles = [t for t in mypm.tiles if not (hasattr(t, "blank") and t.blank)]
+    empty = np.zeros((0, 16, 3))
+    _replace_npz(path, keys=np.array(json.dumps([tile_key(t) for t in tiles])),
+                 rgb=np.array([t.rgb for t in tiles]) if tiles else empty,
+                 lab=np.array([t.lab for t in tiles]) if tiles else empty)
+    logger.info("Analyzed %d tiles into %s", len(tiles), path)
+    return path
+
+def match(job_dir, pool, job=None, **match_kwargs):
+    """
+    Stage 2: choose_match() over the stored analysis -> plan.npz. Usage is
+    recorded under job (see PhotoMosaic.record_usage) before the plan is
+    written, and recording is idempotent, so a rerun does not double count.
+    match_kwargs go to choose_match (local_store, compact, sharded, ...).
+    """
+    path = os.path.join(job_dir, PLAN_FILE)
+    if os.path.exists(path):
+        return path
+    mypm = open_mosaic(job_dir)
+    mypm.choose_match(pool, **match_kwargs)
+    return _save_plan(job_dir, mypm, pool, job)
+
+def match_payloads(job_dir, count, color_space='rgb', sharded=False):
+    """Tile shards of the job for distributed matching (see PhotoMosaic.match_payloads)."""
+    return open_mosaic(job_dir).match_payloads(count, color_space, sharded)
+
+def save_plan(job_dir, matches, pool, job=None):
+    """
+    Stage 2 for distributed matching: write plan.npz from the merged
+    [tile, path, orientation] triples of match_payloads() shards, recording
+    usage as match() does.
+    """
+    path = os.path.join(job_dir, PLAN_FILE)
+    if os.path.exists(path):
+        return path
+    mypm = open_mosaic(job_dir)
+    mypm.apply_matches(matches)
+    return _save_plan(job_dir, mypm, pool, job)
+
+def _save_plan(job_dir, mypm, pool, job):
+    path = os.path.join(job_dir, PLAN_FILE)
+    mypm.record_usage(pool, job)
+    pool_paths, index, keys, matches = [], {}, [], []
+    for tile in mypm.tiles:
+        if (hasattr(tile, "blank") and tile.blank) or tile.match is None:
+            continue
+        if tile.match not in index:
+            index[tile.match] = len(pool_paths)
+            pool_paths.append(tile.match)
+        keys.append(tile_key(tile))
+        matches.append((index[tile.match], tile.orientation))
+    _replace_npz(path, keys=np.array(json.dumps(keys)), pool=np.array(json.dumps(pool_paths)),
+                 matches=np.array(matches, dtype=np.int32).reshape(-1, 2))
+    logger.info("Matched %d tiles to %d pool images into %s", len(keys), len(pool_paths), path)
+    return path
+
+def render(job_dir, workers=None):
+    """
+    Stage 3: render the matched grid strip by strip -> strips/NNNNN.npy.
+    Strips already on disk are kept, so an interrupted render resumes.
+    """
+    params = load_job(job_dir)
+    directory = os.path.join(job_dir, STRIPS_DIR)
+    os.makedirs(directory, exist_ok=True)
+    missing = [row for row in range(params["dimensions"][1]) if not os.path.exists(_strip_path(directory, row))]
+    if not missing:
+        return directory
+    mypm = open_mosaic(job_dir)
+    for row, strip in mypm.iter_strips(params["factor"], workers=workers, fade=params["fade"], only=missing):
+        path = _strip_path(directory, row)
+        tmp = path + '.tmp.npy'
+        np.save(tmp, np.asarray(strip.convert('RGB'), dtype=np.uint8))
+        os.replace(tmp, path)
+    logger.info("Rendered %d strips into %s", len(missing), directory)
+    return directory
+
+def _strip_path(directory, row):
+    return os.path.join(directory, '%05d.npy' % row)
+
+def encode(job_dir, outfile, **save_kwargs):
+    """
+    Stage 4: encode the stored strips into outfile (a name inside the job
+    directory, or an absolute path), streaming PNG / JPEG / TIFF strip by strip.
+    """
+    params = load_job(job_dir)
+    path = os.path.join(job_dir, outfile)
+    if os.path.exists(path):
+        return path
+    directory = os.path.join(job_dir, STRIPS_DIR)
+    strips = [_strip_path(directory, row) for row in range(params["dimensions"][1])]
+    first = np.load(strips[0], mmap_mode='r')
+    size = first.shape[1], sum(np.load(p, mmap_mode='r').shape[0] for p in strips)
+    root, ext = os.path.splitext(path)
+    tmp = root + '.tmp' + ext
+    write_streaming(tmp, size, (np.load(p, mmap_mode='r') for p in strips), **save_kwargs)
+    os.replace(tmp, path)
+    return path
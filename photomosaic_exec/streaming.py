@@ -0,0 +1,239 @@
+"""
+streaming.py
+
+PURPOSE:
+    Writers that encode a mosaic strip by strip, so output size is bounded by disk rather than RAM.
+    Supports row-streamed PNG, baseline JPEG and tiled TIFF / BigTIFF, and a numpy memmap canvas
+    for random-order pasting that is then encoded strip by strip with the same writers.
+
+HOW IT COMMUNICATES:
+    - Used by photomosaic.py (PhotoMosaic.stream_mosaic) with strips from PhotoMosaic.iter_strips().
+    - Writes image files to the local filesystem; no database access.
+
+PATHS TO CHECK:
+    - The output directory (and the memmap scratch directory, if given) must be writable
+      and have room for the uncompressed canvas when the memmap mode is used.
+
+MODERNIZATION NOTES:
+    - PNG is written with stdlib zlib/struct only: one IDAT chunk per strip.
+    - Tiled TIFF uses the optional `tifffile` package (imported lazily).
+    - JPEG bands are encoded separately by Pillow and joined with restart markers (the same
+      stitching as export.py), so only a few bands are in memory. Formats that need the whole
+      image (WebP, progressive JPEG, ...) are rejected; use PhotoMosaic.export() for those.
+"""
+
+import io
+import logging
+import os
+import struct
+import tempfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from .export import MAX_RESTART_INTERVAL, MCU_SIZES, _patch_height, _split_jpeg
+
+logger = logging.getLogger(__name__)
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+BIGTIFF_THRESHOLD = 2 ** 32 - 2 ** 25
+STREAMABLE = ('.png', '.jpg', '.jpeg', '.tif', '.tiff')
+JPEG_BAND_HEIGHT = 256
+
+def reband(strips, band_height):
+    """
+    Regroup an iterable of HxWx3 uint8 arrays (or RGB Images) into bands of
+    exactly band_height rows. The last band may be shorter.
+    """
+    pending = []
+    rows = 0
+    for strip in strips:
+        strip = np.asarray(strip)
+        pending.append(strip)
+        rows += strip.shape[0]
+        while rows >= band_height:
+            buf = np.concatenate(pending, axis=0) if len(pending) > 1 else pending[0]
+            yield buf[:band_height]
+            rest = buf[band_height:]
+            pending = [rest] if rest.shape[0] else []
+            rows = rest.shape[0]
+    if rows:
+        yield np.concatenate(pending, axis=0) if len(pending) > 1 else pending[0]
+
+def _png_chunk(tag, data):
+    chunk = tag + data
+    return struct.pack('>I', len(data)) + chunk + struct.pack('>I', zlib.crc32(chunk) & 0xffffffff)
+
+def write_png(outfile, size, strips, compress_level=6):
+    """
+    Stream an RGB PNG, compressing each strip as it arrives.
+    Only one strip (plus zlib state) is held in memory.
+    """
+    width, height = size
+    written = 0
+    compressor = zlib.compressobj(compress_level)
+    with open(outfile, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        f.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        for strip in strips:
+            rows = np.asarray(strip, dtype=np.uint8)
+            if rows.shape[1] != width:
+                raise ValueError("Strip width %d does not match image width %d" % (rows.shape[1], width))
+            # Filter type 0 (None) prefixes every scanline.
+            raw = np.zeros((rows.shape[0], 1 + 3 * width), dtype=np.uint8)
+            raw[:, 1:] = rows.reshape(rows.shape[0], -1)
+            data = compressor.compress(raw.tobytes())
+            if data:
+                f.write(_png_chunk(b'IDAT', data))
+            written += rows.shape[0]
+        f.write(_png_chunk(b'IDAT', compressor.flush()))
+        f.write(_png_chunk(b'IEND', b''))
+    if written != height:
+        raise ValueError("Wrote %d rows, expected %d" % (written, height))
+
+def write_jpeg(outfile, size, strips, quality=90, subsampling=2, workers=None):
+    """
+    Stream a baseline JPEG: strips are regrouped into bands of whole MCU
+    rows, each band is encoded on its own (at most 2 * workers bands in
+    flight) and the entropy-coded data is joined with RSTn markers, the
+    restart interval being one band.
+    """
+    width, height = size
+    mcu_w, mcu_h = MCU_SIZES[subsampling]
+    mcus_per_row = -(-width // mcu_w)
+    if mcus_per_row > MAX_RESTART_INTERVAL:
+        raise ValueError("Image too wide (%d pixels) to stream as JPEG" % width)
+    band_rows = max(1, min(MAX_RESTART_INTERVAL // mcus_per_row, JPEG_BAND_HEIGHT // mcu_h))
+    workers = workers or os.cpu_count() or 1
+    rows = [0]
+
+    def bands():
+        for band in reband(strips, band_rows * mcu_h):
+            if band.shape[1] != width:
+                raise ValueError("Strip width %d does not match image width %d" % (band.shape[1], width))
+            rows[0] += band.shape[0]
+            yield band
+
+    def encode(band):
+        buf = io.BytesIO()
+        Image.fromarray(np.ascontiguousarray(band, dtype=np.uint8)).save(
+            buf, 'JPEG', quality=quality, subsampling=subsampling, optimize=False, progressive=False)
+        return _split_jpeg(buf.getvalue())
+
+    with open(outfile, 'wb') as f, ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, (header, sos, data) in enumerate(_bounded_map(executor, encode, bands(), 2 * workers)):
+            if i == 0:
+                f.write(b'\xff\xd8')
+                for seg in _patch_height(header, height):
+                    f.write(seg)
+                f.write(b'\xff\xdd' + struct.pack('>HH', 4, mcus_per_row * band_rows))
+                f.write(sos)
+            else:
+                f.write(bytes((0xFF, 0xD0 + (i - 1) % 8)))
+            f.write(data)
+        f.write(b'\xff\xd9')
+    if rows[0] != height:
+        raise ValueError("Wrote %d rows, expected %d" % (rows[0], height))
+
+def _bounded_map(executor, func, items, window):
+    """executor.map that submits at most window items ahead of the consumer."""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def write_tiff(outfile, size, strips, tile=256, compression=None, bigtiff=None):
+    """
+    Stream a tiled RGB TIFF with tifffile. BigTIFF is chosen automatically
+    when the uncompressed image approaches the 4 GB classic TIFF limit.
+    """
+    import tifffile
+
+    width, height = size
+    if bigtiff is None:
+        bigtiff = width * height * 3 > BIGTIFF_THRESHOLD
+
+    def tiles():
+        for band in reband(strips, tile):
+            for x in range(0, width, tile):
+                block = np.zeros((tile, tile, 3), dtype=np.uint8)
+                part = band[:, x:x + tile]
+                block[:part.shape[0], :part.shape[1]] = part
+                yield block
+
+    tifffile.imwrite(outfile, data=tiles(), shape=(height, width, 3), dtype=np.uint8,
+                     tile=(tile, tile), photometric='rgb', compression=compression,
+                     bigtiff=bigtiff)
+
+class MemmapCanvas(object):
+    """
+    Disk-backed RGB canvas supporting paste() in any order.
+
+    Example usage:
+        canvas = MemmapCanvas((width, height))
+        canvas.paste(tile_img, (x, y))
+        canvas.save("mosaic.jpg")
+        canvas.close()
+    """
+    def __init__(self, size, background=(255, 255, 255), directory=None):
+        self.size = size
+        fd, self.path = tempfile.mkstemp(suffix='.canvas', dir=directory)
+        os.close(fd)
+        self.array = np.memmap(self.path, dtype=np.uint8, mode='w+', shape=(size[1], size[0], 3))
+        if tuple(background) != (0, 0, 0):
+            for y in range(0, size[1], 256):
+                self.array[y:y + 256] = background
+
+    def paste(self, im, pos):
+        x, y = pos
+        w, h = im.size
+        self.array[y:y + h, x:x + w] = np.asarray(im.convert('RGB'))
+
+    def strips(self, height=256):
+        for y in range(0, self.size[1], height):
+            yield self.array[y:y + height]
+
+    def save(self, outfile, **kwargs):
+        self.array.flush()
+        write_streaming(outfile, self.size, self.strips(), **kwargs)
+
+    def close(self):
+        if self.array is not None:
+            del self.array
+            self.array = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def streamable(outfile):
+    """True if write_streaming() can encode outfile (from its extension)."""
+    return os.path.splitext(outfile)[1].lower() in STREAMABLE
+
+def write_streaming(outfile, size, strips, **kwargs):
+    """
+    Encode strips to outfile, choosing the writer from the file extension.
+    PNG, JPEG and TIFF are streamed; other formats raise ValueError.
+    """
+    ext = os.path.splitext(outfile)[1].lower()
+    if ext == '.png':
+        write_png(outfile, size, strips, **kwargs)
+    elif ext in ('.jpg', '.jpeg'):
+        write_jpeg(outfile, size, strips, **kwargs)
+    elif ext in ('.tif', '.tiff'):
+        write_tiff(outfile, size, strips, **kwargs)
+    else:
+        raise ValueError("Cannot stream %s output; use png, jpg or tif (or PhotoMosaic.export)" % ext)
+    logger.info("Streamed %dx%d mosaic to %s", size[0], size[1], outfile)